@@ -2,7 +2,13 @@
 #include <Arduino.h> //Arduino >= 1.0
 #include "AxesLib.h"
 
-AxesLib::AxesLib(){}
+AxesLib::AxesLib(){
+	_link = 0;
+}
+
+void AxesLib::setLink(LinkLib* link){
+	_link = link;
+}
 
 void AxesLib::setMotorsPins(int stPin_x, int stPin_y, int dirPin, int enable_x, int enable_y){
 	_stPin_x = stPin_x;
@@ -30,6 +36,24 @@ void AxesLib::setSensorsPins(int s0Pin_x, int s360Pin_x,int sbottomPin_y, int st
 	pinMode(_stopPin_y, INPUT);
 }
 
+bool AxesLib::_abortRequested(){
+	if(Serial.available() > 0 && Serial.peek() == ABORT_BYTE){
+		Serial.read();
+		return true;
+	}
+	return false;
+}
+
+void AxesLib::_heartbeat(){
+	if(millis() - _lastBeat >= HEARTBEAT_MS){
+		_lastBeat = millis();
+		if(_link)
+			_link->heartbeat();
+		else
+			Serial.println("k");
+	}
+}
+
 void AxesLib::_enableMotors(){
 	digitalWrite(_enable_x, LOW);
 	digitalWrite(_enable_y, LOW);
@@ -93,6 +117,7 @@ int AxesLib::_step(int axis, bool dir, int steps, int sensor, bool nodelay){
 		delayMicroseconds(1200);
 		digitalWrite(axis, LOW);
 		delayMicroseconds(1200);
+		_heartbeat();
 		
 		//HIGH = limit reached on X   /   LOW = limit reached on Y
 		if( (axis==_stPin_y && digitalRead(sensor)==LOW) || (axis==_stPin_x && digitalRead(sensor)==HIGH))
@@ -128,10 +153,14 @@ bool AxesLib::movx(bool dir){
 		if(steps % 50 == 0 && facel > 1100)
 			facel -= 1000;
 		
-		while(Serial.available() > 0)
+		_heartbeat();
+		if(_abortRequested())
+			break;
+		//Up to the size of a command, and the abort byte is left for the next check
+		while(bytes_recv < 4 && Serial.available() > 0 && Serial.peek() != ABORT_BYTE)
 			comm[bytes_recv++] = Serial.read();
-		//Safeguard...
-		if(bytes_recv>4)
+		//Safeguard: any other command stops the movement too
+		if(bytes_recv == 4)
 			break;
 	}
 	_disableMotors();
@@ -169,10 +198,14 @@ bool AxesLib::movy(bool dir){
 		if(steps % 50 == 0 && facel > 1100)
 			facel -= 1000;
 		
-		while(Serial.available() > 0)
+		_heartbeat();
+		if(_abortRequested())
+			break;
+		//Up to the size of a command, and the abort byte is left for the next check
+		while(bytes_recv < 4 && Serial.available() > 0 && Serial.peek() != ABORT_BYTE)
 			comm[bytes_recv++] = Serial.read();
-		//Safeguard...
-		if(bytes_recv>4)
+		//Safeguard: any other command stops the movement too
+		if(bytes_recv == 4)
 			break;
 	}
 	_disableMotors();
@@ -240,6 +273,15 @@ void AxesLib::goToRads(float rx, float ry){
 	_moveTo((float) degsH*_pgrad_x, (float) _rad2deg(ry)*_pgrad_y);
 }
 
+void AxesLib::goToSteps(long x, long y){
+	if(x<0)	x = 0;
+	if(y<0)	y = 0;
+	if(x>_X) x = _X;
+	if(y>_Y) y = _Y;
+	
+	_moveTo(x, y);
+}
+
 void AxesLib::_moveTo(int x, int y, char* method){
 	_enableMotors();
 	
@@ -302,6 +344,10 @@ void AxesLib::_moveDDA(int x, int y){
 		x_ = x_+x_inc;
 		y_ = y_+y_inc;
 		_moveXY(lrint(x_), lrint(y_), true);
+		
+		//The position is kept consistent, the movement just ends here
+		if(_abortRequested())
+			break;
 	}
 }
 
@@ -3,6 +3,17 @@
 
 	#include <math.h>
 	#include <string.h>
+	#include "LinkLib.h"
+	
+	/**
+	 * Byte that aborts the running movement (goto, move, movx, movy) when received by the serial port
+	 */
+	#define ABORT_BYTE '!'
+	
+	/**
+	 * Interval in milliseconds between heartbeat lines ("k") during the movements
+	 */
+	#define HEARTBEAT_MS 200
 	
 	/**
 	 * \brief Class that manages movements and the laser of the device
@@ -76,6 +87,29 @@
 			 */
 			int _step(int axis, bool dir, int steps, int sensor, bool nodelay=false);
 			
+			/**
+			 * Checks if the abort byte has been received by the serial port, and consumes it
+			 *
+			 * \return True if the running movement must be aborted
+			 */
+			bool _abortRequested();
+			
+			/**
+			 * Communications with the computer (heartbeat)
+			 */
+			LinkLib* _link;
+			
+			/**
+			 * Time (millis) of the last heartbeat line
+			 */
+			unsigned long _lastBeat;
+			
+			/**
+			 * Prints the heartbeat line ("k") if HEARTBEAT_MS have passed since the last one, so the host
+			 * knows that the device is alive during the long movements
+			 */
+			void _heartbeat();
+			
 			/**
 			 * Enables the motors power supply
 			 */
@@ -189,6 +223,13 @@
 			 */			
 			void setSensorsPins(int s0Pin_x, int s360Pin_x, int sbottomPin_y, int stopPin_y);
 			
+			/**
+			 * Sets the communications library used to send the heartbeat
+			 *
+			 * \param link LinkLib instance
+			 */
+			void setLink(LinkLib* link);
+			
 			/**
 			 * Points the device towards the given coordinates
 			 *
@@ -197,10 +238,20 @@
 			 */				
 			void goToRads(float rx, float ry);
 			
+			/**
+			 * Points the device towards the given position in steps, calculated by the computer from the steps
+			 * per revolution (see getPX and getPY), without any conversion
+			 *
+			 * \param x Steps from 0 on the X axis, on range of 0 - getPX()
+			 * \param y Steps from 0 on the Y axis, on range of 0 - getPY()/2 (180º)
+			 */
+			void goToSteps(long x, long y);
+			
 			/**
 			 * Accelerated movement for X axis
 			 * 
-			 * The movement stops when a 'stop' command is received by the serial port
+			 * The movement stops when a 'stop' command or the abort byte is received by the serial port. Any
+			 * other 4 bytes stop it too, and are consumed: the host aborts the movement before another command
 			 *
 			 * \param dir Direction: True means clockwise direction
 			 * \return Returns true in case of reaches a limit sensor
@@ -210,7 +261,8 @@
 			/**
 			 * Accelerated movement for Y axis
 			 * 
-			 * The movement stops when a 'stop' command is received by the serial port
+			 * The movement stops when a 'stop' command or the abort byte is received by the serial port. Any
+			 * other 4 bytes stop it too, and are consumed: the host aborts the movement before another command
 			 * 
 			 * \param dir Direction: True means upwards
 			 * \return Returns true in case of reaches a limit sensor
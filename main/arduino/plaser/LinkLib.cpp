@@ -0,0 +1,259 @@
+// #include "WProgram.h" // Arduino < 1.0
+#include <Arduino.h> //Arduino >= 1.0
+#include "AxesLib.h"
+#include "LinkLib.h"
+
+/**
+ * Codes of the commands in the binary protocol: code character followed by the command name
+ */
+static const char* _commands[] = {"Iinit", "Ttime", "1set1", "2set2", "3set3", "Ggoto", "Mmove", "Xmovx",
+								  "Ymovy", "Sstop", "Llaon", "lloff", "Pping", "Bbaud", "sstep", 0};
+
+/**
+ * Supported speeds of the serial port (besides DEFAULT_BAUD)
+ */
+static const long _bauds[] = {115200, 230400, 500000, 0};
+
+/**
+ * Test pattern of the speed changes (alternate bits, and all zeros and all ones)
+ */
+static const uint8_t _pattern[BAUD_PATTERN_SIZE] = {0x55, 0xAA, 0x00, 0xFF, 0x0F, 0xF0, 0x33, 0xCC};
+
+LinkLib::LinkLib(){
+	_binary = false;
+	_pipelined = false;
+	_baud = DEFAULT_BAUD;
+	_len = 0;
+	_pos = 0;
+}
+
+void LinkLib::setBinary(bool binary){
+	_binary = binary;
+}
+
+bool LinkLib::isBinary(){
+	return _binary;
+}
+
+void LinkLib::setPipelined(bool pipelined){
+	_pipelined = pipelined;
+}
+
+void LinkLib::begin(){
+	Serial.begin(_baud);
+}
+
+bool LinkLib::isSupportedBaud(long baud){
+	for(int i=0;_bauds[i]!=0;i++)
+		if(_bauds[i] == baud)
+			return true;
+	return false;
+}
+
+bool LinkLib::changeBaud(long baud){
+	unsigned long start;
+	int nbytes = 0;
+	bool valid = true;
+
+	//Waiting for the end of the response, at the previous speed
+	Serial.flush();
+	Serial.begin(baud);
+	start = millis();
+	while(nbytes < BAUD_PATTERN_SIZE && millis() - start < BAUD_TIMEOUT){
+		if(Serial.available() > 0){
+			if(Serial.read() != _pattern[nbytes])
+				valid = false;
+			nbytes++;
+		}
+	}
+	if(valid && nbytes == BAUD_PATTERN_SIZE){
+		Serial.write(_pattern, BAUD_PATTERN_SIZE);
+		_baud = baud;
+		return true;
+	}
+	Serial.begin(_baud);
+	return false;
+}
+
+uint8_t LinkLib::_read(){
+	while(Serial.available() <= 0){}
+	return Serial.read();
+}
+
+uint8_t LinkLib::_crc8(uint8_t crc, uint8_t data){
+	crc ^= data;
+	for(int i=0;i<8;i++)
+		crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+	return crc;
+}
+
+void LinkLib::_sendFrame(char code, const void* payload, uint8_t len){
+	const uint8_t* bytes = (const uint8_t*)payload;
+	uint8_t crc = _crc8(_crc8(0, code), len);
+
+	Serial.write((uint8_t)FRAME_START);
+	Serial.write((uint8_t)code);
+	Serial.write(len);
+	for(int i=0;i<len;i++){
+		Serial.write(bytes[i]);
+		crc = _crc8(crc, bytes[i]);
+	}
+	Serial.write(crc);
+}
+
+void LinkLib::_sendPair(char code, const void* a, const void* b){
+	uint8_t payload[8];
+
+	memcpy(payload, a, 4);
+	memcpy(payload+4, b, 4);
+	_sendFrame(code, payload, 8);
+}
+
+void LinkLib::readCommand(char* comm){
+	_len = 0;
+	_pos = 0;
+	comm[4] = '\0';
+	if(_binary)
+		_readFrameCommand(comm);
+	else
+		_readAsciiCommand(comm);
+}
+
+void LinkLib::_readAsciiCommand(char* comm){
+	int bytes_recv = 0;
+
+	if(!_pipelined)
+		Serial.println("cmd");
+	while(bytes_recv < 4){
+		//Waiting for a command...
+		comm[bytes_recv] = _read();
+		//An abort received when nothing is running is ignored
+		if(comm[bytes_recv] != ABORT_BYTE)
+			bytes_recv++;
+	}
+}
+
+void LinkLib::_readFrameCommand(char* comm){
+	uint8_t code, crc;
+
+	//Any byte out of a frame (aborts, padding..) is ignored
+	while(_read() != FRAME_START){}
+	code = _read();
+	_len = _read();
+	crc = _crc8(_crc8(0, code), _len);
+	strcpy(comm, "????");
+	if(_len > FRAME_MAX_PAYLOAD){
+		_len = 0;
+		return;
+	}
+	for(int i=0;i<_len;i++){
+		_payload[i] = _read();
+		crc = _crc8(crc, _payload[i]);
+	}
+	if(_read() != crc)
+		return;
+	for(int i=0;_commands[i]!=0;i++)
+		if(_commands[i][0] == code){
+			strncpy(comm, _commands[i]+1, 4);
+			return;
+		}
+}
+
+float LinkLib::getFloat(){
+	float value = 0.0;
+
+	if(!_binary)
+		return _readAsciiFloat();
+	if(_pos + 4 <= _len){
+		memcpy(&value, _payload+_pos, 4);
+		_pos += 4;
+	}
+	return value;
+}
+
+long LinkLib::getLong(){
+	int32_t value = 0;
+
+	if(!_binary)
+		return lrint(_readAsciiFloat());
+	if(_pos + 4 <= _len){
+		memcpy(&value, _payload+_pos, 4);
+		_pos += 4;
+	}
+	return value;
+}
+
+char LinkLib::getChar(){
+	if(!_binary)
+		return _read();
+	if(_pos < _len)
+		return _payload[_pos++];
+	return '\0';
+}
+
+float LinkLib::_readAsciiFloat(){
+	char bytes[9], sign;
+	float fex;
+
+	bytes[8] = '\0';
+	if(!_pipelined)
+		Serial.println("float");
+	sign = _read();//Float with eight representation bytes (including dot and sign)
+	for(int nbytes=0;nbytes<8;nbytes++)
+		bytes[nbytes] = _read();
+	fex = strtod(bytes, NULL);
+	if(sign=='-')
+		fex = 0.0 - fex;
+	if(!_pipelined)
+		Serial.println("_OK_");
+	return fex;
+}
+
+void LinkLib::done(const char* tag){
+	if(_binary){
+		_sendFrame('D', tag, strlen(tag));
+	}else{
+		Serial.print("done_");
+		Serial.println(tag);
+	}
+}
+
+void LinkLib::horizontal(float x, float y){
+	if(_binary){
+		_sendPair('h', &x, &y);
+	}else{
+		Serial.print("h_");Serial.print(x, 6); Serial.print(' '); Serial.print(y, 6);Serial.println();
+	}
+}
+
+void LinkLib::equatorial(float ar, float dec){
+	if(_binary){
+		_sendPair('e', &ar, &dec);
+	}else{
+		Serial.print("e_");Serial.print(ar, 6); Serial.print(' '); Serial.print(dec, 6);Serial.println();
+	}
+}
+
+void LinkLib::steps(long px, long py){
+	int32_t x = px, y = py;
+
+	if(_binary){
+		_sendPair('p', &x, &y);
+	}else{
+		Serial.print("p_");Serial.print(px, DEC); Serial.print(' '); Serial.print(py, DEC);Serial.println();
+	}
+}
+
+void LinkLib::heartbeat(){
+	if(_binary)
+		_sendFrame('k', 0, 0);
+	else
+		Serial.println("k");
+}
+
+void LinkLib::error(){
+	if(_binary)
+		_sendFrame('E', 0, 0);
+	else
+		Serial.println("ERROR");
+}
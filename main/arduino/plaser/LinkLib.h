@@ -0,0 +1,219 @@
+#ifndef LinkLib_h
+#define LinkLib_h
+
+	#include <stdint.h>
+	#include <string.h>
+
+	/**
+	 * First byte of every frame of the binary protocol
+	 */
+	#define FRAME_START 0x7E
+
+	/**
+	 * Maximum payload of a frame (5 floats)
+	 */
+	#define FRAME_MAX_PAYLOAD 20
+
+	/**
+	 * Initial speed of the serial port
+	 */
+	#define DEFAULT_BAUD 9600
+
+	/**
+	 * Milliseconds to receive the test pattern after a speed change
+	 */
+	#define BAUD_TIMEOUT 500
+
+	/**
+	 * Size of the test pattern
+	 */
+	#define BAUD_PATTERN_SIZE 8
+
+	/**
+	 * \brief Library for the communications with the computer through the serial port
+	 *
+	 * Supports three protocols:
+	 *
+	 * - ASCII (default at startup): commands of 4 characters, float parameters requested with the 'float' prompt
+	 *   (9 characters each, acknowledged with '_OK_'), and responses in text lines.
+	 * - Pipelined ASCII (negotiated by the computer with the 'pipe' command): the same as ASCII, but without the
+	 *   'cmd' and 'float' prompts and the '_OK_' acks, so the command and its parameters are sent in a single write,
+	 *   and the next command can wait in the serial buffer while the previous one is running.
+	 * - Binary (negotiated by the computer with the 'binm' command): every message is a frame
+	 *
+	 *     FRAME_START, code, length, payload (length bytes), CRC-8 (polynomial 0x07, over code, length and payload)
+	 *
+	 *   Parameters and positions are little endian float32, steps are little endian int32 (also the parameters of
+	 *   'step'). The commands are coded with one character (see _commands), and the responses are:
+	 *   'D' (tag) done, 'h' (x, y) horizontal position, 'e' (ar, dec) equatorial position, 'p' (px, py) steps,
+	 *   'k' () heartbeat and 'E' () error.
+	 *
+	 * The speed of the port is changed with the 'baud' command (see changeBaud()).
+	 */
+	class LinkLib{
+		private:
+			/**
+			 * Binary protocol enabled
+			 */
+			bool _binary;
+
+			/**
+			 * Prompts and acks disabled (pipelined ASCII)
+			 */
+			bool _pipelined;
+
+			/**
+			 * Current speed of the serial port
+			 */
+			long _baud;
+
+			/**
+			 * Payload of the last received frame, and read position of the parameters
+			 */
+			uint8_t _payload[FRAME_MAX_PAYLOAD];
+			uint8_t _len, _pos;
+
+			/**
+			 * Reads a byte from the serial port, waiting for it
+			 */
+			uint8_t _read();
+
+			/**
+			 * Updates a CRC-8 value with a byte
+			 */
+			uint8_t _crc8(uint8_t crc, uint8_t data);
+
+			/**
+			 * Sends a frame of the binary protocol
+			 *
+			 * \param code Response code
+			 * \param payload Payload bytes
+			 * \param len Payload length
+			 */
+			void _sendFrame(char code, const void* payload, uint8_t len);
+
+			/**
+			 * Sends a pair of 32 bits values (float or int32) in a frame
+			 */
+			void _sendPair(char code, const void* a, const void* b);
+
+			/**
+			 * Reads the next command in ASCII protocol
+			 */
+			void _readAsciiCommand(char* comm);
+
+			/**
+			 * Reads the next command frame in binary protocol
+			 */
+			void _readFrameCommand(char* comm);
+
+			/**
+			 * Get a float value from the serial port (ASCII protocol), and send the '_OK_' ack string.
+			 * The value must conains six decimals, in a string with 9 bytes, including sign and decimal dot.
+			 * Examples: '-0.036526', '+5.238388'
+			 */
+			float _readAsciiFloat();
+
+		public:
+			/**
+			 * Class constructor
+			 */
+			LinkLib();
+
+			/**
+			 * Enables or disables the binary protocol
+			 */
+			void setBinary(bool binary);
+
+			/**
+			 * Returns true if the binary protocol is enabled
+			 */
+			bool isBinary();
+
+			/**
+			 * Enables or disables the prompts and acks of the ASCII protocol
+			 */
+			void setPipelined(bool pipelined);
+
+			/**
+			 * Opens the serial port at the default speed
+			 */
+			void begin();
+
+			/**
+			 * Returns true if the given speed is supported (115200, 230400 or 500000)
+			 */
+			bool isSupportedBaud(long baud);
+
+			/**
+			 * Changes the speed of the serial port, and verifies the link: the computer must send the test pattern
+			 * at the new speed within BAUD_TIMEOUT ms, then it is sent back. Otherwise the previous speed is restored.
+			 * The 'done_baud' response must be sent before calling it
+			 *
+			 * \param baud New speed
+			 * \return True if the speed has been changed
+			 */
+			bool changeBaud(long baud);
+
+			/**
+			 * Waits for the next command. The abort byte is ignored, and a binary frame with a wrong CRC or
+			 * an unknown code is returned as the "????" command
+			 *
+			 * \param comm Buffer of 5 bytes for the command name (4 characters)
+			 */
+			void readCommand(char* comm);
+
+			/**
+			 * Gets the next float parameter of the current command
+			 *
+			 * \return float.
+			 */
+			float getFloat();
+
+			/**
+			 * Gets the next integer parameter of the current command: int32 in the binary protocol, and a float
+			 * parameter without decimals in ASCII (for example '+00001234')
+			 *
+			 * \return long.
+			 */
+			long getLong();
+
+			/**
+			 * Gets the next character parameter of the current command
+			 *
+			 * \return char.
+			 */
+			char getChar();
+
+			/**
+			 * Sends the end of a command ("done_<tag>")
+			 */
+			void done(const char* tag);
+
+			/**
+			 * Sends the horizontal position ("h_x y")
+			 */
+			void horizontal(float x, float y);
+
+			/**
+			 * Sends the equatorial position ("e_ar dec")
+			 */
+			void equatorial(float ar, float dec);
+
+			/**
+			 * Sends the steps of each axis ("p_px py")
+			 */
+			void steps(long px, long py);
+
+			/**
+			 * Sends the heartbeat ("k")
+			 */
+			void heartbeat();
+
+			/**
+			 * Sends an error ("ERROR")
+			 */
+			void error();
+	};
+
+#endif
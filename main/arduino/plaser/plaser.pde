@@ -3,6 +3,7 @@
 #include <math.h>
 #include "CoordsLib.h"
 #include "AxesLib.h"
+#include "LinkLib.h"
 
 
 /**
@@ -68,11 +69,16 @@ CoordsLib Coords = CoordsLib();
  */
 AxesLib	Axes = AxesLib();
 
+/**
+ * Library for the communications with the computer (ASCII and binary protocols)
+ */
+LinkLib Link = LinkLib();
+
 /**
  * Initializes the serial port and sets pins to control the device
  */
 void setup(){
-	Serial.begin(9600);
+	Link.begin();
 	Serial.println("init");
 	
 	pinMode(laserPin, OUTPUT);
@@ -80,6 +86,7 @@ void setup(){
 	
 	Axes.setMotorsPins(stepperPin1, stepperPin2, steppersDir, enableStepper1, enableStepper2);
 	Axes.setSensorsPins(sensor0H, sensor360H, sensorBottomV, sensorTopV);
+	Axes.setLink(&Link);
 }
 
 /**
@@ -96,39 +103,6 @@ void laserOff(){
 	digitalWrite(laserPin, HIGH);
 }
 
-/*
- * Get a float value from the serial port, and send the '_OK_' ack string.
- * The value must conains six decimals, in a string with 9 bytes, including sign and decimal dot.
- * Examples: '-0.036526', '+5.238388'
- *
- * \return float.
- */
-float serialGetFloat(){
-	char bytes[9], sign;
-	int nbytes = 0;
-	float fex;
-	bool recv = false;
-	
-	bytes[8] = '\0';
-	Serial.println("float");
-	while(!recv){
-		if (Serial.available() > 0) {
-			sign = Serial.read();//Float with eight representation bytes (including dot and sign)
-			while(nbytes < 8)
-				if(Serial.available() > 0){
-					bytes[nbytes] = Serial.read();
-					nbytes++;
-				}
-			fex = strtod(bytes, NULL);
-			if(sign=='-')
-				fex = 0.0 - fex;
-			recv = true;
-		}
-	}
-	Serial.println("_OK_");
-	return fex;
-}
-
 /**
  * Main loop..
  *
@@ -143,120 +117,141 @@ float serialGetFloat(){
  *-	'set3' (float ar, float dec, float t, float ac, float alt) -> ()	Sets the third reference object (usually not used..)
  *-	'goto' (float ar, float dec, float t) -> (float ar, float dec)(float ac, float alt)		Points the device towards the received equatorial coordinates
  *-	'move' () -> (float px, float py)(float ar, float dec)(float ac, float alt)		Points the device towards the received horizontal coordinates
+ *-	'step' (long px, long py) -> (long px, long py)(float ac, float alt)		Points the device towards the received position in steps (calculated by the computer)
  *-	'movx' (char dir) -> (float ar, float dec)(float ac, float alt)		Starts the accelerated horizontal movement towards the indicated direction
  *-	'movy' (char dir)	Starts the accelerated vertical movement towards the indicated direction
  *-	'stop' () -> ()		Stops the movements initiated by movx or movy commands
  *-	'laon' () -> ()		Turn the laser On
  *-	'loff' () -> ()		Turn the laser Off
+ *-	'ping' () -> ()		Does nothing, used by the host to check that the device is alive and synchronized
+ *-	'binm' () -> ()		Switches to the binary protocol (see LinkLib), after sending 'done_binm'
+ *-	'pipe' () -> ()		Switches to the pipelined ASCII protocol, without prompts nor acks (see LinkLib)
+ *-	'baud' (float baud) -> ()		Changes the speed of the serial port (in units of 100000 baud), after sending 'done_baud' (see LinkLib::changeBaud)
+ *
+ * During the movements the line "k" is sent every HEARTBEAT_MS milliseconds.
+ * The abort byte ('!') ends the running goto, move, step, movx or movy at the current position. It must not be
+ * sent while a float parameter is expected. A command sent during a movement must follow the abort byte: it is
+ * read once the movement ends (movx and movy would read it as a 'stop').
+ * The coordinates reported after a movement are the ones of the position of the axes (where an aborted movement
+ * has stopped).
  */
 void loop(){
 	float t0;
 	float ar, dec, t;
 	float ac, alt;
+	long px, py;
 	char comm[5];
 	char dir;
-	int bytes_recv = 0;
 	bool mov_end;
+	long baud;
 
-	comm[4]='\0';
-	Serial.println("cmd");
-	while(bytes_recv < 4){
-		//Waiting for a command...
-		if (Serial.available() > 0)
-			comm[bytes_recv++] = Serial.read();
-	}
+	Link.readCommand(comm);
 	
 	//Obtaining the expected parameters of the command
 	if(strcmp(comm, "set1")==0 || strcmp(comm, "set2")==0 || strcmp(comm, "set3")==0 || strcmp(comm, "goto")==0){
-		ar = serialGetFloat();
-		dec = serialGetFloat();
-		t = serialGetFloat();
+		ar = Link.getFloat();
+		dec = Link.getFloat();
+		t = Link.getFloat();
 	}
 	if(strcmp(comm, "move")==0){
-		ac = serialGetFloat();
-		alt = serialGetFloat();
-		t = serialGetFloat();
+		ac = Link.getFloat();
+		alt = Link.getFloat();
+		t = Link.getFloat();
+	}
+	if(strcmp(comm, "step")==0){
+		px = Link.getLong();
+		py = Link.getLong();
 	}
 	
 	//Executing command
 		
 	if(strcmp(comm, "time")==0){
-		t0 = serialGetFloat();
+		t0 = Link.getFloat();
 		Coords.setTime(t0);
-		Serial.println();
-		Serial.println("done_time");
+		Link.done("time");
 	}else if(strcmp(comm, "set1")==0){	
 		Coords.setRef_1(ar, dec, t, Axes.getX(), Axes.getY());
-		Serial.println();
-		Serial.println("done_set1");
+		Link.done("set1");
 	}else if(strcmp(comm, "set2")==0){		
 		Coords.setRef_2(ar, dec, t, Axes.getX(), Axes.getY());
-		Serial.println();
-		Serial.println("done_set2");
+		Link.done("set2");
 	}else if(strcmp(comm, "set3")==0){		
 		Coords.setRef_3(ar, dec, t, Axes.getX(), Axes.getY());
-		Serial.println();
-		Serial.println("done_set3");
+		Link.done("set3");
 	}else if(strcmp(comm, "goto")==0){
 		Coords.getHCoords(ar, dec, t, &ac, &alt);
 		Axes.goToRads(ac, alt);
-		Serial.print("h_");Serial.print(Axes.getX(), 6); Serial.print(' '); Serial.print(Axes.getY(), 6);Serial.println();
+		Link.horizontal(Axes.getX(), Axes.getY());
 		if(Coords.isConfigured()==true){
-			Coords.getECoords(ac, alt, t, &ar, &dec);
-			Serial.print("e_");Serial.print(ar, 6); Serial.print(' '); Serial.print(dec, 6);Serial.println();
+			Coords.getECoords(Axes.getX(), Axes.getY(), t, &ar, &dec);
+			Link.equatorial(ar, dec);
         }
-		Serial.println("done_goto");
+		Link.done("goto");
 	}else if(strcmp(comm, "move")==0){
 		Axes.goToRads(ac, alt);
-		Serial.print("p_");Serial.print(Axes.getPx(), DEC); Serial.print(' '); Serial.print(Axes.getPy(), DEC);Serial.println();
-		Serial.print("h_");Serial.print(Axes.getX(), 6); Serial.print(' '); Serial.print(Axes.getY(), 6);Serial.println();
+		Link.steps(Axes.getPx(), Axes.getPy());
+		Link.horizontal(Axes.getX(), Axes.getY());
 		if(Coords.isConfigured()==true){
-			Coords.getECoords(ac, alt, t, &ar, &dec);
-			Serial.print("e_");Serial.print(ar, 6); Serial.print(' '); Serial.print(dec, 6);Serial.println();
+			Coords.getECoords(Axes.getX(), Axes.getY(), t, &ar, &dec);
+			Link.equatorial(ar, dec);
         }
-		Serial.println("done_move");
+		Link.done("move");
+	}else if(strcmp(comm, "step")==0){
+		Axes.goToSteps(px, py);
+		Link.steps(Axes.getPx(), Axes.getPy());
+		Link.horizontal(Axes.getX(), Axes.getY());
+		Link.done("step");
 	}else if(strcmp(comm, "movx")==0){
-		while(Serial.available()<=0){}
-		dir = Serial.read();
+		dir = Link.getChar();
 		mov_end = Axes.movx((dir == '1'));
-		Serial.print("h_");Serial.print(Axes.getX(), 6); Serial.print(' '); Serial.print(Axes.getY(), 6);Serial.println();
+		Link.horizontal(Axes.getX(), Axes.getY());
 		if(Coords.isConfigured()==true){
 			Coords.getECoords(Axes.getX(), Axes.getY(), t, &ar, &dec);
-			Serial.print("e_");Serial.print(ar, 6); Serial.print(' '); Serial.print(dec, 6);Serial.println();
+			Link.equatorial(ar, dec);
         }
 		if(mov_end==false)
-			Serial.println("done_movx");
+			Link.done("movx");
 		else
-			Serial.println("done_end");
+			Link.done("end");
 	}else if(strcmp(comm, "movy")==0){
-		while(Serial.available()<=0){}
-		dir = Serial.read();
+		dir = Link.getChar();
 		mov_end = Axes.movy((dir == '1'));
-		Serial.print("h_");Serial.print(Axes.getX(), 6); Serial.print(' '); Serial.print(Axes.getY(), 6);Serial.println();
+		Link.horizontal(Axes.getX(), Axes.getY());
 		if(Coords.isConfigured()==true){
 			Coords.getECoords(Axes.getX(), Axes.getY(), t, &ar, &dec);
-			Serial.print("e_");Serial.print(ar, 6); Serial.print(' '); Serial.print(dec, 6);Serial.println();
+			Link.equatorial(ar, dec);
         }
 		if(mov_end==false)
-			Serial.println("done_movy");
+			Link.done("movy");
 		else
-			Serial.println("done_end");
+			Link.done("end");
 	}else if(strcmp(comm, "init")==0){
 		Axes.init();
-		Serial.println();
-		Serial.print("p_");Serial.print(Axes.getPX(), DEC); Serial.print(' '); Serial.print(Axes.getPY(), DEC);Serial.println();
-		Serial.println("done_init");
+		Link.steps(Axes.getPX(), Axes.getPY());
+		Link.done("init");
 	}else if(strcmp(comm, "laon")==0){
 		laserOn();
-		Serial.println();
-		Serial.println("done_laserOn");
+		Link.done("laserOn");
 	}else if(strcmp(comm, "loff")==0){
 		laserOff();
-		Serial.println();
-		Serial.println("done_laserOff");
+		Link.done("laserOff");
 	}else if(strcmp(comm, "stop")==0){
-		Serial.println("done_stop");
+		Link.done("stop");
+	}else if(strcmp(comm, "ping")==0){
+		Link.done("ping");
+	}else if(strcmp(comm, "binm")==0 && !Link.isBinary()){
+		Link.done("binm");
+		Link.setBinary(true);
+	}else if(strcmp(comm, "baud")==0){
+		baud = (long)(Link.getFloat() * 100000.0 + 0.5);
+		if(Link.isSupportedBaud(baud)){
+			Link.done("baud");
+			Link.changeBaud(baud);
+		}else
+			Link.error();
+	}else if(strcmp(comm, "pipe")==0 && !Link.isBinary()){
+		Link.done("pipe");
+		Link.setPipelined(true);
 	}else	
-		Serial.println("ERROR");
+		Link.error();
 }
-
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import deque
+from threading import Thread, Condition
+
+## \brief Auxiliary Class to execute functions sequentially in a separate thread, coalescing the pending ones.
+#
+#  Jobs are executed one by one in submission order (a job returning a future is finished when the future
+#  is resolved). A job submitted with a key replaces the pending job with the same key (if any), so while a
+#  long job is running only the newest request of each kind is kept.
+#
+#  An example of use would be as follows:
+#
+#    dispatcher = CoalescingDispatcher()
+#    dispatcher.start()
+#    dispatcher.submit(device.goto, ra, dec, t, key='goto')
+#
+class CoalescingDispatcher(Thread):
+
+    ## Class constructor.
+    #
+    # \param name Thread name
+    def __init__(self, name='CoalescingDispatcher'):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self._jobs = deque()
+        self._cond = Condition()
+        self._finished = False
+        ## @var executed
+        # Number of executed jobs
+        self.executed = 0
+        ## @var superseded
+        # Number of jobs replaced by a newer one before being executed
+        self.superseded = 0
+
+    ## Adds a job to the queue
+    #
+    # \param function Function or callable object to execute
+    # \param args Function arguments
+    # \param key (optional) Coalescing key. A pending job with the same key is replaced
+    # \return True if a pending job has been replaced
+    def submit(self, function, *args, **kwargs):
+        key = kwargs.pop('key', None)
+        job = (key, function, args, kwargs)
+        replaced = False
+        with self._cond:
+            if key is not None:
+                for i in range(len(self._jobs)):
+                    if self._jobs[i][0] == key:
+                        # The newest request runs next, in the place of the one it replaces
+                        self._jobs[i] = job
+                        self.superseded += 1
+                        replaced = True
+                        logging.debug("'%s' superseded (%d in total)" % (key, self.superseded))
+                        break
+            if not replaced:
+                self._jobs.append(job)
+            self._cond.notify()
+        return replaced
+
+    ## Number of pending jobs
+    #
+    # \return Integer
+    def pending(self):
+        with self._cond:
+            return len(self._jobs)
+
+    ## Discards the pending jobs
+    #
+    # \param key (optional) Discards only the jobs with this key
+    def clear(self, key=None):
+        with self._cond:
+            if key is None:
+                self._jobs.clear()
+            else:
+                self._jobs = deque(job for job in self._jobs if job[0] != key)
+
+    ## Starts thread
+    #
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._finished:
+                    self._cond.wait()
+                if self._finished:
+                    return
+                (key, function, args, kwargs) = self._jobs.popleft()
+            try:
+                result = function(*args, **kwargs)
+                # Asynchronous jobs (returning a future) are completed before the next one starts
+                if hasattr(result, 'add_done_callback'):
+                    result.result()
+            except Exception as e:
+                logging.error("Error executing '%s': %s" % (getattr(function, '__name__', function), e))
+            self.executed += 1
+
+    ## Cancel execution
+    #
+    def cancel(self):
+        with self._cond:
+            self._finished = True
+            self._cond.notify()
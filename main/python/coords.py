@@ -4,14 +4,31 @@
 import math
 import re
 import logging
+import functools
 from time import time, ctime, strftime, localtime
 
+# NumPy is only needed by the batch functions (*_array)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # \brief Functions library for format conversions.
 #
 #  Contains the necessary functions to calculate most commons format conversions used by the communications
 #  with the device and Stellarium.
 
 
+## Size of the caches of the parsers and formatters. While tracking, the same values are converted again and again
+CACHE_SIZE = 1024
+
+# Grammars of the strings, compiled once. The groups are the numeric components (an empty one is 0)
+_RAD = re.compile(r'^(-?)[0-9]{1}\.[0-9]{4,8}')
+_DEG_DMS = re.compile(r'^(-?)([0-9]{,3})(?:º|ᵒ)([0-9]{,3})\'([0-9]{,3})(?:[\']{2}|")$')
+_DEG_DECIMAL = re.compile(r'^(-?[0-9]{,3}\.[0-9]{,6})(?:º|ᵒ)$')
+_HOUR_HMS = re.compile(r'^([0-9]{,3})h([0-9]{,3})m([0-9]{,3})s$')
+
+
 ## From radians to hours, with until six decimals of precision (float)
 # (rads * 180)/(15 * pi)
 #
@@ -30,10 +47,9 @@ def rad_2_hour(rads):
 #
 # \param rad Signed radians in string format
 # \return Degrees in float format
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def radStr_2_deg(rad):
-    exp = re.compile('^(-?)[0-9]{1}\.[0-9]{4,8}')
-    
-    if(not exp.match(rad)):
+    if(not _RAD.match(rad)):
         return None
     
     r = float(rad)
@@ -62,27 +78,20 @@ def radStr_2_degStr(r):
 #
 # \param d Degrees in string format ("DºM'S''" || "D.dº")
 # \return Radians in float format
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def degStr_2_rad(d):
-    exp1 = re.compile('^-?[0-9]{,3}(º|ᵒ)[0-9]{,3}\'[0-9]{,3}([\']{2}|")$')
-    exp2 = re.compile('^-?[0-9]{,3}\.[0-9]{,6}(º|ᵒ)$')
-
-    if(not exp1.match(d) and not exp2.match(d)):
-        logging.debug("Error parametro: %s" % d)
-        return None
-    elif(exp1.match(d)):
-        d = d.replace('º','.').replace("''",'.').replace("'",'.')
-        d_dic = d.split('.')
-        d_deg = float(d_dic[0])
-        d_min = float(d_dic[1])
-        d_sec = float(d_dic[2])
-        
-        if(d_deg < 0):
-            d_min = 0 - d_min;
-            d_sec = 0 - d_sec;
-    
-        d_ndeg = (d_deg+(d_min/60)+(d_sec/(60**2)))
+    m = _DEG_DMS.match(d)
+    if(m):
+        (sign, d_deg, d_min, d_sec) = m.groups()
+        d_ndeg = (int(d_deg or 0)+(int(d_min or 0)/60)+(int(d_sec or 0)/3600))
+        if(sign):
+            d_ndeg = -d_ndeg
     else:
-        d_ndeg = float(d.replace('º',''))
+        m = _DEG_DECIMAL.match(d)
+        if(not m):
+            logging.debug("Error parametro: %s" % d)
+            return None
+        d_ndeg = float(m.group(1))
         if(d_ndeg < 0): d_ndeg = 360 - abs(d_ndeg);
 
     return round((d_ndeg * math.pi) / 180, 6)
@@ -98,6 +107,7 @@ def degStr_2_radStr(d):
 #
 # \param deg Degrees in float format
 # \return Degrees in string format ("DºM'S''")
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def deg_2_degStr(deg):
     ndeg = math.floor(float(deg))
     
@@ -113,20 +123,15 @@ def deg_2_degStr(deg):
 #
 # \param h Hours in string format ("HhMmSSs")
 # \return Radians in float format
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def hourStr_2_rad(h):
-    exp = re.compile('^[0-9]{,3}h[0-9]{,3}m[0-9]{,3}s$')
-    if(not exp.match(h)):
+    m = _HOUR_HMS.match(h)
+    if(not m):
         logging.debug("Error in param: %s" % h)
         return None
-    
-    h = h.replace('h','.').replace("m",'.').replace("s",'.')
-    h_dic = h.split('.')
-
-    h_h = float(h_dic[0])
-    h_m = float(h_dic[1])
-    h_s = float(h_dic[2])
 
-    nh = (h_h+(h_m/60)+(h_s/(60**2)))
+    (h_h, h_m, h_s) = m.groups()
+    nh = (int(h_h or 0)+(int(h_m or 0)/60)+(int(h_s or 0)/3600))
 
     return round((nh * 15 * math.pi) / 180, 6)
     
@@ -134,6 +139,7 @@ def hourStr_2_rad(h):
 #
 # \param hours Hours in float format
 # \return Hours in string format ("HhMmSSs")
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def hour_2_hourStr(hours):
     (h, m, s) = hour_min_sec(hours)
     return '%dh%dm%00.1fs' % (h, m, s)
@@ -242,4 +248,326 @@ def rad_2_stellarium_protocol(ra, dec):
     logging.debug("(hours, degrees): (%f, %f)" % (ra_h, dec_d))
     
     return (int(ra_h*(2147483648/12.0)), int(dec_d*(1073741824/90.0)))
-    
+
+## Radians per unit of the "Stellarium Telescope Protocol" (2^31 = 12h = 180º, for both coordinates)
+STELLARIUM_UNIT = math.pi / 2147483648
+
+## From a value of the "Stellarium Telescope Protocol" to radians
+#
+#  Exactly reversible: rad_2_stellarium returns the same value
+#
+# \param value Right ascension (uint32, 2^32 = 24h) or declination (int32, 2^30 = 90º)
+# \return Radians in float format
+def stellarium_2_rad(value):
+    return value * STELLARIUM_UNIT
+
+## Transforms coordinates from radians to the "Stellarium Telescope Protocol" format, rounded to the nearest unit
+#
+#  Without the rounding to microseconds of rad_2_stellarium_protocol, so the values obtained with
+#  stellarium_2_rad are converted back without any change.
+#
+# \param ra Right ascension in radians (any turn)
+# \param dec Declination in radians
+# \return List with (Right ascension (uint32), Declination (int32, in [-90º, 90º]))
+def rad_2_stellarium(ra, dec):
+    dec_p = int(round(dec / STELLARIUM_UNIT))
+    return (int(round(ra / STELLARIUM_UNIT)) & 0xffffffff, max(-1073741824, min(1073741824, dec_p)))
+
+
+
+# Angle values.
+#
+#  Coordinates passed between the server, the application and the device. They are floats with the value in
+#  radians, so they are used in the calculations and sent to the device as they are, without any rounding,
+#  and their string forms are only built when they are shown.
+
+
+## \brief Angle in radians
+#
+#  Immutable and without instance dictionary (a float with a type). The string form is built on demand.
+class Angle(float):
+    __slots__ = ()
+
+    ## Builds an angle from a number of radians or from its string form
+    #
+    # \param value Angle, float (radians) or string (see from_str)
+    # \return Instance of the class
+    @classmethod
+    def of(cls, value):
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls.from_str(value)
+        return cls(value)
+
+    ## Builds an angle from a string of signed radians (see rad_2_radStr)
+    #
+    # \param s Radians in string format
+    # \return Instance of the class
+    @classmethod
+    def from_str(cls, s):
+        return cls(s)
+
+    ## Builds an angle from a value of the "Stellarium Telescope Protocol" (see stellarium_2_rad)
+    #
+    # \param value Right ascension (uint32) or declination (int32)
+    # \return Instance of the class
+    @classmethod
+    def from_stellarium(cls, value):
+        return cls(value * STELLARIUM_UNIT)
+
+    ## Radians (float)
+    @property
+    def rad(self):
+        return float(self)
+
+    ## Signed degrees (float)
+    @property
+    def degrees(self):
+        return (float(self) * 180) / math.pi
+
+    ## String form
+    @property
+    def text(self):
+        return rad_2_radStr(self)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, float(self))
+
+
+## \brief Angle measured in hours: right ascension, time of the day
+#
+#  String form "HhMmSs", in [0h, 24h)
+class Hours(Angle):
+    __slots__ = ()
+
+    ## Builds the angle from a string "HhMmSs"
+    #
+    # \param s Hours in string format
+    # \return Hours instance
+    @classmethod
+    def from_str(cls, s):
+        rad = hourStr_2_rad(s)
+        if rad is None:
+            raise ValueError("Invalid hours: %s" % s)
+        return cls(rad)
+
+    ## Builds the angle of the local time of the day
+    #
+    # \param seconds Unix timestamp (seconds, with decimals)
+    # \return Hours instance
+    @classmethod
+    def from_timestamp(cls, seconds):
+        whole = math.floor(seconds)
+        t = localtime(whole)
+        hours = t.tm_hour + t.tm_min/60.0 + (t.tm_sec + (seconds - whole))/3600.0
+        return cls((hours * 15 * math.pi) / 180)
+
+    ## Angle of the current local time of the day
+    #
+    # \return Hours instance
+    @classmethod
+    def now(cls):
+        return cls.from_timestamp(time())
+
+    ## Hours (float)
+    @property
+    def hours(self):
+        return (float(self) * 180) / (15 * math.pi)
+
+    @property
+    def text(self):
+        return _hours_text(float(self))
+
+
+## \brief Angle measured in degrees: declination, horizontal coordinates
+#
+#  String form "DºM'S''", signed
+class Degrees(Angle):
+    __slots__ = ()
+
+    ## Builds the angle from a string "DºM'S''" or "D.dº"
+    #
+    # \param s Degrees in string format
+    # \return Degrees instance
+    @classmethod
+    def from_str(cls, s):
+        rad = degStr_2_rad(s)
+        if rad is None:
+            raise ValueError("Invalid degrees: %s" % s)
+        return cls(rad)
+
+    @property
+    def text(self):
+        return _degrees_text(float(self))
+
+
+## String form of Hours, rounded to seconds
+#
+# \param rad Radians
+# \return Hours in string format ("HhMmSs")
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _hours_text(rad):
+    secs = int(round((rad * 180)/(15 * math.pi) * 3600)) % 86400
+    return "%dh%02dm%02ds" % (secs // 3600, (secs // 60) % 60, secs % 60)
+
+## String form of Degrees, rounded to seconds
+#
+# \param rad Radians
+# \return Degrees in string format ("DºM'S''")
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _degrees_text(rad):
+    secs = int(round(abs(rad * 180 / math.pi) * 3600))
+    return "%s%dº%02d'%02d''" % ('-' if rad < 0 and secs else '', secs // 3600, (secs // 60) % 60, secs % 60)
+
+# Batch conversions.
+#
+#  Array in / array out versions of the numeric conversions above, for whole columns of coordinates (lists
+#  or NumPy arrays). The results are the same as the scalar functions, element by element, including the
+#  rounding. They need NumPy.
+
+
+## Checks that NumPy is available and converts the values to a float array
+#
+# \param values Sequence or array of numbers
+# \return NumPy array (float64)
+def _float_array(values):
+    if numpy is None:
+        raise ImportError("NumPy is needed by the batch conversions")
+    return numpy.asarray(values, dtype=numpy.float64)
+
+## round(value, digits) of Python for every element
+#
+#  Python rounds the exact decimal value of the float, so the few elements close to a rounding tie
+#  (where the scaled value of NumPy may be on the other side of the tie) are rounded one by one.
+#
+# \param values NumPy array (float64)
+# \param digits Number of decimals
+# \return NumPy array (float64)
+def _round_array(values, digits):
+    scale = 10.0**digits
+    scaled = values * scale
+    result = numpy.rint(scaled) / scale
+    ties = numpy.abs(numpy.abs(scaled - numpy.trunc(scaled)) - 0.5) < 1e-6
+    for i in numpy.flatnonzero(ties):
+        result.flat[i] = round(float(values.flat[i]), digits)
+    return result
+
+## From radians to hours (see rad_2_hour)
+#
+# \param rads Radians
+# \return Array of hours, in [0, 24]
+def rad_2_hour_array(rads):
+    h = _round_array((_float_array(rads) * 180)/(15 * math.pi), 6)
+    h = numpy.where(h > 24.0, h - 24.0, h)
+    return numpy.where(h < 0.0, 24.0 + h, h)
+
+## From hours to radians (see hourStr_2_rad)
+#
+# \param hours Hours
+# \return Array of radians
+def hour_2_rad_array(hours):
+    return _round_array((_float_array(hours) * 15 * math.pi) / 180, 6)
+
+## From degrees to radians (see degStr_2_rad, with "DºM'S''" values)
+#
+# \param degs Degrees
+# \return Array of radians
+def deg_2_rad_array(degs):
+    return _round_array((_float_array(degs) * math.pi) / 180, 6)
+
+## From radians to degrees, the negative values measured from 360º (see radStr_2_deg)
+#
+# \param rads Radians
+# \return Array of degrees
+def rad_2_deg_array(rads):
+    r = _float_array(rads)
+    r = numpy.where(r < 0, (2 * math.pi) - numpy.abs(r), r)
+    return (r * 180) / math.pi
+
+## From hours to hours, minutes and seconds (see hour_min_sec)
+#
+# \param hours Hours
+# \return List with (hours, minutes, seconds) arrays (int64, int64, float64)
+def hour_min_sec_array(hours):
+    hours = _float_array(hours)
+    h = numpy.floor(hours)
+    hours_m = (hours - h)*60.0
+    m = numpy.floor(hours_m)
+    s = (hours_m - m)*60.0
+
+    #Avoiding the X.60 values
+    carry = s >= 59.99
+    s = numpy.where(carry, 0.0, s)
+    m = numpy.where(carry, m + 1, m)
+    carry = m >= 60
+    m = numpy.where(carry, 60 - m, m)
+    h = numpy.where(carry, h + 1, h)
+
+    return (h.astype(numpy.int64), m.astype(numpy.int64), s)
+
+## From degrees to degrees, minutes and seconds (see grad_min_sec)
+#
+# \param degs Degrees
+# \return List with (degrees, minutes, seconds) arrays (int64, int64, float64)
+def grad_min_sec_array(degs):
+    degs = _float_array(degs)
+    to_neg = degs < 0
+    (d, m, s) = hour_min_sec_array(numpy.fabs(degs))
+    return (numpy.where(to_neg, -d, d), m, s)
+
+## From the "Stellarium Telescope Protocol" format to radians
+#
+# \param ra Right ascension (uint32, 2^32 = 24h)
+# \param dec Declination (int32, 2^30 = 90º)
+# \return List with (right ascension, declination) arrays of radians
+def stellarium_protocol_2_rad_array(ra, dec):
+    ra_h = _float_array(ra)*12.0/2147483648
+    dec_d = _float_array(dec)*90.0/1073741824
+    return ((ra_h * 15 * math.pi) / 180, (dec_d * math.pi) / 180)
+
+## From radians to the "Stellarium Telescope Protocol" format (see rad_2_stellarium_protocol)
+#
+# \param ra Right ascension in radians
+# \param dec Declination in radians
+# \return List with (right ascension, declination) arrays (int64)
+def rad_2_stellarium_protocol_array(ra, dec):
+    ra_h = rad_2_hour_array(ra)
+    dec_d = (_float_array(dec) * 180) / math.pi
+    return (numpy.trunc(ra_h*(2147483648/12.0)).astype(numpy.int64),
+            numpy.trunc(dec_d*(1073741824/90.0)).astype(numpy.int64))
+
+## From values of the "Stellarium Telescope Protocol" to radians (see stellarium_2_rad)
+#
+# \param values Right ascensions (uint32) or declinations (int32)
+# \return Array of radians
+def stellarium_2_rad_array(values):
+    return _float_array(values) * STELLARIUM_UNIT
+
+## From radians to the "Stellarium Telescope Protocol" format, rounded to the nearest unit (see rad_2_stellarium)
+#
+# \param ra Right ascensions in radians
+# \param dec Declinations in radians
+# \return List with (right ascension (uint32), declination (int32)) arrays
+def rad_2_stellarium_array(ra, dec):
+    ra_p = numpy.rint(_float_array(ra) / STELLARIUM_UNIT).astype(numpy.int64) & 0xffffffff
+    dec_p = numpy.clip(numpy.rint(_float_array(dec) / STELLARIUM_UNIT), -1073741824, 1073741824)
+    return (ra_p.astype(numpy.uint32), dec_p.astype(numpy.int32))
+
+## Values of the "Stellarium Telescope Protocol" to strings (see eCoords2str)
+#
+# \param ra Right ascension (uint32)
+# \param dec Declination (int32)
+# \param mtime Timestamps in microseconds
+# \return List of (Right ascension, declination, time) => [("HhMmSSs", "DºM'S''", "HhMmSs"), ...]
+def eCoords2str_array(ra, dec, mtime):
+    (h, hm, hs) = hour_min_sec_array(_float_array(ra)*12.0/2147483648)
+    (d, dm, ds) = grad_min_sec_array(_float_array(dec)*90.0/1073741824)
+    time_s = numpy.floor(_float_array(mtime) / 1000000).astype(numpy.int64).tolist()
+    times = dict((t, strftime("%Hh%Mm%Ss", localtime(t))) for t in set(time_s))
+    return [('%dh%dm%00.0fs' % hms, '%dº%d\'%00.0f\'\'' % dms, times[t])
+            for (hms, dms, t) in zip(zip(h.tolist(), hm.tolist(), hs.tolist()),
+                                     zip(d.tolist(), dm.tolist(), ds.tolist()), time_s)]
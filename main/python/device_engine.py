@@ -0,0 +1,915 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+import struct
+import logging
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from threading import Thread, RLock
+from time import time
+import coords
+
+# \brief Asynchronous I/O engine for the device.
+#
+#  A reader thread continuously parses the device output into typed events (Device_Event). Commands are
+#  queued and written to the port by the engine, and each one is completed (as a Future) when its 'done_*'
+#  terminator arrives. Telemetry lines (steps, horizontal and equatorial positions) are delivered as soon
+#  as they are read, whether a command is waiting or not.
+
+
+## Event kinds
+EV_PROMPT = 'prompt'            # 'cmd': the device waits for a command
+EV_FLOAT = 'float'              # 'float': the device waits for a float parameter
+EV_ACK = 'ack'                  # '_OK_': parameter received
+EV_DONE = 'done'                # 'done_*': command terminator, args = (tag, )
+EV_STEPS = 'steps'              # 'p_X Y': steps, args = (int, int)
+EV_HORIZONTAL = 'horizontal'    # 'h_X Y': horizontal position, args = (str, str) in radians
+EV_EQUATORIAL = 'equatorial'    # 'e_X Y': equatorial position, args = (str, str) in radians
+EV_ERROR = 'error'              # 'ERROR': unknown command
+EV_BOOT = 'boot'                # 'init': the device has been (re)started
+EV_HEARTBEAT = 'heartbeat'      # 'k': the device is alive (sent periodically while moving)
+EV_TEXT = 'text'                # Any other line
+EV_TIMEOUT = 'timeout'          # Generated by the engine: the device is not responding
+
+## Command priorities
+PRIORITY_NORMAL = 0     # Queued and written in submission order
+PRIORITY_URGENT = 1     # Written immediately, ahead of the queued work (stop, laser off..)
+
+## Byte that aborts the running movement (goto, move, movx, movy) in the device
+ABORT = b'!'
+
+## Parameter written to complete a pending 'float' prompt while resynchronizing
+FILLER = b'+0.000000'
+
+## First byte of every frame of the binary protocol (see LinkLib.h)
+FRAME_START = 0x7E
+
+## Maximum payload of a frame
+FRAME_MAX_PAYLOAD = 20
+
+## Codes of the commands in the binary protocol
+BINARY_COMMANDS = {'init': b'I', 'time': b'T', 'set1': b'1', 'set2': b'2', 'set3': b'3', 'goto': b'G',
+                   'move': b'M', 'movx': b'X', 'movy': b'Y', 'stop': b'S', 'laon': b'L', 'loff': b'l',
+                   'ping': b'P', 'baud': b'B', 'step': b's'}
+
+## Test pattern sent after a speed change of the serial port (see LinkLib::changeBaud)
+BAUD_PATTERN = b'\x55\xaa\x00\xff\x0f\xf0\x33\xcc'
+
+## Seconds the device waits for the test pattern before restoring the previous speed
+BAUD_TIMEOUT = 0.5
+
+## Unit of the parameter of the 'baud' command
+BAUD_UNIT = 100000.0
+
+## Command states
+ST_QUEUED = 0       # Waiting in the queue
+ST_HANDSHAKE = 1    # Written, waiting for the 'float' prompt to send the parameters
+ST_RUNNING = 2      # Completely written, waiting for the terminator
+
+
+## \brief Exception raised by the device commands
+#
+class DeviceError(Exception):
+    pass
+
+## \brief The device did not complete a command in time
+#
+class DeviceTimeout(DeviceError):
+    pass
+
+## \brief The serial link does not work at the requested speed
+#
+class DeviceLinkError(DeviceError):
+    pass
+
+## \brief The command has been aborted (stop): the movement ended before its target
+#
+class DeviceAborted(DeviceError):
+
+    ## Class constructor
+    #
+    # \param message Description
+    # \param line Terminator received from the device
+    def __init__(self, message, line=None):
+        DeviceError.__init__(self, message)
+        self.line = line
+
+
+## \brief Line (or frame) received from the device
+#
+class Device_Event(object):
+    __slots__ = ('kind', 'args', 'line', 'stamp')
+
+    ## Class constructor
+    #
+    # \param kind Event kind (EV_*)
+    # \param args Parsed values
+    # \param line Raw line
+    # \param stamp Reception time
+    def __init__(self, kind, args=(), line='', stamp=None):
+        self.kind = kind
+        self.args = args
+        self.line = line
+        self.stamp = stamp if stamp is not None else time()
+
+    def __repr__(self):
+        return "Device_Event(%s, %r)" % (self.kind, self.args)
+
+
+_FIXED_LINES = {'cmd': EV_PROMPT, 'float': EV_FLOAT, '_OK_': EV_ACK, 'ERROR': EV_ERROR, 'init': EV_BOOT,
+                'k': EV_HEARTBEAT}
+_TAGGED_LINES = {'h_': EV_HORIZONTAL, 'e_': EV_EQUATORIAL}
+
+## Parses a line of the ASCII protocol
+#
+# \param line Line without the end of line characters
+# \param stamp Reception time
+# \return Device_Event
+def parse_line(line, stamp=None):
+    kind = _FIXED_LINES.get(line)
+    if kind is not None:
+        return Device_Event(kind, (), line, stamp)
+    if line.startswith('done_'):
+        return Device_Event(EV_DONE, (line, ), line, stamp)
+    tag = line[:2]
+    if tag in _TAGGED_LINES:
+        values = line[2:].split(' ')
+        if len(values) == 2:
+            return Device_Event(_TAGGED_LINES[tag], (values[0], values[1]), line, stamp)
+    elif tag == 'p_':
+        values = line[2:].split(' ')
+        try:
+            return Device_Event(EV_STEPS, (int(values[0]), int(values[1])), line, stamp)
+        except (ValueError, IndexError):
+            pass
+    return Device_Event(EV_TEXT, (), line, stamp)
+
+
+## \brief Transport for the ASCII protocol of plaser.pde
+#
+#  Commands are 4 characters, float parameters are sent after the 'float' prompt as 9 characters
+#  ('+0.123456'), and the responses are text lines.
+class Ascii_Transport(object):
+
+    ## Class constructor
+    #
+    # \param port Serial port (pyserial Serial instance, or any object with readline/write/close)
+    # \param param_prompt The device asks for the parameters ('float' prompt) before they are sent. False once
+    #                     the pipelined mode ('pipe') is enabled in the device: the parameters go along with the
+    #                     command, and only the terminator is received
+    def __init__(self, port, param_prompt=True):
+        self.port = port
+        ## @var param_prompt
+        # The device asks for the parameters before they are sent
+        self.param_prompt = param_prompt
+        ## @var tx_bytes
+        # Bytes written to the port
+        self.tx_bytes = 0
+        ## @var rx_bytes
+        # Bytes read from the port
+        self.rx_bytes = 0
+
+    ## Reads the next event
+    #
+    # \return Device_Event, or None if nothing has been received within the port timeout
+    def read_event(self):
+        raw = self.port.readline()
+        if not raw:
+            return None
+        self.rx_bytes += len(raw)
+        return parse_line(raw.decode('ascii', 'replace').rstrip(), time())
+
+    ## Writes a command
+    #
+    # \param name Command name (4 characters)
+    # \param extra Bytes sent just after the command (for example the direction of movx)
+    # \param params Float or integer parameters (see write_params), written along with the command
+    def write_command(self, name, extra=b'', params=()):
+        data = name.encode('ascii') + extra
+        if params:
+            data += self._encode_params(params)
+        self.write(data)
+
+    ## Writes the parameters of a command
+    #
+    # \param params List of floats (radians), or integers (steps, sent without decimals: '+00001234')
+    def write_params(self, params):
+        self.write(self._encode_params(params))
+
+    def _encode_params(self, params):
+        return ''.join('%+09d' % p if isinstance(p, int) else coords.rad_2_radStr(p) for p in params).encode('ascii')
+
+    ## Writes raw bytes
+    #
+    def write(self, data):
+        self.port.write(data)
+        self.tx_bytes += len(data)
+
+    ## Closes the port
+    #
+    def close(self):
+        self.port.close()
+
+
+## Table for the CRC-8 of the frames (polynomial 0x07)
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table.append(crc)
+    return bytes(table)
+
+_CRC8 = _crc8_table()
+
+## CRC-8 (polynomial 0x07, initial value 0)
+#
+# \param data Bytes
+# \return Integer
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = _CRC8[crc ^ b]
+    return crc
+
+## Builds a frame of the binary protocol
+#
+# \param code Code (1 byte)
+# \param payload Bytes
+# \return bytes
+def encode_frame(code, payload=b''):
+    body = code + bytes((len(payload), )) + payload
+    return bytes((FRAME_START, )) + body + bytes((crc8(body), ))
+
+_PAIR_FLOAT = struct.Struct('<ff')
+_PAIR_INT = struct.Struct('<ii')
+
+
+## \brief Transport for the binary protocol of plaser.pde (LinkLib)
+#
+#  Every message is a frame: FRAME_START, code, length, payload, CRC-8. A command and its parameters (float32)
+#  go in a single frame, without prompts, and the responses are decoded into the same events as the ASCII
+#  lines, so the engine handles both protocols alike. Bytes out of frames are read as text lines (the boot
+#  banner of a restarted device).
+class Binary_Transport(object):
+    ## @var param_prompt
+    # The parameters are sent along with the command
+    param_prompt = False
+
+    ## Class constructor
+    #
+    # \param port Serial port (pyserial Serial instance)
+    def __init__(self, port):
+        self.port = port
+        self._buf = bytearray()
+        ## @var tx_bytes
+        # Bytes written to the port
+        self.tx_bytes = 0
+        ## @var rx_bytes
+        # Bytes read from the port
+        self.rx_bytes = 0
+        ## @var crc_errors
+        # Number of discarded frames
+        self.crc_errors = 0
+
+    ## Reads the next event
+    #
+    # \return Device_Event, or None if nothing has been received within the port timeout
+    def read_event(self):
+        while True:
+            event = self._parse()
+            if event is not None:
+                return event
+            data = self.port.read(1)
+            if not data:
+                return None
+            waiting = self.port.in_waiting
+            if waiting:
+                data += self.port.read(waiting)
+            self.rx_bytes += len(data)
+            self._buf += data
+
+    ## Extracts the next event from the received bytes
+    #
+    # \return Device_Event, or None if more bytes are needed
+    def _parse(self):
+        buf = self._buf
+        while buf:
+            if buf[0] != FRAME_START:
+                start = buf.find(FRAME_START)
+                end = buf.find(b'\n')
+                if end != -1 and (start == -1 or end < start):
+                    line = bytes(buf[:end])
+                    del buf[:end + 1]
+                    return parse_line(line.decode('ascii', 'replace').strip(), time())
+                if start == -1:
+                    return None
+                del buf[:start]
+            if len(buf) < 3:
+                return None
+            size = buf[2]
+            if size > FRAME_MAX_PAYLOAD:
+                self.crc_errors += 1
+                del buf[:1]
+                continue
+            if len(buf) < size + 4:
+                return None
+            if crc8(buf[1:size + 3]) != buf[size + 3]:
+                self.crc_errors += 1
+                del buf[:1]
+                continue
+            code = buf[1]
+            payload = bytes(buf[3:size + 3])
+            del buf[:size + 4]
+            return self._decode(code, payload)
+        return None
+
+    ## Decodes a frame into an event
+    #
+    # \param code Frame code
+    # \param payload Frame payload
+    # \return Device_Event
+    def _decode(self, code, payload):
+        stamp = time()
+        code = chr(code)
+        if code == 'D':
+            line = 'done_' + payload.decode('ascii', 'replace')
+            return Device_Event(EV_DONE, (line, ), line, stamp)
+        if code in ('h', 'e') and len(payload) == 8:
+            args = tuple('%.6f' % v for v in _PAIR_FLOAT.unpack(payload))
+            return Device_Event(_TAGGED_LINES[code + '_'], args, '%s_%s %s' % (code, args[0], args[1]), stamp)
+        if code == 'p' and len(payload) == 8:
+            args = _PAIR_INT.unpack(payload)
+            return Device_Event(EV_STEPS, args, 'p_%d %d' % args, stamp)
+        if code == 'k':
+            return Device_Event(EV_HEARTBEAT, (), 'k', stamp)
+        if code == 'E':
+            return Device_Event(EV_ERROR, (), 'ERROR', stamp)
+        return Device_Event(EV_TEXT, (), repr(payload), stamp)
+
+    ## Writes a command
+    #
+    # \param name Command name (4 characters)
+    # \param extra Bytes sent just after the command (for example the direction of movx)
+    # \param params Float parameters (float32), or integers (int32)
+    def write_command(self, name, extra=b'', params=()):
+        if name not in BINARY_COMMANDS:
+            raise DeviceError("'%s' is not supported by the binary protocol" % name)
+        fmt = '<' + ''.join('i' if isinstance(p, int) else 'f' for p in params)
+        self.write(encode_frame(BINARY_COMMANDS[name], extra + struct.pack(fmt, *params)))
+
+    ## Writes raw bytes
+    #
+    def write(self, data):
+        self.port.write(data)
+        self.tx_bytes += len(data)
+
+    ## Closes the port
+    #
+    def close(self):
+        self.port.close()
+
+
+## \brief Command sent (or to send) to the device
+#
+class Device_Command(object):
+    __slots__ = ('name', 'params', 'extra', 'done', 'future', 'state', 'timeout', 'deadline', 'written_at',
+                 'queued_at', 'priority', 'abort', 'aborted_at', 'attempts', 'on_done', 'pipeline', 'abortable')
+
+    ## Class constructor
+    #
+    # \param name Command name (4 characters)
+    # \param params Float or integer parameters
+    # \param extra Bytes sent just after the command
+    # \param done Regular expression for the terminator
+    # \param timeout Seconds from writing the command to its terminator, None means no deadline
+    # \param priority PRIORITY_NORMAL or PRIORITY_URGENT
+    # \param on_done Callable that receives the terminator, called before writing the next command
+    # \param pipeline Other commands can be written while this one is running. False for the commands that
+    #                 read the port while running (movx, movy) or can be aborted
+    # \param abortable The abort byte ends it (movements), see Device_Engine.abort
+    def __init__(self, name, params=(), extra=b'', done='^done_.*$', timeout=None, priority=PRIORITY_NORMAL,
+                 on_done=None, pipeline=True, abortable=False):
+        self.name = name
+        self.params = tuple(params)
+        self.extra = extra
+        self.done = re.compile(done)
+        self.future = Future()
+        self.state = ST_QUEUED
+        self.timeout = timeout
+        self.deadline = None
+        self.written_at = None
+        self.queued_at = time()
+        self.priority = priority
+        self.abort = False
+        self.aborted_at = None
+        self.attempts = None
+        self.on_done = on_done
+        self.pipeline = pipeline
+        self.abortable = abortable
+
+    def __repr__(self):
+        return "Device_Command(%s%r)" % (self.name, self.params)
+
+
+## \brief Latency measurements (count, last, mean and maximum)
+#
+class Latency_Stats(object):
+    __slots__ = ('count', 'total', 'last', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    ## Adds a measurement
+    #
+    # \param seconds Latency in seconds
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    ## Mean latency
+    #
+    # \return Seconds
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def __str__(self):
+        return "n=%d last=%.1fms mean=%.1fms max=%.1fms" % (self.count, self.last*1000, self.mean()*1000, self.max*1000)
+
+
+## \brief I/O engine: command queue, and reader thread
+#
+#  Commands are written in submission order, and each one is completed when its terminator is received.
+#  The methods can be called from any thread.
+class Device_Engine(object):
+
+    ## Class constructor
+    #
+    # \param transport Transport instance (Ascii_Transport..)
+    # \param on_event Callable that receives every Device_Event, from the reader thread
+    # \param heartbeat Seconds without traffic before checking the device with a 'ping', 0 disables it (see
+    #                  supervised)
+    # \param liveness Seconds without traffic, while a command is running, to consider the device hung (see
+    #                 supervised)
+    def __init__(self, transport, on_event=None, heartbeat=0.25, liveness=0.5):
+        self.transport = transport
+        self.on_event = on_event
+        self.heartbeat = heartbeat
+        self.liveness = liveness
+        self._queue = deque()
+        self._inflight = deque()
+        self._lock = RLock()
+        self._running = False
+        self._reader = None
+        self._last_rx = None
+        ## @var alive
+        # False once the device has stopped responding (until a command is completed, or a successful resync())
+        self.alive = True
+        ## @var supervised
+        # The device answers 'ping' and sends the heartbeat during the movements: the liveness check and the
+        # heartbeat are enabled once a 'ping' is completed (or the protocol is negotiated, see LaserDev). Until
+        # then, as with the older firmware, only the deadlines of the commands apply
+        self.supervised = False
+        ## @var max_inflight
+        # Maximum number of commands written to the device and waiting for their terminator. Greater than 1
+        # pipelines the commands: the next one waits in the input buffer of the device while the previous one
+        # is running
+        self.max_inflight = 1
+        ## @var drop_on_urgent
+        # Queued movements are dropped (True) or deferred (False) when an urgent command or an abort arrives. The
+        # other queued commands (configuration, reference objects..) are always deferred
+        self.drop_on_urgent = True
+        ## @var urgent_latency
+        # Time from submitting an urgent command (or writing an abort) to its acknowledgement by the device
+        self.urgent_latency = Latency_Stats()
+
+    ## Starts the reader thread
+    #
+    def start(self):
+        if self._reader is not None:
+            return
+        self._running = True
+        self._reader = Thread(target=self._read_loop, name='Device_Engine reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    ## Stops the reader thread, fails the pending commands and closes the transport
+    #
+    def close(self):
+        self._running = False
+        self.fail_all(DeviceError("Device closed"))
+        if self._reader is not None:
+            self._reader.join(5.0)
+            self._reader = None
+        self.transport.close()
+
+    ## Queues a command
+    #
+    #  Urgent commands pre-empt the queued work: they are written as soon as the device can read a command
+    #  (immediately, unless the parameters of the running command are still pending). The device does not read
+    #  commands during a movement (movx and movy would read it as a 'stop'): with abort_motion the movement in
+    #  flight is aborted first, otherwise the urgent command is written when it ends, so its latency is bounded by
+    #  the deadline of the movement. A movement without deadline (movx, movy) is always aborted. Behind other
+    #  non-pipelined commands (protocol changes), they wait for their end too.
+    #
+    # \param name Command name (4 characters)
+    # \param params Float or integer parameters
+    # \param extra Bytes sent just after the command
+    # \param done Regular expression for the terminator
+    # \param timeout Seconds from writing the command to its terminator, None means no deadline
+    # \param priority PRIORITY_NORMAL or PRIORITY_URGENT
+    # \param on_done Callable that receives the terminator, called (from the reader thread, without the engine
+    #                lock) before writing the next command. Used to switch the protocol (with pipeline False, so no command is written
+    #                behind it in the old protocol)
+    # \param pipeline Other commands can be written while this one is running (see max_inflight)
+    # \param abortable The abort byte ends the command (movements)
+    # \param abort_motion Urgent command that aborts the movement in flight (stop, emergency)
+    # \return Future, resolved with the terminator line
+    def submit(self, name, params=(), extra=b'', done='^done_.*$', timeout=None, priority=PRIORITY_NORMAL,
+               on_done=None, pipeline=True, abortable=False, abort_motion=False):
+        command = Device_Command(name, params, extra, done, timeout, priority, on_done, pipeline, abortable)
+        with self._lock:
+            if priority == PRIORITY_URGENT:
+                self._drop_queued(name)
+                motion = self._motion()
+                if motion is not None and (abort_motion or motion.timeout is None):
+                    self._abort(motion)
+                last = self._inflight[-1] if self._inflight else None
+                if last is None or (last.state == ST_RUNNING and (last.pipeline or last.aborted_at is not None)):
+                    self._write(command)
+                else:
+                    self._queue.appendleft(command)
+            else:
+                self._queue.append(command)
+                self._pump()
+        return command.future
+
+    ## Aborts the movement running in the device
+    #
+    #  The abort byte is sent immediately (or just after the parameters, if they are still pending), and the
+    #  queued movements are dropped. It applies to the movement in flight (the abortable command), whatever was
+    #  written after it: nothing is pipelined behind a movement, except the urgent commands that abort it. The
+    #  future of the aborted command fails with DeviceAborted when the device reports the end of the movement.
+    #
+    # \return Future resolved with the terminator of the aborted command, or None if no movement is in flight
+    def abort(self):
+        with self._lock:
+            motion = self._motion()
+            if motion is None:
+                return None
+            self._drop_queued('abort')
+            self._abort(motion)
+            return _ended(motion.future)
+
+    ## Movement in flight
+    #
+    # \return Device_Command or None
+    def _motion(self):
+        for command in self._inflight:
+            if command.abortable:
+                return command
+        return None
+
+    ## Aborts a command in flight, once: the abort byte is written now, or just after its parameters
+    #
+    # \param command Device_Command
+    def _abort(self, command):
+        if command.abort or command.aborted_at is not None:
+            return
+        if command.state == ST_RUNNING:
+            self._write_abort(command)
+        else:
+            command.abort = True
+
+    ## Writes the abort byte for the given command
+    #
+    def _write_abort(self, command):
+        self.transport.write(ABORT)
+        command.aborted_at = time()
+
+    ## Drops (or defers) the queued movements because of an urgent command
+    #
+    # \param reason Name of the urgent command
+    def _drop_queued(self, reason):
+        if not self.drop_on_urgent:
+            return
+        dropped = [command for command in self._queue if command.priority != PRIORITY_URGENT and command.abortable]
+        if not dropped:
+            return
+        self._queue = deque(command for command in self._queue
+                            if command.priority == PRIORITY_URGENT or not command.abortable)
+        for command in dropped:
+            _resolve(command.future, exception=DeviceError("'%s' dropped by '%s'" % (command.name, reason)))
+        logging.debug("%d queued movements dropped by '%s'" % (len(dropped), reason))
+
+    ## Drains the device back to the command prompt
+    #
+    #  Fails the pending commands, aborts any movement and sends 'ping' until 'done_ping' is received. While
+    #  draining, a 'float' prompt is answered with a filler value, and after an 'ERROR' (the device had read
+    #  a part of a command) each new 'ping' is preceded by one padding byte, so the 4-byte command boundary
+    #  is recovered within 4 attempts.
+    #
+    # \param attempts Maximum number of 'ping' attempts
+    # \param timeout Seconds to wait for the answer of each attempt
+    # \return Future, resolved with 'done_ping' when the device is synchronized
+    def resync(self, attempts=8, timeout=0.5):
+        self.fail_all(DeviceError("Resynchronizing"))
+        command = Device_Command('ping', done='^done_ping$', timeout=timeout, priority=PRIORITY_URGENT)
+        command.attempts = attempts
+        with self._lock:
+            self.transport.write(ABORT)
+            self._write(command)
+        return command.future
+
+    ## Replaces the transport (protocol change)
+    #
+    #  Must be called when nothing is being written: from the on_done callback of the command that switches the
+    #  protocol in the device
+    #
+    # \param transport New transport, on the same port
+    def set_transport(self, transport):
+        with self._lock:
+            self.transport = transport
+
+    ## Command written and waiting for its terminator (the oldest one)
+    #
+    # \return Device_Command or None
+    def current(self):
+        with self._lock:
+            return self._inflight[0] if self._inflight else None
+
+    ## Last command written and waiting for its terminator (the newest one)
+    #
+    # \return Device_Command or None
+    def last(self):
+        with self._lock:
+            return self._inflight[-1] if self._inflight else None
+
+    ## Number of commands queued and in flight
+    #
+    # \return List with (queued, in flight)
+    def pending(self):
+        with self._lock:
+            return (len(self._queue), len(self._inflight))
+
+    ## Fails every queued and in flight command
+    #
+    # \param exc Exception set on the futures
+    def fail_all(self, exc):
+        with self._lock:
+            commands = list(self._inflight) + list(self._queue)
+            self._inflight.clear()
+            self._queue.clear()
+        for command in commands:
+            _resolve(command.future, exception=exc)
+
+    ## Writes the queued commands while the device can accept them
+    #
+    def _pump(self):
+        while self._queue and len(self._inflight) < self.max_inflight:
+            if self._inflight and self._inflight[-1].state != ST_RUNNING:
+                # The parameters of the previous command are still pending
+                return
+            if self._inflight and not self._inflight[-1].pipeline:
+                return
+            command = self._queue.popleft()
+            if command.future.cancelled():
+                continue
+            self._write(command)
+
+    ## Writes a command, and its parameters if the device does not ask for them
+    #
+    # \param command Device_Command
+    def _write(self, command):
+        self._inflight.append(command)
+        command.written_at = time()
+        if command.timeout is not None:
+            command.deadline = command.written_at + command.timeout
+        try:
+            if command.params and self.transport.param_prompt:
+                self.transport.write_command(command.name, command.extra)
+                command.state = ST_HANDSHAKE
+            else:
+                self.transport.write_command(command.name, command.extra, command.params)
+                command.state = ST_RUNNING
+        except Exception as e:
+            self._inflight.remove(command)
+            _resolve(command.future, exception=DeviceError("Error writing '%s': %s" % (command.name, e)))
+
+    ## Registers the acknowledgement latency of urgent commands and aborts
+    #
+    # \param command Completed Device_Command
+    # \param stamp Reception time of the terminator
+    def _measure(self, command, stamp):
+        if command.aborted_at is not None:
+            self.urgent_latency.add(stamp - command.aborted_at)
+        elif command.priority == PRIORITY_URGENT:
+            # Including the end of the movement it waited for
+            self.urgent_latency.add(stamp - command.queued_at)
+        else:
+            return
+        logging.debug("'%s' acknowledged in %.1fms (%s)" % (command.name, self.urgent_latency.last*1000,
+                                                           self.urgent_latency))
+
+    ## Reader thread
+    #
+    def _read_loop(self):
+        while self._running:
+            try:
+                event = self.transport.read_event()
+            except Exception as e:
+                if self._running:
+                    logging.error("Error reading from device: %s" % e)
+                    self.fail_all(DeviceError("Error reading from device: %s" % e))
+                return
+            if event is not None:
+                self._last_rx = event.stamp
+                self._dispatch(event)
+            self._check_timers(time())
+
+    ## Checks the deadlines, the liveness of the device and the heartbeat
+    #
+    # \param now Current time
+    def _check_timers(self, now):
+        expired = None
+        with self._lock:
+            if self._inflight:
+                head = self._inflight[0]
+                if head.attempts is not None and head.deadline is not None and now > head.deadline:
+                    # Resynchronizing: no answer to this attempt
+                    self._retry_resync(head, b'')
+                elif head.deadline is not None and now > head.deadline:
+                    expired = (self._inflight.popleft(), "'%s' not completed in %.1fs" % (head.name, head.timeout))
+                elif self.supervised and now - max(self._last_rx or 0, head.written_at) > self.liveness:
+                    expired = (self._inflight.popleft(), "Device not responding (no data for %.1fs while running '%s')" %
+                                                         (now - self._last_rx, head.name))
+                if expired is not None:
+                    # The queued commands are not written to a device that does not respond (the next ones
+                    # submitted are, and the first one completed marks it alive again)
+                    self.alive = False
+                    dropped = list(self._queue)
+                    self._queue.clear()
+            elif self.supervised and self.heartbeat > 0 and self.alive and self._last_rx is not None and \
+                    not self._queue and now - self._last_rx > self.heartbeat:
+                self._write(Device_Command('ping', done='^done_ping$', timeout=self.liveness))
+        if expired is not None:
+            (command, reason) = expired
+            logging.error(reason)
+            _resolve(command.future, exception=DeviceTimeout(reason))
+            for queued in dropped:
+                _resolve(queued.future, exception=DeviceTimeout("'%s' not sent: %s" % (queued.name, reason)))
+            if self.on_event is not None:
+                self.on_event(Device_Event(EV_TIMEOUT, (command.name, ), reason, now))
+
+    ## Sends a new 'ping' attempt while resynchronizing
+    #
+    # \param command Resync Device_Command
+    # \param padding Bytes sent before the 'ping'
+    def _retry_resync(self, command, padding):
+        command.attempts -= 1
+        if command.attempts <= 0:
+            self._inflight.remove(command)
+            _resolve(command.future, exception=DeviceTimeout("Resync failed"))
+            return
+        self.transport.write(padding)
+        self.transport.write_command('ping')
+        command.deadline = time() + command.timeout
+
+    ## Starts the deadline of the next pipelined command, which begins to run when the previous one ends
+    #
+    # \param now Completion time of the previous command
+    def _advance(self, now):
+        if self._inflight:
+            head = self._inflight[0]
+            if head.timeout is not None:
+                head.deadline = max(head.deadline, now + head.timeout)
+
+    ## Completes the oldest command in flight and writes the next ones
+    #
+    # \param event Terminator Device_Event
+    # \param exc (optional) Exception that fails the command
+    # \return Tuple (command, result, exception) to resolve its future
+    def _complete(self, event, exc=None):
+        head = self._inflight.popleft()
+        finished = (head, event.line, None) if exc is None else (head, None, exc)
+        if head.aborted_at is not None:
+            finished = (head, None, DeviceAborted("'%s' aborted" % head.name, event.line))
+        elif head.name == 'ping':
+            self.supervised = True
+        self.alive = True
+        self._measure(head, event.stamp)
+        self._advance(event.stamp)
+        self._pump()
+        return finished
+
+    ## Completes a command with on_done callback, which is called without the lock: it can wait for the device
+    #  (speed change) without blocking submit, abort or the timers. The command stays in flight meanwhile (it is
+    #  not pipelined), so nothing else is written until it is completed
+    #
+    # \param command Device_Command
+    # \param event Terminator Device_Event
+    # \return Tuple (command, result, exception) to resolve its future, None if it has been failed meanwhile
+    def _switch(self, command, event):
+        exc = None
+        try:
+            command.on_done(event.line)
+        except DeviceError as e:
+            exc = e
+        except Exception as e:
+            exc = DeviceError("Error completing '%s': %s" % (command.name, e))
+        with self._lock:
+            if not self._inflight or self._inflight[0] is not command:
+                return None
+            return self._complete(event, exc)
+
+    ## Processes an event from the device
+    #
+    # \param event Device_Event
+    def _dispatch(self, event):
+        finished = None
+        switching = None
+        with self._lock:
+            if self._inflight and self._inflight[0].attempts is not None:
+                head = self._inflight[0]
+                if event.kind == EV_FLOAT:
+                    self.transport.write(FILLER)
+                elif event.kind == EV_ERROR:
+                    self._retry_resync(head, b'.')
+                elif event.kind == EV_DONE and head.done.match(event.line):
+                    self._inflight.popleft()
+                    finished = (head, event.line, None)
+                    self.alive = True
+                    self.supervised = True
+                    self._pump()
+            elif self._inflight:
+                head = self._inflight[0]
+                if event.kind == EV_FLOAT and head.state == ST_HANDSHAKE:
+                    self.transport.write_params(head.params)
+                    head.state = ST_RUNNING
+                    if head.abort:
+                        self._write_abort(head)
+                        # The urgent commands that aborted it
+                        while self._queue and self._queue[0].priority == PRIORITY_URGENT:
+                            self._write(self._queue.popleft())
+                    self._pump()
+                elif event.kind == EV_DONE and head.done.match(event.line) and head.on_done is not None:
+                    # Completed by _switch, without the lock
+                    head.deadline = None
+                    switching = head
+                elif event.kind == EV_DONE and head.done.match(event.line):
+                    finished = self._complete(event)
+                elif event.kind == EV_ERROR:
+                    self._inflight.popleft()
+                    finished = (head, None, DeviceError("'%s' rejected by the device" % head.name))
+                    self._advance(event.stamp)
+                    self._pump()
+        if switching is not None:
+            finished = self._switch(switching, event)
+        if finished is not None:
+            (command, result, exc) = finished
+            _resolve(command.future, result, exc)
+        if self.on_event is not None:
+            try:
+                self.on_event(event)
+            except Exception as e:
+                logging.error("Error handling %r: %s" % (event, e))
+
+
+## Sets the result of a future, unless it has been cancelled or already resolved
+#
+def _resolve(future, result=None, exception=None):
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+## Future of the end of a command, resolved with its terminator also if it is aborted
+#
+# \param future Future of the command
+# \return Future
+def _ended(future):
+    ended = Future()
+    def chain(future):
+        if future.cancelled():
+            ended.cancel()
+        elif isinstance(future.exception(), DeviceAborted):
+            _resolve(ended, future.exception().line)
+        elif future.exception() is not None:
+            _resolve(ended, exception=future.exception())
+        else:
+            _resolve(ended, future.result())
+    future.add_done_callback(chain)
+    return ended
@@ -7,12 +7,19 @@ import functools
 import logging
 from PyQt4 import QtCore, QtGui
 from threading import Thread, Event
-from time import ctime, strftime, localtime
+from time import ctime
 from ui.laser_control_ui import Ui_LaserControl
 from telescope_server import Telescope_Server
 import coords
 from ldevice import LaserDev, get_avalilable_ports
 from repeat_timer import RepeatTimer
+from coalescing_dispatcher import CoalescingDispatcher
+
+# The predictive tracking needs NumPy, otherwise the target is sent periodically
+try:
+    from tracking_engine import TrackingEngine
+except ImportError:
+    TrackingEngine = None
 
 
 try:
@@ -37,7 +44,7 @@ class LaserControlMain(QtGui.QMainWindow):
     ## @var act_stell_pos
     #  Signal to communications with the Telescope_Server instance
     #  It emits when we want to send to Stellarium the equatorial coordinates
-    act_stell_pos = QtCore.pyqtSignal(str, str)
+    act_stell_pos = QtCore.pyqtSignal(object, object) #Ra (coords.Hours), Dec (coords.Degrees)
 
     ## Class constructor
     #
@@ -49,7 +56,7 @@ class LaserControlMain(QtGui.QMainWindow):
         self.confMode = False
         self.nRef = 0
         self.device = None
-        (self._ra, self._dec) = ("0h0m0s", "0º0'0''")
+        (self._ra, self._dec) = (None, None)
 
         self.ui = Ui_LaserControl()
         self.ui.setupUi(self)
@@ -64,9 +71,13 @@ class LaserControlMain(QtGui.QMainWindow):
         self.ui.tabWidget.setCurrentIndex(1)
         self.ui.tabWidget.setTabEnabled(1, False)
 
-        self.pos = ('0.0000', '0.0000')
+        self.pos = (coords.Degrees(0.0), coords.Degrees(0.0))
         self._prev_pos = ("0º0'0''", "0º0'0''")
         
+        #Device commands are executed sequentially out of the GUI thread, keeping only the newest goto/move
+        self.dispatcher = CoalescingDispatcher()
+        self.dispatcher.start()
+        
         #Starts server
         self.Server = Telescope_Server(pos_signal=self.act_stell_pos)
         self.Server.daemon = True
@@ -141,19 +152,16 @@ class LaserControlMain(QtGui.QMainWindow):
     #  
     #  Also manages the UI status along the configuration process.
     #
-    # \param ra Right ascension
-    # \param dec Declination
-    # \param mtime Timestamp
+    # \param ra Right ascension (coords.Hours)
+    # \param dec Declination (coords.Degrees)
+    # \param mtime Timestamp in microseconds
     def stellariumRecv(self, ra, dec, mtime):
-        ra = float(ra)
-        dec = float(dec)
-        mtime = float(mtime)
-        logging.debug("%s" % coords.toJ2000(ra, dec, mtime))
-        (sra, sdec, stime) = coords.eCoords2str(ra, dec, mtime)
-        (self._ra, self._dec) = (sra, sdec)
+        logging.debug("%s/%s at %s" % (ra, dec, ctime(mtime / 1000000)))
+        stime = coords.Hours.from_timestamp(mtime / 1000000.0)
+        (self._ra, self._dec) = (ra, dec)
 
         if self.device != None:
-            logging.debug("Sending to the device: '%s','%s','%s'" % (sra, sdec, stime))
+            logging.debug("Sending to the device: '%s','%s','%s'" % (ra, dec, stime))
             try:
                 if self.ui.Reconfigure.isChecked():
                     if self.ui.redef_1:
@@ -166,13 +174,14 @@ class LaserControlMain(QtGui.QMainWindow):
                         self.ui.redef_3.setChecked(False)
                         redef = 3
                     self.ui.Reconfigure.setChecked(False)
-                    self.device.setRef(redef, sra, sdec, stime)
+                    self.dispatcher.submit(self.device.setRef, redef, ra, dec, stime)
                 elif not self.confMode:
-                    self.device.goto(sra, sdec, stime)
+                    if self.dispatcher.submit(self.device.goto, ra, dec, stime, key='goto'):
+                        logging.debug("Pending goto superseded (%d in total)" % self.dispatcher.superseded)
                 else:
                     self.nRef = self.nRef + 1
                     self.ui.text_status.setText("References: %d/2" % self.nRef)
-                    self.device.setRef(self.nRef, sra, sdec, stime)
+                    self.dispatcher.submit(self.device.setRef, self.nRef, ra, dec, stime)
                     if self.nRef == 2:
                         self.setConfigDone()
                         self.nRef = 0
@@ -211,9 +220,11 @@ class LaserControlMain(QtGui.QMainWindow):
     
     ## Up/Down/Right/Left key released..
     #
-    #  Stops any movement
+    #  Stops any movement, and discards the pending ones (the other jobs, as the reference objects, are kept)
     def arrow_released(self):
         if self.device != None:
+            self.dispatcher.clear('goto')
+            self.dispatcher.clear('move')
             self.device.stop()
     
     ## Handles the changes on the coordinates text boxes
@@ -225,7 +236,7 @@ class LaserControlMain(QtGui.QMainWindow):
         y = _toUtf8(self.ui.posVertical.text())
         if self.device != None and (self._prev_pos[0]!=x or self._prev_pos[1]!=y):
             logging.debug("Sending (%s, %s) to device" % (x, y))
-            self.device.move(x,y)
+            self.dispatcher.submit(self.device.move, x, y, key='move')
         self._prev_pos = (x, y)
         
     ## Handles the changes on "configuration mode" check box
@@ -256,14 +267,22 @@ class LaserControlMain(QtGui.QMainWindow):
             
     ## Handles changes on tracking check box
     # 
-    #  If check is On, starts the tracking mode on the device
+    #  If check is On, starts the tracking mode on the device: the corrections are predicted (TrackingEngine, at
+    #  the angular rates of the target) if the device is connected and NumPy is available, otherwise the target is
+    #  sent every 5 seconds. If it is Off, the instrumentation of the tracking is logged
     def trackModeChanged(self):
         if self.ui.trackMode.isChecked():
-            self.track = RepeatTimer(5.0, self.tracking)
+            if TrackingEngine is not None and self.device != None and self.device.pointing is not None:
+                submit = functools.partial(self.dispatcher.submit, self.device.goto, key='goto')
+                self.track = TrackingEngine(self.device, lambda: (self._ra, self._dec), submit)
+            else:
+                self.track = RepeatTimer(5.0, self.tracking)
             self.track.start()
             logging.debug("Track mode ON")
         else:
             self.track.cancel()
+            if hasattr(self.track, 'stats'):
+                logging.info("Tracking: %s" % self.track.stats())
             logging.debug("Track mode Off")
         
     ## Starts the device connection
@@ -280,6 +299,7 @@ class LaserControlMain(QtGui.QMainWindow):
                 self.device.init_received.connect(self.init_received)
                 self.device.pos_received.connect(self.pos_received)
                 self.device.pos_e_received.connect(self.pos_e_received)
+                self.device.link_changed.connect(self.link_changed)
                 self.device.start()
         except:
             logging.info("Device not found")
@@ -295,31 +315,38 @@ class LaserControlMain(QtGui.QMainWindow):
         logging.info("Initializing device..")
         try:
             if self.device != None:
-                self.device.init()
+                self.dispatcher.submit(self.device.init)
         except:
             logging.info("Error initializing device.")
     
+    ## Receives the negotiated link settings from the device
+    #
+    #  Shows the protocol and speed of the connection in the status bar
+    def link_changed(self, protocol, baud):
+        logging.info("Device link: %s protocol, %d baud" % (protocol, baud))
+        self.statusBar().showMessage("Device: %s protocol, %d baud" % (protocol, baud))
+        
     ## Receives the end of initialization signal from the device
     #
     #  That signal indicates that the device is successfully initialized
     def init_received(self):
         logging.debug("Init received")
-        self.pos = ('0.0000', '0.0000')
+        self.pos = (coords.Degrees(0.0), coords.Degrees(0.0))
         self.ui.posHorizontal.setText("%s" % _fromUtf8("0º0'0''"))
         self.ui.posVertical.setText("%s" % _fromUtf8("0º0'0''"))
         
     ## Receives the position updated signal from the device
     #
-    #  The parameters are the horizontal coordinates which the device points to
+    #  The parameters are the horizontal coordinates which the device points to (coords.Degrees)
     def pos_received(self, x, y):
         logging.debug("%s,%s" % (x, y))
         self.pos = (x, y)
-        self.ui.posHorizontal.setText("%s" % _fromUtf8(coords.deg_2_degStr(360.0 - coords.radStr_2_deg(self.pos[0]))))
-        self.ui.posVertical.setText("%s" % _fromUtf8(coords.radStr_2_degStr(self.pos[1])))
+        self.ui.posHorizontal.setText("%s" % _fromUtf8(coords.deg_2_degStr(360.0 - self.pos[0].degrees % 360.0)))
+        self.ui.posVertical.setText("%s" % _fromUtf8(coords.deg_2_degStr(self.pos[1].degrees % 360.0)))
         
     ## Receives the position updated signal from the device
     #
-    #  The parameters are the equatorial coordinates which the device points to
+    #  The parameters are the equatorial coordinates which the device points to (coords.Hours, coords.Degrees)
     def pos_e_received(self, x, y):
         logging.debug("%s,%s" % (x, y))
         self.act_stell_pos.emit(x, y)
@@ -328,9 +355,10 @@ class LaserControlMain(QtGui.QMainWindow):
     #
     #  Updates periodically the device position by sending the equatorial coordinates and time
     def tracking(self):
-        logging.debug("('%s', '%s', '%s')" % (self._ra, self._dec, strftime("%Hh%Mm%Ss", localtime())))
-        if self.device != None and self._ra != '0h0m0s':
-            self.device.goto( self._ra, self._dec, strftime("%Hh%Mm%Ss", localtime()) )
+        now = coords.Hours.now()
+        logging.debug("('%s', '%s', '%s')" % (self._ra, self._dec, now))
+        if self.device != None and self._ra is not None:
+            self.dispatcher.submit(self.device.goto, self._ra, self._dec, now, key='goto')
     
     ## Laser toggle..
     #
@@ -353,6 +381,9 @@ class LaserControlMain(QtGui.QMainWindow):
         logging.info("Disconnecting device..")
         try:
             if self.device != None:
+                # The tracking can not go on without the device
+                self.ui.trackMode.setChecked(False)
+                self.dispatcher.clear()
                 self.device.close()
                 self.device = None
         except:
@@ -364,6 +395,7 @@ class LaserControlMain(QtGui.QMainWindow):
         logging.debug("Bye!")
         try:
             self.Server.close_socket()
+            self.dispatcher.cancel()
             self.track.cancel()
             event.accept()
         except:
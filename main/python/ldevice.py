@@ -4,24 +4,54 @@
 import sys
 import re
 import math
+import threading
 import serial, os
 from serial.tools import list_ports
 import logging
+import struct
+from concurrent.futures import Future
 from PyQt4 import QtCore
-import asyncore, socket
-from time import sleep, time, strftime, localtime
-from string import replace
+from time import sleep
 import coords
+from device_engine import Device_Engine, Ascii_Transport, Binary_Transport, DeviceError, PRIORITY_URGENT, \
+    DeviceLinkError, DeviceAborted, BAUD_PATTERN, BAUD_TIMEOUT, BAUD_UNIT, \
+    EV_BOOT, EV_PROMPT, EV_STEPS, EV_HORIZONTAL, EV_EQUATORIAL, EV_TIMEOUT, EV_TEXT
+
+# The transformations of the device are only computed on the host if NumPy is available
+try:
+    from pointing_engine import PointingEngine
+except ImportError:
+    PointingEngine = None
 
 # Check for pyserial version ( >= 2.6 nedded)
 if serial.VERSION < '2.6':
     print("pySerial >= 2.6. is needed (in Linux you can install 'pip' and then run 'pip install pyserial --upgrade' as root)")
     sys.exit()
 
+## Duration of a motor step in the device (two half periods of 1200us, see AxesLib::_step)
+STEP_PERIOD = 0.0024
+
+## Maximum number of steps of each axis during 'init' (see AxesLib::init)
+MAX_INIT_STEPS = 10000
+
+## Poll interval of the reader thread (serial port timeout)
+POLL_INTERVAL = 0.05
+
+## Speeds of the serial port supported by the device, besides the initial one (fastest first)
+BAUD_RATES = (500000, 230400, 115200)
+
+_float = struct.Struct('<f')
+
+## Rounds to single precision (float of the Arduino)
+def _f32(value):
+    return _float.unpack(_float.pack(value))[0]
+
 ## \brief Class that implements the interface to control the device.
 # 
-# It is designed to work on a separate thread. The communication with the main application is via 
-# asynchronous Qt signals.
+# The communication with the main application is via asynchronous Qt signals. The commands are executed
+# by a Device_Engine: every method returns immediately with a Future (concurrent.futures), resolved with
+# the terminator line when the device completes the command, so completion callbacks can be added with
+# add_done_callback(). The position telemetry is emitted as soon as it is received.
 # Also it uses some functions present in coords.py
 #
 class LaserDev (QtCore.QThread):
@@ -33,12 +63,17 @@ class LaserDev (QtCore.QThread):
     ## @var pos_received
     #  Signal for the communications with the main thread
     #  It emits when the horizontal coordinates are received from the device
-    pos_received = QtCore.pyqtSignal(str, str) #alt, az
+    pos_received = QtCore.pyqtSignal(object, object) #az, alt (coords.Degrees)
     
     ## @var pos_e_received
     #  Signal for the communications with the main thread
     #  It emits when the equatorial coordinates are received from the device
-    pos_e_received = QtCore.pyqtSignal(str, str) #ar, dec
+    pos_e_received = QtCore.pyqtSignal(object, object) #ar (coords.Hours), dec (coords.Degrees)
+
+    ## @var link_changed
+    #  Signal for the communications with the main thread
+    #  It emits when the protocol and the speed of the connection have been negotiated
+    link_changed = QtCore.pyqtSignal(str, int) #protocol, baud
 
 
     ## Class constructor
@@ -47,155 +82,554 @@ class LaserDev (QtCore.QThread):
     #
     # \param usb_serial Serial port. By default is '/dev/ttyUSB0'
     # \param usb_serial_port Transmission speed. Default 9600 baud
-    # \param timeout Maximum waiting time for responses
-    def __init__(self, usb_serial='/dev/ttyUSB0', usb_serial_baud=9600, timeout=2):
+    # \param timeout Maximum waiting time for the response of a command, besides its movement time
+    # \param binary Negotiates the binary protocol when connecting (otherwise the pipelined ASCII mode is
+    #               negotiated, and the ASCII protocol is kept if the device does not support any of them)
+    # \param pipeline Maximum number of commands sent to the device ahead of their completion (1 disables it)
+    # \param max_baud Maximum speed negotiated with the device (the connection starts at usb_serial_baud)
+    # \param offload Computes the transformations on the host (see goto()), once the two first reference
+    #                objects are set. It needs NumPy
+    # \param step_targets Sends the horizontal positions as steps of the motors ('step' command), once the
+    #                     steps per revolution are known (see toSteps())
+    # \param suppress Drops the gotos and moves that would not move the motors (see _redundant())
+    def __init__(self, usb_serial='/dev/ttyUSB0', usb_serial_baud=9600, timeout=2, binary=True, pipeline=2,
+                 max_baud=500000, offload=False, step_targets=True, suppress=True):
         QtCore.QThread.__init__(self, None)
-        self.serial = serial.Serial(usb_serial, usb_serial_baud, timeout=timeout)
+        self.timeout = timeout
+        self.binary = binary
+        self.max_baud = max_baud
+        ## @var offload
+        # The gotos are converted to horizontal coordinates by the host, and sent as moves
+        self.offload = offload and PointingEngine is not None
+        ## @var step_targets
+        # The positions are converted to steps by the host
+        self.step_targets = step_targets
+        ## @var suppress
+        # The movements to the current position in steps are not sent
+        self.suppress = suppress
+        ## @var suppressed
+        # Number of movements not sent, by command ('goto', 'move')
+        self.suppressed = {'goto': 0, 'move': 0}
+        # Last movement sent (future, position in steps or None if it is not known), until it is completed
+        self._commanded = None
+        ## @var protocol
+        # Protocol in use: 'ascii', 'pipe' (ASCII without parameter prompts) or 'binary'
+        self.protocol = 'ascii'
+        self.serial = serial.Serial(usb_serial, usb_serial_baud, timeout=POLL_INTERVAL)
+        self.engine = Device_Engine(Ascii_Transport(self.serial), self._event)
+        self.engine.max_inflight = pipeline
+        self._ready = threading.Event()
+        ## @var steps
+        # Steps per revolution of each axis, reported by the device after 'init' (calibration)
+        self.steps = None
+        ## @var step_position
+        # Last position of the axes in steps (x, y), reported by the device after 'move' and 'step'
+        self.step_position = None
+        ## @var position
+        # Last horizontal position reported by the device (x, y), in radians
+        self.position = None
+        ## @var pointing
+        # Transformations of the device computed on the host (PointingEngine, None without NumPy), with the
+        # same initial time and reference objects
+        self.pointing = PointingEngine() if PointingEngine else None
         logging.debug("Connected (%s)" % usb_serial)
         
-    ## Getting the response of sent commands
-    #
-    #  Implements the common process for getting response of a command
-    #
-    # \param expect Regular expression for the "end of the command" tag. By default is '^cmd$'
-    # \param wait Maximum number of cycles to wait for the response
-    # \return Last line read
-    def sread(self, expect='^cmd$', wait=0):
-        _d = None
-        exp = re.compile(expect)
-        line = self.serial.readline().rstrip()
-        tag_steps = re.compile('^p_.*$')
-        tag_horizontal = re.compile('^h_.*$')
-        tag_equatorial = re.compile('^e_.*$')
-        _count = 0
-        while(not exp.match(line) and _count <= wait):
-            if tag_steps.match(line):
-                resp = line.replace("p_", '')
-                _d = resp.split(' ')
-                logging.debug("Steps: (%s, %s)" % (_d[0], _d[1]))
-            elif tag_horizontal.match(line):
-                resp = line.replace("h_", '')
-                _d = resp.split(' ')
-                self.pos_received.emit(_d[0], _d[1])
-                logging.debug("PosH: (%s / %s)" % ( coords.deg_2_degStr( 360.0 - coords.radStr_2_deg(_d[0])), coords.deg_2_degStr( coords.radStr_2_deg(_d[1])) ))
-            elif tag_equatorial.match(line):
-                resp = line.replace("e_", '')
-                _d = resp.split(' ')
-                self.pos_e_received.emit(_d[0], _d[1])
-                logging.debug("PosE: (%s / %s)" % ( \
-                    coords.hour_2_hourStr(coords.rad_2_hour(coords.degStr_2_rad(coords.radStr_2_degStr(_d[0])))), \
-                    coords.deg_2_degStr(coords.radStr_2_deg(_d[1])) ))
-            if line == '':
-                _count += 1
+    ## Handles the events received from the device (reader thread)
+    #
+    # \param event Device_Event
+    def _event(self, event):
+        _d = event.args
+        if event.kind in (EV_BOOT, EV_PROMPT):
+            if event.kind == EV_BOOT and self.protocol != 'ascii':
+                # The device has been restarted, so it is back in ASCII mode
+                logging.warning("Device restarted, switching to ASCII protocol")
+                self.engine.set_transport(Ascii_Transport(self.serial))
+                self.protocol = 'ascii'
+            if event.kind == EV_BOOT and self.pointing is not None:
+                # The reference objects are lost
+                self.pointing = PointingEngine()
+            self._ready.set()
+        elif event.kind == EV_STEPS:
+            current = self.engine.current()
+            if current is not None and current.name == 'init':
+                self.steps = _d
+                logging.debug("Steps per revolution: (%s, %s)" % (_d[0], _d[1]))
             else:
-                print("__debug__: %s" % line)
-            line = self.serial.readline().rstrip()
-        return line
+                self.step_position = _d
+                logging.debug("Steps: (%s, %s)" % (_d[0], _d[1]))
+        elif event.kind == EV_HORIZONTAL:
+            self.position = (coords.Degrees(_d[0]), coords.Degrees(_d[1]))
+            self.pos_received.emit(*self.position)
+            logging.debug("PosH: (%s / %s)" % self.position)
+        elif event.kind == EV_EQUATORIAL:
+            if self._offloaded():
+                # Reported by the host (see _report_equatorial)
+                return
+            (ra, dec) = (coords.Hours(_d[0]), coords.Degrees(_d[1]))
+            self.pos_e_received.emit(ra, dec)
+            logging.debug("PosE: (%s / %s)" % (ra, dec))
+        elif event.kind == EV_TIMEOUT:
+            logging.info("Device timeout: %s" % event.line)
+        elif event.kind == EV_TEXT and event.line != '':
+            print("__debug__: %s" % event.line)
+
+    ## Deadline of a movement, from the distance to move
+    #
+    #  The DDA algorithm moves up to one step on each axis per iteration, and it makes as many iterations as
+    #  steps on the longest axis.
+    #
+    # \param target Horizontal position (x, y) in radians, None if it is not known by the host (goto)
+    # \return Seconds
+    def _motion_timeout(self, target=None):
+        if self.steps is None:
+            # Not initialized: the whole range of both axes
+            return self.timeout + 2 * MAX_INIT_STEPS * STEP_PERIOD
+        (px, py) = self.steps
+        if target is None or self.position is None:
+            steps = max(px, py / 2.0)
+        else:
+            steps = max(abs(target[0] - self.position[0]) * px, abs(target[1] - self.position[1]) * py) / (2 * math.pi)
+        return self.timeout + 1.25 * 2 * steps * STEP_PERIOD
 
     ## Sets initial time in the device
     #
-    # \param time Unix timestamp
+    # \param time Local time of the day (coords.Hours, or string "HhMmSs")
+    # \return Future
     def setTime(self, time):
-        self.serial.write("time")
-        if(self.serial.readline().rstrip() == 'float'):
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(time)) )
-            self.sread()
+        time = coords.Hours.of(time)
+        future = self.engine.submit('time', (time, ), timeout=self.timeout)
+        if self.pointing is not None:
+            future.add_done_callback(lambda f: self._succeeded(f) and self.pointing.setTime(time))
+        return future
         
     ## Initializes the device
     #
     #  Emits the init_received when the device responds
+    # \return Future
     def init(self):
-        self.serial.readline() # wait the timeout at most
-        self.serial.write('init')
-        
-        self.sread(expect='^done_init$', wait=20)
-        self.init_received.emit()
+        if self.steps is None:
+            steps = 4 * MAX_INIT_STEPS
+        else:
+            # Both limits of X, and both limits of Y (90º)
+            steps = 2 * self.steps[0] + self.steps[1] / 2.0
+        future = self.engine.submit('init', done='^done_init$', timeout=self.timeout + 1.25 * steps * STEP_PERIOD)
+        self._sent(future, None)
+        future.add_done_callback(self._init_done)
+        return future
+    
+    ## Completion of the 'init' command
+    #
+    def _init_done(self, future):
+        if self._succeeded(future):
+            # At the beginning of both axes (see AxesLib::init and AxesLib::getX)
+            self.position = (coords.Degrees(2 * math.pi), coords.Degrees(0.0))
+            self.init_received.emit()
+
+    ## Indicates if the transformations are computed on the host (offload mode, with the reference objects set)
+    #
+    # \param offload Overrides the offload mode
+    # \return Boolean
+    def _offloaded(self, offload=None):
+        if offload is None:
+            offload = self.offload
+        return offload and self.pointing is not None and self.pointing.canTransform()
+
+    ## Position in steps of the motors of a horizontal position, as AxesLib::goToRads calculates it, but
+    #  rounded to the nearest step instead of the nearest degree
+    #
+    # \param x X axis, in radians (0 - 2*Pi)
+    # \param y Y axis, in radians (0 - Pi)
+    # \return List with the steps from 0 of each axis (x, y), or None if the steps per revolution are not known
+    def toSteps(self, x, y):
+        if self.steps is None:
+            return None
+        (px, py) = self.steps
+        # The X axis goes clockwise from 360º (see AxesLib::getX), and the Y axis up to 180º
+        sx = int(round((-x % (2 * math.pi)) * px / (2 * math.pi))) % px
+        sy = min(max(int(round(y * py / (2 * math.pi))), 0), py // 2)
+        return (sx, sy)
+
+    ## Position in steps of the motors that the device calculates for a horizontal position in 'goto' and 'move'
+    #  (see AxesLib::goToRads: rounded to whole degrees, in single precision)
+    #
+    # \param x X axis, in radians
+    # \param y Y axis, in radians
+    # \return List with the steps from 0 of each axis (x, y), or None if the steps per revolution are not known
+    def deviceSteps(self, x, y):
+        if self.steps is None:
+            return None
+        (px, py) = self.steps
+        (pgrad_x, pgrad_y) = (_f32(px / 360.0), _f32(py / 360.0))
+        (max_x, max_y) = (int(_f32(360 * pgrad_x)), int(_f32(180 * pgrad_y)))
+        degs_x = 360 - round(_f32(_f32(_f32(x) * 180.0) / _f32(math.pi)))
+        if degs_x >= 360:
+            degs_x -= 360
+        sx = int(_f32(degs_x * pgrad_x))
+        sy = int(_f32(round(_f32(_f32(_f32(y) * 180.0) / _f32(math.pi))) * pgrad_y))
+        if sx < 0:
+            sx = max_x - abs(sx)
+        return (min(sx, max_x) % px, min(max(sy, 0), max_y))
+
+    ## Position in steps of the device, or the one of the movement in progress
+    #
+    # \return List with the steps from 0 of each axis (x, y), or None if it is not known
+    def currentSteps(self):
+        commanded = self._commanded
+        if commanded is not None:
+            return commanded[1]
+        if self.position is None:
+            return None
+        return self.toSteps(*self.position)
+
+    ## Indicates if a movement would not move the motors, because its position in steps is the one of the device
+    #  (or the one of the movement in progress), and counts it
+    #
+    # \param name Command ('goto' or 'move')
+    # \param steps Position in steps of the movement, None if it is not known
+    # \return Boolean
+    def _redundant(self, name, steps):
+        if not self.suppress or steps is None or steps != self.currentSteps():
+            return False
+        self.suppressed[name] += 1
+        logging.debug("'%s' to (%d, %d) suppressed (%d in total)" % ((name, ) + steps + (self.suppressed[name], )))
+        return True
+
+    ## Future of a movement that has not been sent (see _redundant)
+    #
+    # \return Future, already resolved
+    def _suppressed(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    ## Registers a movement sent to the device: its position is the reference of the next ones until it is
+    #  completed (see _redundant)
+    #
+    # \param future Future of the movement
+    # \param steps Position in steps of the movement, None if it is not known
+    # \return The future
+    def _sent(self, future, steps):
+        self._commanded = (future, steps)
+        future.add_done_callback(self._completed)
+        return future
+
+    def _completed(self, future):
+        commanded = self._commanded
+        if commanded is not None and commanded[0] is future:
+            # From here the position reported by the device is used
+            self._commanded = None
+
+    ## Moves the device to a horizontal position
+    #
+    #  The position is sent in steps ('step') if step_targets is enabled and the steps per revolution are known,
+    #  so the device does not convert it. Otherwise it is sent in radians ('move').
+    #
+    # \param target Horizontal position (x, y), in radians
+    # \param time Local time of the movement (coords.Hours), for the equatorial coordinates of 'move'
+    # \param name Command that requested the movement ('goto' or 'move'), see _redundant
+    # \return List with (future, True if the command is 'step'), or (None, False) if it is not sent
+    def _move(self, target, time, name='move'):
+        timeout = self._motion_timeout(target)
+        steps = self.toSteps(*target) if self.step_targets else None
+        if steps is None:
+            if self._redundant(name, self.deviceSteps(*target)):
+                return (None, False)
+            future = self.engine.submit('move', target + (time, ), timeout=timeout, pipeline=False,
+                                        abortable=True)
+            return (self._sent(future, self.deviceSteps(*target)), False)
+        if self._redundant(name, steps):
+            return (None, False)
+        logging.debug("Steps target: (%d, %d)" % steps)
+        future = self.engine.submit('step', steps, timeout=timeout, pipeline=False, abortable=True)
+        return (self._sent(future, steps), True)
+
+    ## Reports the equatorial coordinates of a movement computed on the host (offload mode, or 'step'), once it
+    #  is completed or aborted, as the device does (see plaser.pde)
+    #
+    # \param future Future of the movement
+    # \param ac Azimuth (X axis). By default, the position reported by the device
+    # \param alt Altitude (Y axis)
+    # \param time Local time of the movement. By default, the current time
+    def _report_equatorial(self, future, ac=None, alt=None, time=None):
+        if not self._reached(future) or self.pointing is None or not self.pointing.canTransform():
+            return
+        if ac is None:
+            if self.position is None:
+                return
+            (ac, alt) = self.position
+        (ra, dec) = self.pointing.getECoords(ac, alt, coords.Hours.now() if time is None else time)
+        (ra, dec) = (coords.Hours(ra), coords.Degrees(dec))
+        self.pos_e_received.emit(ra, dec)
+        logging.debug("PosE (host): (%s / %s)" % (ra, dec))
+
+    ## Indicates if the command of a future has been completed
+    #
+    # \param future Future of the command
+    # \return Boolean
+    def _succeeded(self, future):
+        return not future.cancelled() and future.exception() is None
+
+    ## Indicates if the movement of a future has ended, completed or aborted: the device has reported its position
+    #
+    # \param future Future of the movement
+    # \return Boolean
+    def _reached(self, future):
+        if future.cancelled():
+            return False
+        return future.exception() is None or isinstance(future.exception(), DeviceAborted)
         
     ## Initializes the execution thread
     #
+    #  Starts the engine reader and initializes the device, once it has finished booting (the board is
+    #  reset when the port is opened)
     def run(self):
+        self.engine.start()
+        self._ready.wait(self.timeout)
+        self.probe()
+        self.negotiate()
+        self.negotiate_baud()
+        self.link_changed.emit(self.protocol, self.serial.baudrate)
         self.init()
+
+    ## Checks if the device answers 'ping': then it also sends the heartbeat during the movements, and the engine
+    #  checks its liveness (see Device_Engine.supervised). The older firmware rejects it
+    #
+    # \return True if the device is supervised
+    def probe(self):
+        try:
+            self.engine.submit('ping', done='^done_ping$', timeout=self.timeout).result()
+        except DeviceError as e:
+            logging.info("No heartbeat from the device, only the deadlines of the commands apply (%s)" % e)
+        return self.engine.supervised
+
+    ## Switches the device and the connection to the fastest protocol supported by both
+    #
+    #  The binary protocol ('binm') is tried first (if enabled), then the pipelined ASCII mode ('pipe'). The
+    #  transport is replaced as soon as the device acknowledges the change, before writing any other command
+    #  (nothing is pipelined behind the change).
+    #
+    # \return Protocol in use: 'binary', 'pipe' or 'ascii'
+    def negotiate(self):
+        modes = [('binm', 'binary', lambda: Binary_Transport(self.serial)),
+                 ('pipe', 'pipe', lambda: Ascii_Transport(self.serial, param_prompt=False))]
+        if not self.binary:
+            modes = modes[1:]
+        for (name, protocol, transport) in modes:
+            switch = lambda line, transport=transport: self.engine.set_transport(transport())
+            future = self.engine.submit(name, done='^done_%s$' % name, timeout=self.timeout, on_done=switch,
+                                        pipeline=False)
+            try:
+                future.result()
+            except DeviceError as e:
+                logging.info("Protocol '%s' not available (%s)" % (protocol, e))
+                continue
+            self.protocol = protocol
+            break
+        logging.info("Using '%s' protocol" % self.protocol)
+        return self.protocol
+
+    ## Switches the connection to the fastest speed supported by both sides
+    #
+    #  Each speed (up to max_baud) is tried from the fastest one: the device acknowledges the 'baud' command at
+    #  the current speed, and then both sides change it and the link is verified with a test pattern. If the
+    #  verification fails both sides go back to the previous speed, and the next one is tried.
+    #
+    # \return Speed in use
+    def negotiate_baud(self):
+        for baud in BAUD_RATES:
+            if baud > self.max_baud or baud <= self.serial.baudrate:
+                continue
+            switch = lambda line, baud=baud: self._switch_baud(baud)
+            future = self.engine.submit('baud', (baud / BAUD_UNIT, ), done='^done_baud$', timeout=self.timeout,
+                                        on_done=switch, pipeline=False)
+            try:
+                future.result()
+                break
+            except DeviceLinkError as e:
+                logging.info("%d baud not available (%s)" % (baud, e))
+                # The device could have received a part of the test pattern as a command
+                try:
+                    self.resync().result()
+                except DeviceError as e:
+                    logging.error("Device not responding after the speed change (%s)" % e)
+                    break
+            except DeviceError as e:
+                logging.info("%d baud not available (%s)" % (baud, e))
+        logging.info("Link speed: %d baud" % self.serial.baudrate)
+        return self.serial.baudrate
+
+    ## Changes the speed of the port, and verifies the link with the test pattern (reader thread, without the engine
+    #  lock: submit and abort are not blocked while it waits for the device)
+    #
+    # \param baud New speed
+    def _switch_baud(self, baud):
+        previous = self.serial.baudrate
+        self.serial.baudrate = baud
+        self.serial.write(BAUD_PATTERN)
+        echo = b''
+        for i in range(int(2 * BAUD_TIMEOUT / POLL_INTERVAL)):
+            echo += self.serial.read(len(BAUD_PATTERN) - len(echo))
+            if len(echo) >= len(BAUD_PATTERN):
+                break
+        if echo != BAUD_PATTERN:
+            # Waiting for the device to go back to the previous speed
+            self.serial.baudrate = previous
+            sleep(BAUD_TIMEOUT)
+            self.serial.reset_input_buffer()
+            raise DeviceLinkError("Link verification failed at %d baud" % baud)
+
+    ## Drains the device back to the command prompt, after a timeout or a communication error
+    #
+    # \return Future, resolved when the device is synchronized
+    def resync(self):
+        logging.info("Resynchronizing device..")
+        return self.engine.resync()
     
     ## Sets a reference object in the device
     #
     #
     # \param id_rel Number of the reference object, 1, 2 or 3
-    # \param ra Right ascension
-    # \param dec Declination
-    # \param time Timestamp of the measure
+    # \param ra Right ascension (coords.Hours, or string "HhMmSs")
+    # \param dec Declination (coords.Degrees, or string "DºM'S''")
+    # \param time Local time of the measure (coords.Hours, or string "HhMmSs")
+    # \return Future
     def setRef(self, id_ref, ra, dec, time):
         setf = {1: 'set1', 2: 'set2', 3: 'set3'}
-        logging.debug(" %s(%s, %s, %s)" % (setf[id_ref], ra, dec, time))
-        self.serial.write(setf[id_ref])
-        if(self.serial.readline().rstrip() == 'float'):
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(ra)) )
-            self.serial.write( coords.rad_2_radStr(coords.degStr_2_rad(dec)) )
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(time)) )
-            self.sread(wait=5)
+        params = (coords.Hours.of(ra), coords.Degrees.of(dec), coords.Hours.of(time))
+        logging.debug(" %s(%s, %s, %s)" % ((setf[id_ref], ) + params))
+        future = self.engine.submit(setf[id_ref], params, timeout=self.timeout)
+        if self.pointing is not None:
+            # The device takes its current position as the horizontal coordinates of the object
+            future.add_done_callback(lambda f: self._succeeded(f) and self.position is not None and
+                                     self.pointing.setRef(id_ref, *(params + self.position)))
+        return future
         
     ## Points the device toward the given equatorial coordinates
     #
-    # \param ra Right ascension
-    # \param dec Declination
-    # \param time Timestamp of the measure
-    def goto(self, ra, dec, time):
-        logging.debug("(%s, %s, %s)" % (ra, dec, time))
-        self.serial.write('goto')
-        if(self.serial.readline().rstrip() == 'float'):
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(ra)) )
-            self.serial.write( coords.rad_2_radStr(coords.degStr_2_rad(dec)) )
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(time)) )
-            self.sread(wait=10)
+    #  In offload mode the horizontal coordinates are calculated by the host (LaserDev.pointing), and the device
+    #  only moves to them ('move'). The equatorial coordinates of the position reported by the device (where the
+    #  motors stopped, also if the movement is aborted) are calculated by the host too.
+    #
+    #  If the motors would not move (see _redundant), nothing is sent and the future is already resolved.
+    #
+    # \param ra Right ascension (coords.Hours, or string "HhMmSs")
+    # \param dec Declination (coords.Degrees, or string "DºM'S''")
+    # \param time Local time of the measure (coords.Hours, or string "HhMmSs")
+    # \param offload Overrides the offload mode for this goto (for example, the corrections of the tracking)
+    # \return Future
+    def goto(self, ra, dec, time, offload=None):
+        params = (coords.Hours.of(ra), coords.Degrees.of(dec), coords.Hours.of(time))
+        logging.debug("(%s, %s, %s)" % params)
+        if self._offloaded(offload):
+            (ac, alt) = self.pointing.getHCoords(*params)
+            target = (coords.Degrees(ac), coords.Degrees(alt))
+            (future, steps) = self._move(target, params[2], 'goto')
+            if future is not None:
+                future.add_done_callback(lambda f: self._report_equatorial(f, time=params[2]))
+                return future
+        else:
+            steps = None
+            if self.pointing is not None and self.pointing.canTransform():
+                # The position the device will calculate, to know if it moves the motors
+                steps = self.deviceSteps(*self.pointing.getHCoords(*params))
+            if not self._redundant('goto', steps):
+                future = self.engine.submit('goto', params, timeout=self._motion_timeout(), pipeline=False,
+                                            abortable=True)
+                return self._sent(future, steps)
+        future = self._suppressed()
+        # The device stays at its position: the equatorial coordinates at the time of the goto
+        self._report_equatorial(future, time=params[2])
+        return future
         
     ## Points the device toward the given horizontal coordinates
     #
-    # \param ac Azimut
-    # \param alt Altitude
+    #  If the motors would not move (see _redundant), nothing is sent and the future is already resolved.
+    #
+    # \param ac Azimut (coords.Degrees, or string "DºM'S''")
+    # \param alt Altitude (coords.Degrees, or string "DºM'S''")
+    # \return Future
     def move(self, ac, alt):
         logging.debug("(%s, %s)" % (ac, alt))
-        self.serial.write('move')
-        if(self.serial.readline().rstrip() == 'float'):
-            self.serial.write( coords.rad_2_radStr(6.283185 - coords.degStr_2_rad(ac)) )
-            self.serial.write( coords.rad_2_radStr(coords.degStr_2_rad(alt)) )
-            self.serial.write( coords.rad_2_radStr(coords.hourStr_2_rad(strftime("%Hh%Mm%Ss", localtime()))) )
-            self.sread(wait=10)
+        params = (6.283185 - coords.Degrees.of(ac), coords.Degrees.of(alt), coords.Hours.now())
+        (future, steps) = self._move(params[:2], params[2])
+        if future is None:
+            return self._suppressed()
+        if steps or self._offloaded():
+            # The device does not report the equatorial coordinates of the position
+            future.add_done_callback(lambda f: self._report_equatorial(f, time=params[2]))
+        return future
             
     ## Starts the accelerated movement along the X axis, in the given direction
     #
+    #  The returned future is resolved when the movement ends (see stop())
+    #
     # \param signDir Direction of movement: 1 means clockwise direction, 0 means counter clockwise
+    # \return Future
     def movx(self, signDir):
-        self.serial.write('movx')
-        self.serial.write(signDir)
+        future = self.engine.submit('movx', extra=signDir.encode('ascii'), done='^done_(movx|end)$', pipeline=False,
+                                    abortable=True)
+        self._sent(future, None)
+        if self._offloaded():
+            future.add_done_callback(self._report_equatorial)
+        return future
     
     ## Starts the accelerated movement along the Y axis, in the given direction
     #
+    #  The returned future is resolved when the movement ends (see stop())
+    #
     # \param signDir Direction of movement. 1 means upwards, 0 means downwards
+    # \return Future
     def movy(self, signDir):
-        self.serial.write('movy')
-        self.serial.write(signDir)
+        future = self.engine.submit('movy', extra=signDir.encode('ascii'), done='^done_(movy|end)$', pipeline=False,
+                                    abortable=True)
+        self._sent(future, None)
+        if self._offloaded():
+            future.add_done_callback(self._report_equatorial)
+        return future
 
-    ## Stops the accelerated movement on both axes
+    ## Stops the movement on both axes
+    #
+    #  Urgent: if a movement (goto, move, step, movx, movy) is in flight, it is aborted immediately (its future
+    #  fails with DeviceAborted) and the returned future is resolved when the device reports the end of the
+    #  movement. Otherwise 'stop' is sent ahead of the queued commands. In both cases the queued movements are
+    #  dropped.
     #
+    # \return Future
     def stop(self):
-        self.serial.write('stop')
-        resp = self.sread(expect = '^done_.*')
-        if resp == 'done_end':# End sensor reached ..
-            self.sread()#.. 
-            self.sread()#.. so we expect an extra cmd
-        else:
-            self.sread()
+        future = self.engine.abort()
+        if future is not None:
+            return future
+        return self.engine.submit('stop', done='^done_stop$', timeout=self.timeout, priority=PRIORITY_URGENT,
+                                  abort_motion=True)
+
+    ## Emergency stop: aborts any movement and turns the laser off
+    #
+    # \return Future of the laser off command
+    def emergency(self):
+        self.stop()
+        return self.laserOff(abort_motion=True)
         
     ## Turn the laser On
     #
+    # \return Future
     def laserOn(self):
-        self.serial.write('laon')
-        self.sread(wait=3)
+        return self.engine.submit('laon', timeout=self.timeout)
     
     ## Turn the laser Off
     #
-    def laserOff(self):
-        self.serial.write('loff')
-        self.sread(wait=3)
+    #  Urgent: it is sent ahead of the queued commands. The device reads it at the end of the goto, move or step
+    #  in flight, if any (within the deadline of the movement), unless the movement is aborted. The movements
+    #  without end (movx, movy) are always aborted
+    #
+    # \param abort_motion Aborts the movement in flight first (see emergency())
+    # \return Future
+    def laserOff(self, abort_motion=False):
+        return self.engine.submit('loff', timeout=self.timeout, priority=PRIORITY_URGENT, abort_motion=abort_motion)
+
+    ## Closes the device connection
+    #
+    def close(self):
+        self.engine.close()
     
 # Function to scan available serial ports...
 #
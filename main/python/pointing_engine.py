@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy
+
+## Relationship between the solar time (M) and the sidereal time (S): S = M * K (see CoordsLib)
+K = 1.002737908
+
+## \brief Coordinates transformations of the device (CoordsLib), computed on the host.
+#
+#  Toshimi Taki's matrix method, as the firmware does it: the transformation matrix is obtained from two or
+#  three reference objects (equatorial coordinates and time, and the horizontal position of the device), and
+#  then converts between both coordinate systems. The same operations as CoordsLib, in double precision, and on
+#  whole arrays of coordinates in a single call.
+#
+#  All the angles are in radians, and the times are the local time of the day in radians (as the parameters of
+#  the device commands, see coords.Hours). It is built with the reference objects sent to the device:
+#
+#    engine = PointingEngine()
+#    engine.setRef(1, ra1, dec1, t1, ac1, alt1)
+#    engine.setRef(2, ra2, dec2, t2, ac2, alt2)
+#    (ac, alt) = engine.getHCoords(ra_array, dec_array, t_array)
+#
+class PointingEngine(object):
+
+    ## Class constructor
+    #
+    # \param t0 Initial observation time (see setTime)
+    def __init__(self, t0=0.0):
+        self.t0 = t0
+        ## @var T
+        # Transformation matrix, from equatorial to horizontal vectors (zero until configured, as in CoordsLib)
+        self.T = numpy.zeros((3, 3))
+        ## @var iT
+        # Inverse transformation matrix, from horizontal to equatorial vectors
+        self.iT = numpy.zeros((3, 3))
+        self._lmn = [None, None, None]
+        self._LMN = [None, None, None]
+        self._isSetR3 = False
+
+    ## Vector cosines of equatorial coordinates
+    #
+    # \param ra Right ascension
+    # \param dec Declination
+    # \param t Time of the observation
+    # \return Array (3, ...)
+    def _setEVC(self, ra, dec, t):
+        h = ra - K*(t - self.t0)
+        return numpy.array([numpy.cos(dec)*numpy.cos(h), numpy.cos(dec)*numpy.sin(h), numpy.sin(dec)])
+
+    ## Vector cosines of horizontal coordinates
+    #
+    # \param ac Azimuth
+    # \param alt Altitude
+    # \return Array (3, ...)
+    def _setHVC(self, ac, alt):
+        return numpy.array([numpy.cos(alt)*numpy.cos(ac), numpy.cos(alt)*numpy.sin(ac), numpy.sin(alt)])
+
+    ## Inverse of a 3x3 matrix, from its adjugate (infinite or NaN values if it is singular, as in CoordsLib)
+    #
+    # \param m Matrix
+    # \return Inverse matrix
+    @staticmethod
+    def _inv(m):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            adj = numpy.array([numpy.cross(m[1], m[2]), numpy.cross(m[2], m[0]), numpy.cross(m[0], m[1])]).T
+            return adj / numpy.dot(m[0], numpy.cross(m[1], m[2]))
+
+    ## Sets the initial observation time (command 'time')
+    #
+    # \param t0 Time
+    def setTime(self, t0):
+        self.t0 = t0
+
+    ## Sets a reference object (commands 'set1', 'set2' and 'set3')
+    #
+    #  Setting the first or the second one discards the third one (it is calculated again, see autoRef_3)
+    #
+    # \param id_ref Number of the reference object, 1, 2 or 3
+    # \param ra Right ascension
+    # \param dec Declination
+    # \param t Time of the observation
+    # \param ac Azimuth of the device (X axis)
+    # \param alt Altitude of the device (Y axis)
+    def setRef(self, id_ref, ra, dec, t, ac, alt):
+        i = id_ref - 1
+        self._LMN[i] = self._setEVC(ra, dec, t)
+        self._lmn[i] = self._setHVC(ac, alt)
+        self._isSetR3 = (id_ref == 3)
+        if self.isConfigured():
+            self._setT()
+
+    ## Indicates if the three reference objects have been established
+    #
+    # \return Boolean
+    def isConfigured(self):
+        return self._lmn[0] is not None and self._lmn[1] is not None and self._isSetR3
+
+    ## Indicates if the transformations can be calculated: the two first reference objects are established (the
+    #  third one is calculated from them if it is not set)
+    #
+    # \return Boolean
+    def canTransform(self):
+        return self._lmn[0] is not None and self._lmn[1] is not None
+
+    ## Third reference object calculated from the cross product of the two first ones
+    #
+    def autoRef_3(self):
+        if self._lmn[0] is None or self._lmn[1] is None:
+            return
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            lmn3 = numpy.cross(self._lmn[0], self._lmn[1])
+            self._lmn[2] = lmn3 / numpy.sqrt(numpy.dot(lmn3, lmn3))
+            LMN3 = numpy.cross(self._LMN[0], self._LMN[1])
+            self._LMN[2] = LMN3 / numpy.sqrt(numpy.dot(LMN3, LMN3))
+        self._isSetR3 = True
+        self._setT()
+
+    ## Sets the transformation matrix and its inverse
+    #
+    def _setT(self):
+        self.T = numpy.dot(numpy.array(self._lmn).T, self._inv(numpy.array(self._LMN).T))
+        self.iT = self._inv(self.T)
+
+    ## Horizontal coordinates of equatorial ones (see CoordsLib::getHCoords)
+    #
+    #  The third reference object is calculated if it is not established
+    #
+    # \param ra Right ascension (number or array)
+    # \param dec Declination (number or array)
+    # \param t Time of the observation (number or array)
+    # \return List with (azimuth, altitude), arrays with the shape of the parameters
+    def getHCoords(self, ra, dec, t):
+        evc = self._setEVC(*numpy.broadcast_arrays(ra, dec, t))
+        if not self._isSetR3:
+            self.autoRef_3()
+        hvc = numpy.tensordot(self.T, evc, axes=1)
+        with numpy.errstate(invalid='ignore'):
+            return (numpy.arctan2(hvc[1], hvc[0]), numpy.arcsin(hvc[2]))
+
+    ## Equatorial coordinates of horizontal ones (see CoordsLib::getECoords)
+    #
+    #  The third reference object is calculated if it is not established
+    #
+    # \param ac Azimuth (number or array)
+    # \param alt Altitude (number or array)
+    # \param t Time of the observation (number or array)
+    # \return List with (right ascension, declination), arrays with the shape of the parameters
+    def getECoords(self, ac, alt, t):
+        (ac, alt, t) = numpy.broadcast_arrays(ac, alt, t)
+        hvc = self._setHVC(ac, alt)
+        if not self._isSetR3:
+            self.autoRef_3()
+        evc = numpy.tensordot(self.iT, hvc, axes=1)
+        with numpy.errstate(invalid='ignore'):
+            return (numpy.arctan2(evc[1], evc[0]) + K*(t - self.t0), numpy.arcsin(evc[2]))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import struct
+from time import time
+
+# \brief Codec for the 'Stellarium Telescope Protocol'.
+#
+#  Messages are described by precompiled fixed layouts (struct.Struct), so decoding reads the fields
+#  straight from the receive buffer and encoding writes them into a caller-provided buffer, without
+#  building intermediate objects for each message.
+#
+#  Client -> server (goto), 20 bytes:
+#   LENGTH (uint16) TYPE (uint16) TIME (int64) RA (uint32) DEC (int32)
+#
+#  Server -> client (current position), 24 bytes:
+#   LENGTH (uint16) TYPE (uint16) TIME (int64) RA (uint32) DEC (int32) STATUS (int32)
+#
+#  All the fields are little endian. RA goes from 0 to 2^32 (0h..24h) and DEC from -2^30 to 2^30 (-90º..90º).
+
+
+## Type of the goto message (client -> server)
+MSG_GOTO = 0
+
+## Type of the current position message (server -> client)
+MSG_CURRENT_POSITION = 0
+
+## Layout of the common header: length and type
+HEADER = struct.Struct('<HH')
+
+## Layout of the goto message
+GOTO = struct.Struct('<HHqIi')
+
+## Layout of the current position message
+CURRENT_POSITION = struct.Struct('<HHqIii')
+
+## Size of the header in bytes
+HEADER_SIZE = HEADER.size
+
+## Size of the goto message in bytes
+GOTO_SIZE = GOTO.size
+
+## Size of the current position message in bytes
+CURRENT_POSITION_SIZE = CURRENT_POSITION.size
+
+_unpack_header = HEADER.unpack_from
+_unpack_goto = GOTO.unpack_from
+_pack_position = CURRENT_POSITION.pack_into
+
+
+## Current timestamp in the protocol format
+#
+# \return Microseconds since epoch (int)
+def timestamp():
+    return int(time() * 1000000)
+
+## Reads the header of the message placed at the given offset
+#
+# \param buf Buffer (bytes, bytearray or memoryview)
+# \param offset Position of the message in the buffer
+# \return List with (length, type)
+def decode_header(buf, offset=0):
+    return _unpack_header(buf, offset)
+
+## Decodes the goto message placed at the given offset
+#
+# \param buf Buffer (bytes, bytearray or memoryview) with at least GOTO_SIZE bytes from offset
+# \param offset Position of the message in the buffer
+# \return List with (time, ra, dec) => (microseconds, uint32, int32)
+def decode_goto(buf, offset=0):
+    (msize, mtype, mtime, ra, dec) = _unpack_goto(buf, offset)
+    return (mtime, ra, dec)
+
+## Encodes a current position message into the given buffer
+#
+# \param buf Writable buffer (bytearray or memoryview) with at least CURRENT_POSITION_SIZE bytes from offset
+# \param ra Right ascension in the protocol format (uint32)
+# \param dec Declination in the protocol format (int32)
+# \param mtime Timestamp in microseconds. By default is the current time
+# \param status Status of the telescope, 0 means OK
+# \param offset Position of the message in the buffer
+# \return Number of bytes written
+def encode_position_into(buf, ra, dec, mtime=None, status=0, offset=0):
+    if mtime is None:
+        mtime = timestamp()
+    _pack_position(buf, offset, CURRENT_POSITION_SIZE, MSG_CURRENT_POSITION, mtime, ra & 0xffffffff, dec, status)
+    return CURRENT_POSITION_SIZE
+
+## Allocates a buffer for current position messages
+#
+# \param count Number of messages the buffer can hold
+# \return bytearray
+def position_buffer(count=1):
+    return bytearray(CURRENT_POSITION_SIZE * count)
+
+
+## \brief Reassembles the protocol messages from the byte stream of a connection.
+#
+#  TCP does not keep the message boundaries: a single read can bring several messages, or only a part of
+#  one. The received bytes are stored in a ring buffer, and the length prefix of each message is used to
+#  extract every complete message, keeping the trailing partial bytes for the next read.
+#
+#  Usage:
+#
+#    n = sock.recv_into(framer.recv_buffer())
+#    framer.commit(n)
+#    batch = framer.messages()
+#
+class Message_Framer(object):
+    
+    ## Class constructor
+    #
+    # \param capacity Size of the ring buffer in bytes (power of two)
+    def __init__(self, capacity=4096):
+        if capacity & (capacity - 1):
+            raise ValueError("Capacity must be a power of two: %d" % capacity)
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._scratch = bytearray(capacity)
+        self._read = 0
+        self._write = 0
+        ## Number of discarded bytes (unknown or malformed messages)
+        self.discarded = 0
+        
+    ## Number of bytes waiting to be processed
+    #
+    # \return Integer
+    def pending(self):
+        return self._write - self._read
+        
+    ## Returns the free region of the ring buffer where the next read must be written
+    #
+    # \return Writable memoryview (empty if the buffer is full)
+    def recv_buffer(self):
+        w = self._write & self._mask
+        free = self._capacity - (self._write - self._read)
+        return self._view[w:w + min(free, self._capacity - w)]
+        
+    ## Marks as received the bytes written in the region returned by recv_buffer()
+    #
+    # \param nbytes Number of bytes written
+    def commit(self, nbytes):
+        self._write += nbytes
+        
+    ## Copies data into the ring buffer (for callers that do not read with recv_into)
+    #
+    # \param data Received bytes
+    # \return Number of bytes stored (less than len(data) if the buffer is full)
+    def feed(self, data):
+        data = memoryview(data)
+        stored = 0
+        while stored < len(data):
+            region = self.recv_buffer()
+            n = min(len(region), len(data) - stored)
+            if n == 0:
+                break
+            region[:n] = data[stored:stored + n]
+            self.commit(n)
+            stored += n
+        return stored
+        
+    ## Contiguous view of n bytes starting at the given stream position
+    #
+    #  Bytes that wrap around the end of the ring are copied into a scratch buffer
+    #
+    # \return List with (buffer, offset)
+    def _contiguous(self, pos, n):
+        p = pos & self._mask
+        if p + n <= self._capacity:
+            return (self._buf, p)
+        first = self._capacity - p
+        self._scratch[:first] = self._view[p:]
+        self._scratch[first:n] = self._view[:n - first]
+        return (self._scratch, 0)
+        
+    ## Extracts every complete message from the buffer
+    #
+    #  Goto messages are decoded, any other type is skipped by using its length prefix.
+    #
+    # \return List of decoded goto messages [(time, ra, dec), ...]
+    def messages(self):
+        batch = []
+        while self._write - self._read >= HEADER_SIZE:
+            (buf, off) = self._contiguous(self._read, HEADER_SIZE)
+            (msize, mtype) = _unpack_header(buf, off)
+            if msize < HEADER_SIZE or msize > self._capacity:
+                # We cannot find the next boundary, so the stream is resynchronized on the next read
+                self.discarded += self._write - self._read
+                self._read = self._write
+                break
+            if self._write - self._read < msize:
+                break
+            if mtype == MSG_GOTO and msize >= GOTO_SIZE:
+                (buf, off) = self._contiguous(self._read, GOTO_SIZE)
+                batch.append(decode_goto(buf, off))
+            else:
+                self.discarded += msize
+            self._read += msize
+        return batch
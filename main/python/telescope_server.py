@@ -3,11 +3,10 @@
 
 import logging
 from PyQt4 import QtCore
-from threading import Thread
-import asyncore, socket
-from time import time, localtime
-from bitstring import BitArray, BitStream, ConstBitStream # http://code.google.com/p/python-bitstring/
+import asyncio, socket
+from collections import deque
 import coords
+import stellarium_protocol as protocol
 
 
 logging.basicConfig(level=logging.DEBUG, format="%(filename)s: %(funcName)s - %(levelname)s: %(message)s")
@@ -15,177 +14,400 @@ logging.basicConfig(level=logging.DEBUG, format="%(filename)s: %(funcName)s - %(
 
 ## \brief Implementation of the server side connection for 'Stellarium Telescope Protocol'
 #
-#  Manages the execution thread to the server side connection with Stellarium
-class Telescope_Channel(QtCore.QThread, asyncore.dispatcher):
-    ## @var stell_pos_recv
-    # It emits when equatorial coordinates are received from client (Stellarium)
-    stell_pos_recv = QtCore.pyqtSignal(str, str, str) #Ra, Dec, Time
-    
+#  One lightweight protocol instance per connected client. Runs on the event loop of the Telescope_Server,
+#  and reports the received messages and the connection lifecycle to it.
+#
+#  Writes never block: while the socket does not accept more data, outgoing messages wait in a bounded
+#  queue where a new position replaces the pending one (latest position wins). A client that stays
+#  stalled longer than stall_timeout is disconnected.
+class Telescope_Channel(asyncio.BufferedProtocol):
+
     ## Class constructor
     #
-    # \param conn_sock Connection socket
-    def __init__(self, conn_sock):
-        self.is_writable = False
-        self.buffer = ''
-        asyncore.dispatcher.__init__(self, conn_sock)
-        QtCore.QThread.__init__(self, None)
-        
-    ## Indicates the socket is readable
-    #
-    # \return Boolean True/False
-    def readable(self):
-        return True
-    
-    ## Indicates the socket is writable
-    #
-    # \return Boolean True/False
-    def writable(self):
-        return self.is_writable
-        
+    # \param server Telescope_Server instance that owns the connection
+    # \param max_queue Maximum number of messages waiting while the socket is not writable
+    # \param stall_timeout Seconds a client can stay not writable before being disconnected
+    # \param high_water Bytes buffered in the transport before considering the socket not writable
+    def __init__(self, server, max_queue=8, stall_timeout=5.0, high_water=1024):
+        self.server = server
+        self.transport = None
+        self.peer = None
+        self.framer = protocol.Message_Framer()
+        self.stall_timeout = stall_timeout
+        self.high_water = high_water
+        self._queue = deque(maxlen=max_queue)
+        self._paused = False
+        self._paused_since = 0.0
+        ## @var sent
+        # Number of messages written to the socket
+        self.sent = 0
+        ## @var coalesced
+        # Number of positions replaced by a newer one before being sent
+        self.coalesced = 0
+        ## @var dropped
+        # Number of messages discarded (full queue or disconnected client)
+        self.dropped = 0
+
+    ## Connection handler
+    #
+    # \param transport Transport of the accepted connection
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        transport.set_write_buffer_limits(high=self.high_water)
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.channel_opened(self)
+
     ## Close connection handler
     #
-    def handle_close(self):
-        logging.debug("Disconnected")
-        self.close()
-    
-    ## Reading socket handler
-    #    
-    # Reads and processes client data, and throws the proper signal with coordinates as parameters
-    def handle_read(self):
-        #format: 20 bytes in total. Size: intle:16
-        #Incomming messages comes with 160 bytes..
-        data0 = self.recv(160);
-        if data0:            
-            data = ConstBitStream(bytes=data0, length=160)
-            #print "All: %s" % data.bin
-            
-            msize = data.read('intle:16')
-            mtype = data.read('intle:16')
-            mtime = data.read('intle:64')
-            
-            # RA: 
-            ant_pos = data.bitpos
-            ra = data.read('hex:32')
-            data.bitpos = ant_pos
-            ra_uint = data.read('uintle:32')
-            
-            # DEC:
-            ant_pos = data.bitpos
-            dec = data.read('hex:32')
-            data.bitpos = ant_pos
-            dec_int = data.read('intle:32')
-            
-            #______ Testing:
-            # Sends back to Stellarium the received coordinates, in order to update the field of view indicator
-            (sra, sdec, stime) = coords.eCoords2str(float("%f" % ra_uint), float("%f" % dec_int), float("%f" %  mtime))
-            self.act_pos(coords.hourStr_2_rad(sra), coords.degStr_2_rad(sdec))
-            #______ End Testing
-            
-            # Emits the signal with received equatorial coordinates (for use in external Qt Gui..)
-            self.stell_pos_recv.emit("%f" % ra_uint, "%f" % dec_int, "%f" %  mtime)
-    
-    
-    ## Updates the field of view indicator in Stellarium
-    #
-    # \param ra Right ascension in signed string format
-    # \param dec Declination in signed string format
-    def act_pos(self, ra, dec):
-        (ra_p, dec_p) = coords.rad_2_stellarium_protocol(float(ra), float(dec))
-        
-        times = 10 #Number of times that Stellarium expects to receive new coords //Absolutly empiric..
-        for i in range(times):
-            self.move(ra_p, dec_p)
-    
-    ## Sends to Stellarium equatorial coordinates
-    #
-    #  Receives the coordinates in float format. Obtains the timestamp from local time
-    #
-    # \param ra Ascensión recta.
-    # \param dec Declinación.
-    def move(self, ra, dec):
-        msize = '0x1800'
-        mtype = '0x0000'
-        aux_format_str = 'int:64=%r' % time()
-        localtime = ConstBitStream(aux_format_str.replace('.', ''))
-        
-        sdata = ConstBitStream(msize) + ConstBitStream(mtype)
-        sdata += ConstBitStream(intle=localtime.intle, length=64) + ConstBitStream(uintle=ra, length=32)
-        sdata += ConstBitStream(intle=dec, length=32) + ConstBitStream(intle=0, length=32)
-
-        self.buffer = sdata
-        self.is_writable = True
-        self.handle_write()
-            
-    ## Transmission handler
-    #
-    def handle_write(self):
-        self.send(self.buffer.bytes)
-        self.is_writable = False
-    
+    # \param exc Exception that closed the connection, or None on a regular close
+    def connection_lost(self, exc):
+        self.transport = None
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self.server.channel_closed(self, exc)
+
+    ## Returns the region of the framer where the received data must be written
+    #
+    # \param sizehint Size suggested by the event loop (ignored)
+    def get_buffer(self, sizehint):
+        return self.framer.recv_buffer()
+
+    ## Reading handler
+    #
+    # Processes every complete message received
+    #
+    # \param nbytes Number of bytes written in the buffer returned by get_buffer()
+    def buffer_updated(self, nbytes):
+        self.framer.commit(nbytes)
+        batch = self.framer.messages()
+        if batch:
+            self.handle_messages(batch)
+
+    ## Processes a batch of received goto messages
+    #
+    # \param batch List of decoded messages [(time, ra, dec), ...]
+    def handle_messages(self, batch):
+        self.server.messages_received(self, batch)
+
+    ## Sends already encoded data to Stellarium
+    #
+    #  If the socket is not writable the data is queued. A position replaces the last queued position.
+    #
+    # \param data Bytes with one or more encoded messages
+    # \param coalesce The data is a position that can be replaced by a newer one
+    def send(self, data, coalesce=True):
+        if self.transport is None or self.transport.is_closing():
+            self.dropped += 1
+            return
+        if not self._paused:
+            self.transport.write(data)
+            self.sent += 1
+            return
+        if self.server.loop.time() - self._paused_since > self.stall_timeout:
+            logging.info("Slow client %s disconnected (stalled for more than %.1fs)" % (self.peer, self.stall_timeout))
+            self.dropped += 1
+            self.transport.abort()
+            return
+        if coalesce and self._queue and self._queue[-1][1]:
+            self._queue[-1] = (data, coalesce)
+            self.coalesced += 1
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append((data, coalesce))
+
+    ## The transport buffer is over the high water mark
+    #
+    def pause_writing(self):
+        self._paused = True
+        self._paused_since = self.server.loop.time()
+
+    ## The socket is writable again: sends the queued messages
+    #
+    def resume_writing(self):
+        self._paused = False
+        while self._queue and not self._paused and self.transport is not None:
+            (data, coalesce) = self._queue.popleft()
+            self.transport.write(data)
+            self.sent += 1
+
+    ## Bytes waiting to be sent to the client
+    #
+    # \return Integer
+    def queue_depth(self):
+        queued = sum(len(data) for (data, coalesce) in self._queue)
+        if self.transport is None:
+            return queued
+        return queued + self.transport.get_write_buffer_size()
+
+    ## Counters of the outgoing messages
+    #
+    # \return Dictionary with the sent, coalesced, dropped and queued messages
+    def stats(self):
+        return {'sent': self.sent, 'coalesced': self.coalesced, 'dropped': self.dropped, 'queued': len(self._queue)}
+
+    ## Closes the connection
+    #
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+## \brief Sends the current position messages to every connected client
+#
+#  Each position is encoded once, and the same bytes are sent to all the channels. Unchanged positions are
+#  skipped, and the last position is periodically refreshed (with a new timestamp) so that Stellarium keeps
+#  its field of view indicator updated.
+class Position_Broadcaster(object):
+
+    ## Class constructor
+    #
+    # \param channels Set of connected channels (Telescope_Channel instances)
+    # \param repeat Number of copies of each new position sent in a row
+    # \param refresh Frequency (Hz) of the periodic refresh of the last position, 0 disables it
+    def __init__(self, channels, repeat=1, refresh=2.0):
+        self.channels = channels
+        self.repeat = repeat
+        self.refresh = refresh
+        self.loop = None
+        self.buffer = protocol.position_buffer(repeat)
+        self.position = None
+        self._timer = None
+        ## @var sent
+        # Number of encoded messages sent
+        self.sent = 0
+        ## @var skipped
+        # Number of positions skipped because they did not change
+        self.skipped = 0
+
+    ## Starts the periodic refresh on the given event loop
+    #
+    # \param loop Event loop
+    def start(self, loop):
+        self.loop = loop
+        self._schedule()
+
+    ## Stops the periodic refresh
+    #
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.loop = None
+
+    ## Sends a new position to every client (event loop side)
+    #
+    # \param ra Right ascension in the protocol format (uint32)
+    # \param dec Declination in the protocol format (int32)
+    def publish(self, ra, dec):
+        if self.position == (ra, dec):
+            self.skipped += 1
+            return
+        self.position = (ra, dec)
+        self._broadcast(self.repeat)
+        # The refresh period starts again from the last sent position
+        self._schedule()
+
+    ## Sends the last position to a client just connected
+    #
+    # \param channel Telescope_Channel instance
+    def attach(self, channel):
+        if self.position is not None:
+            protocol.encode_position_into(self.buffer, self.position[0], self.position[1])
+            channel.send(bytes(self.buffer[:protocol.CURRENT_POSITION_SIZE]))
+
+    ## Bytes waiting to be sent on each connection
+    #
+    # \return Dictionary {peer: bytes}
+    def queue_depths(self):
+        return dict((channel.peer, channel.queue_depth()) for channel in self.channels)
+
+    ## Encodes the current position and sends it to every channel
+    #
+    # \param copies Number of copies of the message
+    def _broadcast(self, copies):
+        mtime = protocol.timestamp()
+        for i in range(copies):
+            protocol.encode_position_into(self.buffer, self.position[0], self.position[1], mtime,
+                                          offset=i*protocol.CURRENT_POSITION_SIZE)
+        data = bytes(self.buffer[:copies*protocol.CURRENT_POSITION_SIZE])
+        for channel in list(self.channels):
+            channel.send(data)
+        self.sent += 1
+
+    ## Programs the next refresh
+    #
+    def _schedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.loop is not None and self.refresh > 0:
+            self._timer = self.loop.call_later(1.0/self.refresh, self._refresh)
+
+    ## Periodic refresh of the last position
+    #
+    def _refresh(self):
+        self._timer = None
+        if self.position is not None and self.channels:
+            self._broadcast(1)
+        self._schedule()
+
 
 ## \brief Implementation of the server side communications for 'Stellarium Telescope Protocol'.
 #
-#  Each connection request generate an independent execution thread as instance of Telescope_Channel
-class Telescope_Server(QtCore.QThread, asyncore.dispatcher):
+#  Runs an asyncio event loop in its own thread (or on a given loop, see listen()), serving any number of
+#  concurrent clients. Each connection is handled by a Telescope_Channel instance.
+class Telescope_Server(QtCore.QThread):
     # @var stell_pos_recv
-    # Proxy signal to the same name signal of the Telescope_Channel instance
-    stell_pos_recv = QtCore.pyqtSignal(str, str, str) #Ra, Dec, Time
-    
+    # It emits when equatorial coordinates are received from any client (Stellarium)
+    stell_pos_recv = QtCore.pyqtSignal(object, object, object) #Ra (coords.Hours), Dec (coords.Degrees), Time (us)
+
     ## Class constructor
     #
     # \param port Port to listen on
     # \param pos-signal Signal that will receive the coordinates to send to Stellarium
-    def __init__(self, port=10001, pos_signal=None):
-        asyncore.dispatcher.__init__(self, None)
+    # \param host Address to listen on
+    # \param repeat Number of copies of each new position sent to Stellarium
+    # \param refresh Frequency (Hz) of the periodic refresh of the position in Stellarium
+    # \param max_queue Maximum number of messages queued for a slow client
+    # \param stall_timeout Seconds a client can stay stalled before being disconnected
+    def __init__(self, port=10001, pos_signal=None, host='localhost', repeat=1, refresh=2.0,
+                 max_queue=8, stall_timeout=5.0):
         QtCore.QThread.__init__(self, None)
-        self.tel = None
+        self.host = host
         self.port = port
+        self.max_queue = max_queue
+        self.stall_timeout = stall_timeout
+        self.loop = None
+        self.server = None
+        self._own_loop = False
+        ## @var channels
+        # Connected clients (Telescope_Channel instances)
+        self.channels = set()
+        ## @var broadcaster
+        # Sends the position updates to the clients
+        self.broadcaster = Position_Broadcaster(self.channels, repeat, refresh)
         if pos_signal != None:
             pos_signal.connect(self.proxy_signal_sent)
-        
+
+    ## Opens the listening socket on the given event loop
+    #
+    #  Allows to serve the clients on an already running loop, instead of the thread one
+    #
+    # \param loop Event loop. By default is the running loop
+    async def listen(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.server = await self.loop.create_server(self._new_channel, self.host, self.port,
+                                                    reuse_address=True)
+        self.broadcaster.start(self.loop)
+        logging.info(self.__class__.__name__+" listening on %s:%d" % (self.host, self.port))
+
+    ## Factory of the client connections
+    #
+    # \return Telescope_Channel instance
+    def _new_channel(self):
+        return Telescope_Channel(self, self.max_queue, self.stall_timeout)
+
+    ## Counters of the outgoing messages of every client
+    #
+    # \return Dictionary {peer: {'sent', 'coalesced', 'dropped', 'queued'}}
+    def stats(self):
+        return dict((channel.peer, channel.stats()) for channel in self.channels)
+
     ## Starts thread
     #
-    # Sets the socket to listen on
+    # Runs the event loop until close_socket() is called
     def run(self):
         logging.info(self.__class__.__name__+" is running...")
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind(('localhost', self.port))
-        self.listen(1)
-        self.connected = False
-        asyncore.loop()
-        
-    ## Handles incomming connection
-    #
-    # Stats a new thread as Telescope_Channel instance, passing it the opened socket as parameter
-    def handle_accept(self):
-        self.conn, self.addr = self.accept()
-        logging.debug('Connected: %s', self.addr)
-        self.connected = True
-        self.tel = Telescope_Channel(self.conn)
-        self.tel.stell_pos_recv.connect(self.proxy_signal_recv)
-        
-    ## Proxy signal for receive and throw again the Telescope_Channel signal
-    #
-    # \param Right ascension
-    # \param dec Declination
-    # \param mtime Timestamp
-    def proxy_signal_recv(self, ra, dec, mtime):
-        self.stell_pos_recv.emit(ra, dec, mtime)
-        
-    ## Proxy signal for receive coordinates and send them to the Telescope_Channel threads
-    #
-    # \ra Right ascension
-    # \dec Declination
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._own_loop = True
+        try:
+            loop.run_until_complete(self.listen(loop))
+            loop.run_forever()
+        finally:
+            self._close_all()
+            # Lets the transports run their connection_lost callbacks
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+            self.loop = None
+            self._own_loop = False
+
+    ## Registers a new connection
+    #
+    # \param channel Telescope_Channel instance
+    def channel_opened(self, channel):
+        self.channels.add(channel)
+        self.broadcaster.attach(channel)
+        logging.debug('Connected: %s (%d clients)' % (channel.peer, len(self.channels)))
+
+    ## Unregisters a closed connection
+    #
+    # \param channel Telescope_Channel instance
+    # \param exc Exception that closed the connection, or None
+    def channel_closed(self, channel, exc=None):
+        self.channels.discard(channel)
+        if exc is not None:
+            logging.debug('Disconnected: %s (%s)' % (channel.peer, exc))
+        else:
+            logging.debug('Disconnected: %s' % (channel.peer, ))
+
+    ## Receives the messages of a channel and throws the stell_pos_recv signal
+    #
+    # \param channel Telescope_Channel instance
+    # \param batch List of decoded messages [(time, ra, dec), ...]
+    def messages_received(self, channel, batch):
+        #______ Testing:
+        # Sends back to Stellarium the last received coordinates, in order to update the field of view indicator
+        (mtime, ra_uint, dec_int) = batch[-1]
+        self.broadcaster.publish(ra_uint, dec_int)
+        #______ End Testing
+
+        for (mtime, ra_uint, dec_int) in batch:
+            self.stell_pos_recv.emit(coords.Hours.from_stellarium(ra_uint), coords.Degrees.from_stellarium(dec_int),
+                                     mtime)
+
+    ## Proxy signal for receive coordinates and send them to every connected client
+    #
+    #  It can be called from any thread
+    #
+    # \ra Right ascension (radians)
+    # \dec Declination (radians)
     def proxy_signal_sent(self, ra, dec):
-        if self.tel != None:
-            self.tel.act_pos(ra, dec)
-        
-    ## Closes the connection
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._act_pos, ra, dec)
+
+    ## Updates the field of view indicator in Stellarium (event loop side)
+    #
+    # \param ra Right ascension in radians
+    # \param dec Declination in radians
+    def _act_pos(self, ra, dec):
+        (ra_p, dec_p) = coords.rad_2_stellarium(ra, dec)
+        self.broadcaster.publish(ra_p, dec_p)
+
+    ## Closes the listening socket and all the client connections (event loop side)
+    #
+    def _close_all(self):
+        self.broadcaster.stop()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for channel in list(self.channels):
+            channel.close()
+
+    ## Closes the connections and stops the server
     #
+    #  It can be called from any thread
     def close_socket(self):
-        if self.connected:
-            self.conn.close()
+        if self.loop is None or self.loop.is_closed():
+            return
+        if self._own_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self.loop.call_soon_threadsafe(self._close_all)
 
 #Run a Telescope Server
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+import logging
+from threading import Thread, Event
+from time import time
+import numpy
+import coords
+
+## Minimum interval between corrections, in seconds (near the zenith the azimuth of the target changes faster)
+MIN_INTERVAL = 0.5
+
+## Maximum interval without a prediction, in seconds: the predicted trajectory covers it
+MAX_INTERVAL = 60.0
+
+## Half the interval of the calculation of the angular rates of the target, in seconds
+RATE_DT = 1.0
+
+## Precision of the time of a step change, in seconds
+PRECISION = 0.01
+
+## Wait when the device can not be driven (not initialized, without reference objects, or in a manual movement)
+IDLE_WAIT = 0.5
+
+## Seconds of the day in radians of local time (see coords.Hours)
+DAY = 86400.0
+
+## \brief Predictive tracking: the device follows the target with the smallest corrections, when they are needed.
+#
+#  The horizontal trajectory of the target over the maximum interval is predicted with the transformations of the
+#  device computed on the host (LaserDev.pointing), and converted to positions in steps of the motors. The engine
+#  sleeps until the predicted position changes (the target crosses the middle between two steps), and then sends
+#  a goto to the new position, so the pointing error stays under one step with a command per step change.
+#
+#  The positions are predicted at the interval in which the target drifts one step, from its angular rates in azimuth
+#  and altitude (it is shorter near the zenith and longer near the pole), bounded by the minimum and maximum
+#  intervals: the corrections are not sent more often than the minimum one.
+#
+#  The trajectory is predicted again after every correction, when the target changes, and when the device reports
+#  its position (the telemetry of any other movement). The corrections are gotos calculated by the host
+#  (LaserDev.goto with offload), sent as steps when the device supports them, and the redundant ones are not sent.
+#
+#  An example of use would be as follows:
+#
+#    engine = TrackingEngine(device, lambda: (ra, dec))
+#    engine.start()
+#    ...
+#    engine.cancel()
+#
+class TrackingEngine(Thread):
+
+    ## Class constructor.
+    #
+    # \param device LaserDev, initialized and with the reference objects set
+    # \param target Callable that returns the tracked equatorial coordinates (ra, dec), or (None, None)
+    # \param submit (optional) Callable that sends a correction, with the parameters of LaserDev.goto. By
+    #               default, the goto is called directly
+    # \param min_interval Minimum interval between corrections, in seconds
+    # \param max_interval Maximum interval without a prediction, in seconds
+    def __init__(self, device, target, submit=None, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        Thread.__init__(self, name='TrackingEngine')
+        self.daemon = True
+        self.device = device
+        self.target = target
+        self.submit = submit if submit is not None else device.goto
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.finished = Event()
+        self._wake = Event()
+        ## @var corrections
+        # Number of corrections sent
+        self.corrections = 0
+        ## @var predictions
+        # Number of predicted trajectories
+        self.predictions = 0
+        ## @var rates
+        # Angular rates of the target in the last prediction, (azimuth, altitude) in steps per second
+        self.rates = (0.0, 0.0)
+        ## @var interval
+        # Interval between the predicted positions in the last prediction, in seconds
+        self.interval = max_interval
+        self._last = None
+        self._periods = (0, 0.0, None, None)
+        device.pos_received.connect(self._telemetry)
+
+    ## Local time of the day at a timestamp, in radians, without wrapping at midnight within the window
+    #
+    # \param t Timestamp or array of timestamps (seconds)
+    # \param now Reference timestamp
+    # \return Radians
+    def _local(self, t, now):
+        return coords.Hours.from_timestamp(now) + (t - now) * 2 * math.pi / DAY
+
+    ## Position in steps of the target at the given times
+    #
+    # \param ra Right ascension
+    # \param dec Declination
+    # \param times Array of timestamps
+    # \param now Reference timestamp
+    # \return List of positions (x, y)
+    def _steps(self, ra, dec, times, now):
+        device = self.device
+        quantize = device.toSteps if device.step_targets else device.deviceSteps
+        (ac, alt) = device.pointing.getHCoords(ra, dec, self._local(numpy.asarray(times, dtype=float), now))
+        return [quantize(x, y) for (x, y) in zip(numpy.atleast_1d(ac), numpy.atleast_1d(alt))]
+
+    ## Angular rates of a target
+    #
+    # \param ra Right ascension
+    # \param dec Declination
+    # \param now Current timestamp
+    # \return List with the rates (azimuth, altitude), in steps per second
+    def getRates(self, ra, dec, now):
+        (px, py) = self.device.steps
+        times = self._local(numpy.array([now - RATE_DT, now + RATE_DT]), now)
+        (ac, alt) = self.device.pointing.getHCoords(ra, dec, times)
+        dac = (ac[1] - ac[0] + math.pi) % (2 * math.pi) - math.pi
+        return (abs(dac) * px / (4 * math.pi * RATE_DT), abs(alt[1] - alt[0]) * py / (4 * math.pi * RATE_DT))
+
+    ## Next correction of the tracking of a target
+    #
+    #  It is not sooner than the minimum interval after the last correction
+    # \param ra Right ascension
+    # \param dec Declination
+    # \param now Current timestamp
+    # \return List with (timestamp, position in steps) of the next change, (end of the window, None) if the
+    #         position does not change within it, or None if the device can not be driven
+    def plan(self, ra, dec, now):
+        device = self.device
+        if device.pointing is None or not device.pointing.canTransform() or device.steps is None:
+            return None
+        current = device.currentSteps()
+        if current is None:
+            return None
+        self.predictions += 1
+        self.rates = self.getRates(ra, dec, now)
+        rate = max(self.rates)
+        interval = 1.0 / rate if rate > 0 else self.max_interval
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        times = now + numpy.arange(0.0, self.max_interval + self.interval, self.interval)
+        predicted = self._steps(ra, dec, times, now)
+        if predicted[0] != current:
+            return (self._bound(now), predicted[0])
+        for i in range(1, len(predicted)):
+            if predicted[i] != current:
+                break
+        else:
+            return (times[-1], None)
+        # The change is between two samples
+        (t0, t1, steps) = (times[i-1], times[i], predicted[i])
+        while t1 - t0 > PRECISION:
+            t = (t0 + t1) / 2
+            position = self._steps(ra, dec, [t], now)[0]
+            if position == current:
+                t0 = t
+            else:
+                (t1, steps) = (t, position)
+        return (self._bound(t1), steps)
+
+    ## Time of a correction, not sooner than the minimum interval after the last one
+    #
+    # \param when Timestamp
+    # \return Timestamp
+    def _bound(self, when):
+        if self._last is None:
+            return when
+        return max(when, self._last + self.min_interval)
+
+    ## Registers a correction sent
+    #
+    # \param now Timestamp of the correction
+    def _corrected(self, now):
+        self.corrections += 1
+        if self._last is not None:
+            (count, total, shortest, longest) = self._periods
+            period = now - self._last
+            self._periods = (count + 1, total + period, period if shortest is None else min(shortest, period),
+                             period if longest is None else max(longest, period))
+        self._last = now
+
+    ## Instrumentation of the tracking
+    #
+    # \return Dictionary with the corrections and predictions, the rates (steps per second) and the prediction
+    #         interval of the last prediction, and the periods between corrections (seconds)
+    def stats(self):
+        (count, total, shortest, longest) = self._periods
+        return {'corrections': self.corrections, 'predictions': self.predictions, 'rates': self.rates,
+                'interval': self.interval, 'period_min': shortest, 'period_max': longest,
+                'period_mean': total / count if count else None}
+
+    ## Plans and sends the next correction
+    #
+    # \return Seconds to wait before the next one (or a new position of the device)
+    def _step(self):
+        (ra, dec) = self.target()
+        if ra is None:
+            return IDLE_WAIT
+        now = time()
+        plan = self.plan(ra, dec, now)
+        if plan is None:
+            return IDLE_WAIT
+        (when, steps) = plan
+        if when > now:
+            return when - now
+        self._corrected(now)
+        logging.debug("Correction %d to (%d, %d), rates %.3f/%.3f steps/s" %
+                      ((self.corrections, ) + steps + self.rates))
+        self.submit(ra, dec, coords.Hours(self._local(now, now)), offload=True)
+        # Planned again with the position of the correction, once it is sent
+        return IDLE_WAIT
+
+    ## The device has reported its position
+    #
+    def _telemetry(self, x, y):
+        self._wake.set()
+
+    ## Starts thread
+    #
+    def run(self):
+        while not self.finished.is_set():
+            self._wake.clear()
+            try:
+                wait = self._step()
+            except Exception as e:
+                logging.error("Tracking error: %s" % e)
+                wait = IDLE_WAIT
+            self._wake.wait(wait)
+
+    ## Cancel execution
+    #
+    def cancel(self):
+        self.finished.set()
+        self._wake.set()
+        try:
+            self.device.pos_received.disconnect(self._telemetry)
+        except (TypeError, AttributeError):
+            pass
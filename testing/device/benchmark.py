@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import threading
+from time import time, sleep
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+import coords
+from device_engine import Device_Engine, Ascii_Transport, Binary_Transport, EV_BOOT, EV_PROMPT, EV_FLOAT, \
+	EV_ACK, EV_DONE
+
+## \brief Benchmark of the communications with the device (Arduino).
+#
+#  Runs the same session (initial time, two reference objects and several gotos, see README.md) with each
+#  protocol of the device, and prints for every command:
+#
+#  - Round trips: handshake messages the host has to receive ('float' prompts, '_OK_' acks and the 'done_*'
+#    terminator). The next step of the host waits for each one of them.
+#  - Latency: from writing the command to its terminator (mean and maximum).
+#  - Bytes written and read per command.
+#
+#  Then a burst of reference commands is sent with and without pipelining (next command written before
+#  the 'done_*' of the previous one).
+#
+#  The board is reset when the port is opened, so each protocol runs in a new connection. Example:
+#
+#	./benchmark.py /dev/ttyUSB0 --gotos 10
+#
+
+## Handshake events (each one is a turn of the line)
+HANDSHAKE = (EV_FLOAT, EV_ACK, EV_DONE)
+
+REFERENCES = [("2h31m49s", "89º15'51''", "22h04m20s"), ("18h36m56s", "38º47'03''", "22h05m07s")]
+TARGETS = [("19h50m47s", "8º52'07''", "22h06m11s"), ("18h03m48s", "-24º23'00''", "22h06m52s"),
+		   ("13h17m55s", "-8º29'04''", "22h07m51s")]
+
+## Modes of the device: (protocol, command that enables it, transport)
+MODES = [('ascii', None, lambda port: Ascii_Transport(port)),
+		 ('pipe', 'pipe', lambda port: Ascii_Transport(port, param_prompt=False)),
+		 ('binary', 'binm', lambda port: Binary_Transport(port))]
+
+class Benchmark():
+	def __init__(self, port, baud=9600, timeout=30):
+		self.serial = serial.Serial(port, baud, timeout=0.05)
+		self.timeout = timeout
+		self.ready = threading.Event()
+		self.handshakes = 0
+		self.engine = Device_Engine(Ascii_Transport(self.serial), self.event, heartbeat=0)
+		self.engine.start()
+		self.results = {}
+
+	def event(self, event):
+		if event.kind in (EV_BOOT, EV_PROMPT):
+			self.ready.set()
+		if event.kind in HANDSHAKE:
+			self.handshakes += 1
+
+	def close(self):
+		self.engine.close()
+
+	def switch(self, name, transport):
+		self.ready.wait(3)
+		if name is not None:
+			self.engine.submit(name, done='^done_%s$' % name, timeout=self.timeout, pipeline=False,
+							   on_done=lambda line: self.engine.set_transport(transport(self.serial))).result()
+
+	def counters(self):
+		return (self.handshakes, self.engine.transport.tx_bytes, self.engine.transport.rx_bytes, time())
+
+	def run(self, name, params=(), **kwargs):
+		before = self.counters()
+		self.engine.submit(name, params, timeout=self.timeout, **kwargs).result()
+		after = self.counters()
+		self.results.setdefault(name, []).append([a - b for (a, b) in zip(after, before)])
+
+	def session(self, gotos):
+		self.run('time', (coords.hourStr_2_rad("22h02m0s"), ))
+		for (i, (ra, dec, t)) in enumerate(REFERENCES):
+			self.run('set%d' % (i+1), (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)))
+		for i in range(gotos):
+			(ra, dec, t) = TARGETS[i % len(TARGETS)]
+			self.run('goto', (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)),
+					 pipeline=False)
+
+	def burst(self, count, depth):
+		(ra, dec, t) = REFERENCES[0]
+		params = (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t))
+		self.engine.max_inflight = depth
+		t0 = time()
+		futures = [self.engine.submit('set1', params, timeout=self.timeout) for i in range(count)]
+		for future in futures:
+			future.result()
+		self.engine.max_inflight = 1
+		return time() - t0
+
+	def report(self, protocol):
+		for name in sorted(self.results):
+			rows = self.results[name]
+			n = float(len(rows))
+			print("%-7s %-5s  round trips: %4.1f  latency: %7.1fms (max %7.1fms)  bytes: %5.1f out, %5.1f in" % (
+				protocol, name, sum(r[0] for r in rows)/n, sum(r[3] for r in rows)/n*1000,
+				max(r[3] for r in rows)*1000, sum(r[1] for r in rows)/n, sum(r[2] for r in rows)/n))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Communications benchmark of the device")
+	parser.add_argument('port', nargs='?', default='/dev/ttyUSB0', help="Serial port of the device")
+	parser.add_argument('--baud', type=int, default=9600)
+	parser.add_argument('--gotos', type=int, default=6, help="Number of gotos of each session")
+	parser.add_argument('--burst', type=int, default=20, help="Number of commands of the pipelining burst")
+	parser.add_argument('--modes', default='ascii,pipe,binary', help="Protocols to test")
+	args = parser.parse_args()
+
+	for (protocol, name, transport) in MODES:
+		if protocol not in args.modes.split(','):
+			continue
+		b = Benchmark(args.port, args.baud)
+		try:
+			b.switch(name, transport)
+			b.session(args.gotos)
+			b.report(protocol)
+			sequential = b.burst(args.burst, 1)
+			pipelined = b.burst(args.burst, 2)
+			print("%-7s burst of %d commands: %.1fms sequential, %.1fms pipelined\n" % (
+				protocol, args.burst, sequential*1000, pipelined*1000))
+		finally:
+			b.close()
+		sleep(0.5)
@@ -0,0 +1,79 @@
+#ifndef Arduino_h
+#define Arduino_h
+
+	#include <stdint.h>
+	#include <stdlib.h>
+	#include <string.h>
+	#include <math.h>
+
+	/**
+	 * \brief Arduino API for the host build of the firmware (see harness.cpp)
+	 *
+	 * Only the functions used by plaser.pde and its libraries. The serial port is a pseudo-terminal, the pins are
+	 * connected to a model of the mechanism (stepper drivers and limit sensors), and the time is virtual.
+	 */
+
+	#define HIGH 1
+	#define LOW 0
+	#define INPUT 0
+	#define OUTPUT 1
+
+	#define DEC 10
+	#define HEX 16
+
+	typedef uint8_t byte;
+
+	void pinMode(uint8_t pin, uint8_t mode);
+	void digitalWrite(uint8_t pin, uint8_t value);
+	int digitalRead(uint8_t pin);
+
+	unsigned long millis();
+	unsigned long micros();
+	void delay(unsigned long ms);
+	void delayMicroseconds(unsigned int us);
+
+	/**
+	 * Serial port on a pseudo-terminal
+	 */
+	class HardwareSerial{
+		private:
+			long _baud;
+
+			size_t _printNumber(unsigned long n, uint8_t base);
+			size_t _printFloat(double number, uint8_t digits);
+
+		public:
+			HardwareSerial();
+
+			void begin(long baud);
+			void end();
+			int available();
+			int peek();
+			int read();
+			void flush();
+
+			size_t write(uint8_t b);
+			size_t write(const uint8_t* buffer, size_t size);
+
+			size_t print(const char* s);
+			size_t print(char c);
+			size_t print(int n, int base = DEC);
+			size_t print(unsigned int n, int base = DEC);
+			size_t print(long n, int base = DEC);
+			size_t print(unsigned long n, int base = DEC);
+			size_t print(double n, int digits = 2);
+
+			size_t println();
+			size_t println(const char* s);
+			size_t println(char c);
+			size_t println(int n, int base = DEC);
+			size_t println(long n, int base = DEC);
+			size_t println(double n, int digits = 2);
+	};
+
+	extern HardwareSerial Serial;
+
+	void setup();
+	void loop();
+
+#endif
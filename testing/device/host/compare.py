@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import argparse
+import threading
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'main', 'python'))
+import coords
+from device_engine import Device_Engine, Ascii_Transport, EV_BOOT, EV_HEARTBEAT, EV_PROMPT, EV_FLOAT, EV_ACK
+
+## \brief Compares the responses of two devices to the same session (ASCII protocol).
+#
+#  Used to find differences between the firmware built for the host (plaser_host) and the Python simulator
+#  (../simulator.py), or any of them and the real device. Both must start at the same position. Example:
+#
+#	./plaser_host --fast --link /tmp/ttyFW &
+#	../simulator.py --fast --link /tmp/ttyPLASER &
+#	./compare.py /tmp/ttyFW /tmp/ttyPLASER
+#
+#  Numbers may differ up to --tolerance (the trigonometric functions of each libm round the last bit differently).
+#  The prompts and heartbeats are not compared (they depend on the timing). The manual movements run before the
+#  configuration, because their equatorial position uses an uninitialized time in plaser.pde.
+#
+
+REFERENCES = [("2h31m49s", "89º15'51''", "22h04m20s"), ("18h36m56s", "38º47'03''", "22h05m07s")]
+TARGETS = [("19h50m47s", "8º52'07''", "22h06m11s"), ("18h03m48s", "-24º23'00''", "22h06m52s"),
+		   ("13h17m55s", "-8º29'04''", "22h07m51s"), ("5h55m10s", "7º24'25''", "22h08m30s")]
+MOVES = [(0.5, 0.3), (5.8, 1.2), (3.1, 0.05)]
+## Positions in steps (the last ones beyond the range, and with the Y axis over 90º)
+STEPS = [(37, 12), (1500, 620), (2100, -5), (0, 0)]
+
+NUMBER = re.compile(r'-?\d+(?:\.\d+)?|nan|inf|ovf')
+
+## Lines equal except for differences in the numbers up to the given tolerance
+def equivalent(a, b, tolerance):
+	if NUMBER.sub('#', a) != NUMBER.sub('#', b):
+		return False
+	for (na, nb) in zip(NUMBER.findall(a), NUMBER.findall(b)):
+		if na != nb and (na in ('nan', 'inf', 'ovf') or nb in ('nan', 'inf', 'ovf') or
+						 abs(float(na) - float(nb)) > tolerance):
+			return False
+	return True
+
+class Recorder():
+	def __init__(self, port, timeout=120):
+		self.serial = serial.Serial(port, 9600, timeout=0.05)
+		self.timeout = timeout
+		self.lines = []
+		self.ready = threading.Event()
+		self.engine = Device_Engine(Ascii_Transport(self.serial), self.event, heartbeat=0)
+		self.engine.start()
+
+	def event(self, event):
+		if event.kind == EV_BOOT:
+			self.ready.set()
+		if event.kind not in (EV_HEARTBEAT, EV_PROMPT, EV_FLOAT, EV_ACK):
+			self.lines.append(event.line)
+
+	def run(self, name, params=(), extra=b''):
+		self.lines.append('>> %s %s %s' % (name, ' '.join('%.6f' % p for p in params), extra.decode('ascii')))
+		self.engine.submit(name, params, extra=extra, done='^done_.*$', timeout=self.timeout,
+						   pipeline=False).result()
+
+	def session(self):
+		self.ready.wait(3)
+		self.run('init')
+		self.run('time', (coords.hourStr_2_rad("22h02m0s"), ))
+		self.run('movx', extra=b'1')
+		self.run('movy', extra=b'1')
+		self.run('movx', extra=b'0')
+		for (ra, dec, t) in TARGETS[:1]:
+			self.run('goto', (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)))
+		for (i, (ra, dec, t)) in enumerate(REFERENCES):
+			self.run('move', MOVES[i] + (coords.hourStr_2_rad(t), ))
+			self.run('set%d' % (i+1), (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)))
+		for (ra, dec, t) in TARGETS:
+			self.run('goto', (coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)))
+		self.run('move', MOVES[2] + (coords.hourStr_2_rad("22h09m0s"), ))
+		for steps in STEPS:
+			self.run('step', steps)
+
+	def close(self):
+		self.engine.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Compares the responses of two devices")
+	parser.add_argument('port_a')
+	parser.add_argument('port_b')
+	parser.add_argument('--tolerance', type=float, default=2e-6, help="Maximum difference of the numbers")
+	args = parser.parse_args()
+
+	recorders = [Recorder(args.port_a), Recorder(args.port_b)]
+	threads = [threading.Thread(target=r.session) for r in recorders]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	for r in recorders:
+		r.close()
+
+	(a, b) = (recorders[0].lines, recorders[1].lines)
+	differences = 0
+	for i in range(max(len(a), len(b))):
+		(la, lb) = (a[i] if i < len(a) else '', b[i] if i < len(b) else '')
+		if not equivalent(la, lb, args.tolerance):
+			differences += 1
+			print("%-45s | %s" % (la, lb))
+	print("%d lines, %d differences" % (max(len(a), len(b)), differences))
+	sys.exit(1 if differences else 0)
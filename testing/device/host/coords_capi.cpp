@@ -0,0 +1,35 @@
+/**
+ * C interface of CoordsLib for the host (libcoords.so), in order to compare the transformations of the
+ * firmware with the ones computed by the application (see pointing_check.py)
+ */
+#include "CoordsLib.h"
+
+extern "C"{
+	CoordsLib* coords_new(){
+		return new CoordsLib();
+	}
+
+	void coords_delete(CoordsLib* coords){
+		delete coords;
+	}
+
+	void coords_set_time(CoordsLib* coords, float t0){
+		coords->setTime(t0);
+	}
+
+	void coords_set_ref(CoordsLib* coords, int id_ref, float ar, float dec, float t, float ac, float alt){
+		switch(id_ref){
+			case 1: coords->setRef_1(ar, dec, t, ac, alt); break;
+			case 2: coords->setRef_2(ar, dec, t, ac, alt); break;
+			case 3: coords->setRef_3(ar, dec, t, ac, alt); break;
+		}
+	}
+
+	void coords_get_hcoords(CoordsLib* coords, float ar, float dec, float t, float* ac, float* alt){
+		coords->getHCoords(ar, dec, t, ac, alt);
+	}
+
+	void coords_get_ecoords(CoordsLib* coords, float ac, float alt, float t, float* ar, float* dec){
+		coords->getECoords(ac, alt, t, ar, dec);
+	}
+}
@@ -0,0 +1,432 @@
+/**
+ * Host build of the plaser firmware (plaser.pde, AxesLib, CoordsLib, LinkLib), without Arduino.
+ *
+ * The serial port is a pseudo-terminal, so the application (LaserDev) drives it as the real device. The pins of
+ * plaser.pde are connected to a model of the mechanism: the step, direction and enable pins move the axes, and
+ * the limit sensors are read from their position (the mechanism has --steps-x steps in 360º and --steps-y steps
+ * in 90º, and it starts at 0, 0). The time is virtual: the delays of the firmware advance it, and it is kept in
+ * real time unless --fast is given. While the firmware waits for the serial port, the virtual time goes on as the
+ * real one.
+ *
+ * As the Arduino, the firmware is restarted every time the port is opened: each connection runs in a new process,
+ * while the position of the mechanism is kept.
+ *
+ * Usage: ./plaser_host [--fast] [--steps-x 2000] [--steps-y 500] [--link /tmp/ttyPLASER]
+ */
+#include <stdio.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <poll.h>
+#include <pty.h>
+#include <termios.h>
+#include <signal.h>
+#include <sys/mman.h>
+#include <sys/wait.h>
+#include <time.h>
+#include "Arduino.h"
+
+/**
+ * Pins of plaser.pde
+ */
+#define PIN_DIR 2
+#define PIN_STEP_X 3
+#define PIN_STEP_Y 4
+#define PIN_S360_X 5
+#define PIN_SBOTTOM_Y 6
+#define PIN_STOP_Y 7
+#define PIN_LASER 8
+#define PIN_ENABLE_X 9
+#define PIN_ENABLE_Y 10
+#define PIN_S0_X 11
+#define PINS 20
+
+/**
+ * Maximum wait for the serial port when the firmware is polling it (ms), and empty polls without any delay
+ * before waiting (the movements check the port more than once per step)
+ */
+#define IDLE_WAIT 10
+#define IDLE_POLLS 4
+
+/**
+ * Position of the mechanism (steps), shared between the connections
+ */
+struct Mechanism{
+	long px, py;
+	long steps_x, steps_y;
+};
+
+static Mechanism* _mech;
+static uint8_t _pins[PINS];
+
+static bool _fast = false;
+static int _master = -1;
+
+/**
+ * Virtual time (us), its origin in real time, and virtual time and number of the last empty polls of the serial
+ * port
+ */
+static uint64_t _clock = 0;
+static uint64_t _origin = 0;
+static uint64_t _last_poll = (uint64_t)-1;
+static int _empty_polls = 0;
+
+/**
+ * Received bytes not read by the firmware
+ */
+static uint8_t _rx[4096];
+static size_t _rx_len = 0;
+
+HardwareSerial Serial;
+
+static uint64_t _wall(){
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (uint64_t)ts.tv_sec*1000000 + ts.tv_nsec/1000;
+}
+
+/**
+ * Waits until the real time reaches the virtual one (real time mode)
+ */
+static void _pace(){
+	int64_t ahead;
+
+	if(_fast)
+		return;
+	ahead = (int64_t)_clock - (int64_t)(_wall() - _origin);
+	if(ahead > 2000)
+		usleep(ahead);
+}
+
+/**
+ * Reads the bytes received by the pseudo-terminal, waiting up to timeout ms. The connection ends when the port
+ * is closed by the computer
+ */
+static void _receive(int timeout){
+	struct pollfd pfd = {_master, POLLIN, 0};
+	ssize_t n;
+
+	if(poll(&pfd, 1, timeout) <= 0)
+		return;
+	n = read(_master, _rx+_rx_len, sizeof(_rx)-_rx_len);
+	if(n < 0 && (errno == EAGAIN || errno == EINTR))
+		return;
+	if(n <= 0)
+		_exit(0);
+	_rx_len += n;
+}
+
+/**
+ * Serial port polled without any delay of the firmware: it is waiting, so the time goes on
+ */
+static void _idle(){
+	uint64_t start = _wall();
+
+	_receive(IDLE_WAIT);
+	if(_fast)
+		_clock += _wall() - start;
+	else if(_wall() - _origin > _clock)
+		_clock = _wall() - _origin;
+}
+
+void pinMode(uint8_t pin, uint8_t mode){
+}
+
+void digitalWrite(uint8_t pin, uint8_t value){
+	if(pin >= PINS)
+		return;
+	//Rising edges of the step pins, with the driver enabled (LOW). X increases with LOW direction, Y with HIGH
+	if(value == HIGH && _pins[pin] == LOW){
+		if(pin == PIN_STEP_X && _pins[PIN_ENABLE_X] == LOW)
+			_mech->px += (_pins[PIN_DIR] == LOW) ? 1 : -1;
+		else if(pin == PIN_STEP_Y && _pins[PIN_ENABLE_Y] == LOW)
+			_mech->py += (_pins[PIN_DIR] == HIGH) ? 1 : -1;
+	}
+	_pins[pin] = value;
+}
+
+int digitalRead(uint8_t pin){
+	//X sensors are active HIGH, Y sensors active LOW
+	switch(pin){
+		case PIN_S0_X:
+			return (_mech->px <= 0) ? HIGH : LOW;
+		case PIN_S360_X:
+			return (_mech->px >= _mech->steps_x) ? HIGH : LOW;
+		case PIN_SBOTTOM_Y:
+			return (_mech->py <= 0) ? LOW : HIGH;
+		case PIN_STOP_Y:
+			return (_mech->py >= _mech->steps_y) ? LOW : HIGH;
+	}
+	return (pin < PINS) ? _pins[pin] : LOW;
+}
+
+unsigned long millis(){
+	return _clock/1000;
+}
+
+unsigned long micros(){
+	return _clock;
+}
+
+void delay(unsigned long ms){
+	_clock += (uint64_t)ms*1000;
+	_pace();
+}
+
+void delayMicroseconds(unsigned int us){
+	_clock += us;
+	_pace();
+}
+
+HardwareSerial::HardwareSerial(){
+	_baud = 9600;
+}
+
+void HardwareSerial::begin(long baud){
+	_baud = baud;
+}
+
+void HardwareSerial::end(){
+}
+
+int HardwareSerial::available(){
+	if(_rx_len == 0){
+		_receive(0);
+		if(_rx_len == 0){
+			_empty_polls = (_last_poll == _clock) ? _empty_polls+1 : 0;
+			if(_empty_polls >= IDLE_POLLS)
+				_idle();
+			_last_poll = _clock;
+		}
+	}
+	return _rx_len;
+}
+
+int HardwareSerial::peek(){
+	if(available() <= 0)
+		return -1;
+	return _rx[0];
+}
+
+int HardwareSerial::read(){
+	int b;
+
+	if(available() <= 0)
+		return -1;
+	b = _rx[0];
+	memmove(_rx, _rx+1, --_rx_len);
+	return b;
+}
+
+void HardwareSerial::flush(){
+}
+
+size_t HardwareSerial::write(const uint8_t* buffer, size_t size){
+	//Transmission time (10 bits per byte)
+	if(!_fast){
+		_clock += (uint64_t)size*10000000/_baud;
+		_pace();
+	}
+	if(::write(_master, buffer, size) < 0 && errno == EIO)
+		_exit(0);
+	return size;
+}
+
+size_t HardwareSerial::write(uint8_t b){
+	return write(&b, 1);
+}
+
+size_t HardwareSerial::print(const char* s){
+	return write((const uint8_t*)s, strlen(s));
+}
+
+size_t HardwareSerial::print(char c){
+	return write((uint8_t)c);
+}
+
+size_t HardwareSerial::_printNumber(unsigned long n, uint8_t base){
+	char buf[8*sizeof(long)+1];
+	char* s = buf+sizeof(buf)-1;
+
+	*s = '\0';
+	do{
+		char c = n % base;
+		n /= base;
+		*--s = c < 10 ? c+'0' : c+'A'-10;
+	}while(n);
+	return print(s);
+}
+
+size_t HardwareSerial::print(long n, int base){
+	size_t len = 0;
+
+	if(base == DEC && n < 0){
+		len = print('-');
+		n = -n;
+	}
+	return len + _printNumber(n, base);
+}
+
+size_t HardwareSerial::print(int n, int base){
+	return print((long)n, base);
+}
+
+size_t HardwareSerial::print(unsigned int n, int base){
+	return _printNumber(n, base);
+}
+
+size_t HardwareSerial::print(unsigned long n, int base){
+	return _printNumber(n, base);
+}
+
+/**
+ * Print::printFloat() of Arduino, with the single precision double of the AVR
+ */
+size_t HardwareSerial::_printFloat(double value, uint8_t digits){
+	float number = value, rounding = 0.5, remainder;
+	unsigned long int_part;
+	size_t len = 0;
+
+	if(isnan(number))
+		return print("nan");
+	if(isinf(number))
+		return print("inf");
+	if(number > 4294967040.0 || number < -4294967040.0)
+		return print("ovf");
+	if(number < 0.0){
+		len += print('-');
+		number = -number;
+	}
+	for(uint8_t i=0;i<digits;i++)
+		rounding /= 10.0;
+	number += rounding;
+	int_part = (unsigned long)number;
+	remainder = number - (float)int_part;
+	len += _printNumber(int_part, DEC);
+	if(digits > 0)
+		len += print('.');
+	while(digits-- > 0){
+		remainder *= 10.0;
+		unsigned int digit = (unsigned int)remainder;
+		len += _printNumber(digit, DEC);
+		remainder -= digit;
+	}
+	return len;
+}
+
+size_t HardwareSerial::print(double n, int digits){
+	return _printFloat(n, digits);
+}
+
+size_t HardwareSerial::println(){
+	return print("\r\n");
+}
+
+size_t HardwareSerial::println(const char* s){
+	return print(s) + println();
+}
+
+size_t HardwareSerial::println(char c){
+	return print(c) + println();
+}
+
+size_t HardwareSerial::println(int n, int base){
+	return print(n, base) + println();
+}
+
+size_t HardwareSerial::println(long n, int base){
+	return print(n, base) + println();
+}
+
+size_t HardwareSerial::println(double n, int digits){
+	return print(n, digits) + println();
+}
+
+/**
+ * Waits until the port is opened by the computer (no hang up on the master side)
+ */
+static void _waitOpen(){
+	struct pollfd pfd = {_master, POLLIN, 0};
+
+	while(true){
+		pfd.revents = 0;
+		poll(&pfd, 1, 50);
+		if(!(pfd.revents & POLLHUP))
+			return;
+		usleep(50000);
+	}
+}
+
+/**
+ * Runs the firmware until the port is closed
+ */
+static void _run(){
+	_origin = _wall();
+	//Time for the computer to configure the port
+	usleep(50000);
+	setup();
+	while(true)
+		loop();
+}
+
+static void _usage(const char* name){
+	fprintf(stderr, "Usage: %s [--fast] [--steps-x N] [--steps-y N] [--link PATH]\n", name);
+	exit(2);
+}
+
+int main(int argc, char** argv){
+	const char* link = 0;
+	char port[128];
+	struct termios tio;
+	int slave;
+
+	_mech = (Mechanism*)mmap(0, sizeof(Mechanism), PROT_READ|PROT_WRITE, MAP_SHARED|MAP_ANONYMOUS, -1, 0);
+	_mech->px = _mech->py = 0;
+	_mech->steps_x = 2000;
+	_mech->steps_y = 500;
+	for(int i=1;i<argc;i++){
+		if(strcmp(argv[i], "--fast") == 0)
+			_fast = true;
+		else if(strcmp(argv[i], "--steps-x") == 0 && i+1 < argc)
+			_mech->steps_x = atol(argv[++i]);
+		else if(strcmp(argv[i], "--steps-y") == 0 && i+1 < argc)
+			_mech->steps_y = atol(argv[++i]);
+		else if(strcmp(argv[i], "--link") == 0 && i+1 < argc)
+			link = argv[++i];
+		else
+			_usage(argv[0]);
+	}
+
+	if(openpty(&_master, &slave, port, 0, 0) < 0){
+		perror("openpty");
+		return 1;
+	}
+	tcgetattr(slave, &tio);
+	cfmakeraw(&tio);
+	tcsetattr(slave, TCSANOW, &tio);
+	close(slave);
+	if(link){
+		unlink(link);
+		if(symlink(port, link) < 0){
+			perror("symlink");
+			return 1;
+		}
+	}
+	printf("Firmware on %s\n", link ? link : port);
+	fflush(stdout);
+
+	signal(SIGPIPE, SIG_IGN);
+	while(true){
+		pid_t pid;
+
+		_waitOpen();
+		pid = fork();
+		if(pid == 0){
+			_run();
+			_exit(0);
+		}
+		waitpid(pid, 0, 0);
+	}
+	return 0;
+}
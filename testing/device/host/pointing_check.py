@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import math
+import ctypes
+import argparse
+import threading
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'main', 'python'))
+import coords
+from pointing_engine import PointingEngine
+
+## \brief Compares the transformations of the host (PointingEngine) with the ones of the firmware (CoordsLib).
+#
+#  By default CoordsLib is called through libcoords.so (make), with the same reference objects and a set of
+#  random coordinates in both directions. With --port, a device (the firmware on the host, the simulator or the
+#  real one) is configured through LaserDev, and the equatorial positions it reports after the gotos and moves
+#  are compared with the ones of LaserDev.pointing. Example:
+#
+#	make
+#	./pointing_check.py --count 10000
+#	./plaser_host --fast --link /tmp/ttyFW &
+#	./pointing_check.py --port /tmp/ttyFW
+#
+#  The differences (angular distance in arc seconds) come from the single precision of the firmware, and they are
+#  larger near the poles (asin).
+#
+
+## Reference objects: equatorial coordinates, time and horizontal position (see ../README.md)
+REFERENCES = [("2h31m49s", "89º15'51''", "22h04m20s", "0º27'09''", "36º49'17''"),
+			  ("18h36m56s", "38º47'03''", "22h05m07s", "78º10'04''", "70º05'19''")]
+
+ARCSEC = math.pi / (180 * 3600)
+
+## Horizontal position of the device for a position entered in the application (see LaserDev.move)
+def device_position(az, alt):
+	return (6.283185 - coords.degStr_2_rad(az), coords.degStr_2_rad(alt))
+
+## Angular distance between two positions (arc seconds), without the singularity of the longitude at the poles
+def separation(lon1, lat1, lon2, lat2):
+	v = [numpy.array([numpy.cos(lat)*numpy.cos(lon), numpy.cos(lat)*numpy.sin(lon), numpy.sin(lat)])
+		 for (lon, lat) in ((lon1, lat1), (lon2, lat2))]
+	return 2 * numpy.arcsin(numpy.minimum(1.0, numpy.linalg.norm(v[0] - v[1], axis=0) / 2)) / ARCSEC
+
+def f32(values):
+	return numpy.asarray(values, dtype=numpy.float32).astype(numpy.float64)
+
+def report(name, diffs):
+	(worst, mean) = (float(numpy.nanmax(diffs)), float(numpy.nanmean(diffs)))
+	print("%-22s mean %8.4f\"  max %8.4f\"" % (name, mean, worst))
+	return worst
+
+class CoordsLib():
+	def __init__(self, path):
+		self.lib = ctypes.CDLL(path)
+		self.lib.coords_new.restype = ctypes.c_void_p
+		self.lib.coords_set_time.argtypes = [ctypes.c_void_p, ctypes.c_float]
+		self.lib.coords_set_ref.argtypes = [ctypes.c_void_p, ctypes.c_int] + [ctypes.c_float]*5
+		for name in ('coords_get_hcoords', 'coords_get_ecoords'):
+			getattr(self.lib, name).argtypes = [ctypes.c_void_p] + [ctypes.c_float]*3 + \
+				[ctypes.POINTER(ctypes.c_float)]*2
+		self.coords = ctypes.c_void_p(self.lib.coords_new())
+
+	def setRef(self, id_ref, ra, dec, t, ac, alt):
+		self.lib.coords_set_ref(self.coords, id_ref, ra, dec, t, ac, alt)
+
+	def _transform(self, function, a, b, t):
+		(ra, rb) = (numpy.empty(len(a)), numpy.empty(len(a)))
+		(x, y) = (ctypes.c_float(), ctypes.c_float())
+		for i in range(len(a)):
+			function(self.coords, a[i], b[i], t[i], ctypes.byref(x), ctypes.byref(y))
+			(ra[i], rb[i]) = (x.value, y.value)
+		return (ra, rb)
+
+	def getHCoords(self, ra, dec, t):
+		return self._transform(self.lib.coords_get_hcoords, ra, dec, t)
+
+	def getECoords(self, ac, alt, t):
+		return self._transform(self.lib.coords_get_ecoords, ac, alt, t)
+
+## CoordsLib (libcoords.so) and PointingEngine with the same random coordinates
+def check_library(args):
+	firmware = CoordsLib(args.library)
+	engine = PointingEngine()
+	for (i, (ra, dec, t, az, alt)) in enumerate(REFERENCES):
+		# The device receives single precision values
+		params = f32((coords.hourStr_2_rad(ra), coords.degStr_2_rad(dec), coords.hourStr_2_rad(t)) +
+					 device_position(az, alt))
+		firmware.setRef(i+1, *params)
+		engine.setRef(i+1, *params)
+
+	rnd = numpy.random.RandomState(1)
+	t = f32(coords.hourStr_2_rad("22h10m0s") + rnd.uniform(0, 0.05, args.count))
+	ra = f32(rnd.uniform(0, 2 * math.pi, args.count))
+	dec = f32(rnd.uniform(-math.pi / 2, math.pi / 2, args.count))
+	(ac_f, alt_f) = firmware.getHCoords(ra, dec, t)
+	(ac, alt) = engine.getHCoords(ra, dec, t)
+	worst = report("getHCoords (ac, alt)", separation(ac, alt, ac_f, alt_f))
+
+	ac = f32(rnd.uniform(0, 2 * math.pi, args.count))
+	alt = f32(rnd.uniform(0, math.pi / 2, args.count))
+	(ra_f, dec_f) = firmware.getECoords(ac, alt, t)
+	(ra, dec) = engine.getECoords(ac, alt, t)
+	worst = max(worst, report("getECoords (ra, dec)", separation(ra, dec, ra_f, dec_f)))
+	return worst
+
+## Equatorial positions reported by a device, and the ones of LaserDev.pointing
+def check_device(args):
+	from ldevice import LaserDev
+
+	reported = []
+	device = LaserDev(usb_serial=args.port, timeout=5)
+	device.pos_e_received.connect(lambda ra, dec: reported.append((ra, dec)))
+	initialized = threading.Event()
+	device.init_received.connect(initialized.set)
+	device.start()
+	if not initialized.wait(300):
+		raise RuntimeError("Device not initialized")
+	for (i, (ra, dec, t, az, alt)) in enumerate(REFERENCES):
+		device.move(az, alt).result(120)
+		device.setRef(i+1, ra, dec, t).result(10)
+
+	rnd = numpy.random.RandomState(1)
+	expected = []
+	for n in range(args.count):
+		t = coords.Hours(coords.hourStr_2_rad("22h10m0s") + 0.001 * n)
+		if n % 2 == 0:
+			(ra, dec) = (coords.Hours(rnd.uniform(0, 2 * math.pi)), coords.Degrees(rnd.uniform(-0.5, 1.2)))
+			device.goto(ra, dec, t).result(120)
+			# The device reports the equatorial coordinates of the calculated horizontal ones
+			(ac, alt) = device.pointing.getHCoords(*f32((ra, dec, t)))
+		else:
+			(ac, alt) = (coords.Degrees(rnd.uniform(0.1, 6.2)), coords.Degrees(rnd.uniform(0.05, 1.5)))
+			device.engine.submit('move', (ac, alt, t), timeout=120, pipeline=False).result(120)
+		expected.append(device.pointing.getECoords(*f32((ac, alt, t))))
+	device.close()
+
+	(ra_d, dec_d) = (numpy.array([p[0] for p in reported[-args.count:]]),
+					 numpy.array([p[1] for p in reported[-args.count:]]))
+	(ra_e, dec_e) = (numpy.array([e[0] for e in expected]), numpy.array([e[1] for e in expected]))
+	return report("device (ra, dec)", separation(ra_d, dec_d, ra_e, dec_e))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Compares PointingEngine with the transformations of the firmware")
+	parser.add_argument('--port', help="Serial port of a device (by default libcoords.so is used)")
+	parser.add_argument('--library', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libcoords.so'))
+	parser.add_argument('--count', type=int, default=1000, help="Number of coordinates")
+	parser.add_argument('--tolerance', type=float, default=5.0, help="Maximum difference (arc seconds)")
+	args = parser.parse_args()
+
+	worst = check_device(args) if args.port else check_library(args)
+	print("%s (tolerance %.2f\")" % ("OK" if worst <= args.tolerance else "FAILED", args.tolerance))
+	sys.exit(0 if worst <= args.tolerance else 1)
@@ -0,0 +1,785 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tty
+import math
+import struct
+import select
+import argparse
+import threading
+from time import time, sleep
+
+## \brief Virtual plaser device (Arduino) on a pseudo-terminal.
+#
+#  Implements the command set of plaser.pde (ASCII, pipelined ASCII and binary protocols, speed changes,
+#  heartbeat and abort byte), with a model of AxesLib (step timing, DDA movements, accelerated movx/movy and
+#  limit sensors) and CoordsLib (matrix method, in single precision like the Arduino).
+#
+#  The virtual time of the movements is kept in real time (by default), or skipped in fast mode. The
+#  transmission time of the responses is also simulated in real time, at the current speed of the link.
+#  Optionally (--cpu-time), the time of the CoordsLib calculations on the Arduino is simulated too, also in
+#  fast mode.
+#  As the Arduino, the device is reset each time the port is opened.
+#
+#  Usage:
+#
+#	./simulator.py [--fast] [--link /tmp/ttyPLASER]
+#	Virtual device on /dev/pts/5
+#
+#  and then, for example:
+#
+#	LaserDev(usb_serial='/dev/pts/5')
+#
+#  It can be started from Python too:
+#
+#	device = Virtual_Device(fast=True)
+#	device.start()
+#	laser = LaserDev(usb_serial=device.port)
+#
+
+## Half period of a step in AxesLib::_step (seconds)
+STEP_HALF_PERIOD = 0.0012
+
+## Initial half period of the accelerated movements (movx, movy)
+ACCEL_HALF_PERIOD = 0.0071
+
+## Pause before the movements of AxesLib::_step (except DDA steps)
+STEP_START_DELAY = 0.05
+
+## Maximum number of steps in AxesLib::init
+MAX_STEPS = 10000
+
+## Interval between heartbeats (HEARTBEAT_MS)
+HEARTBEAT = 0.2
+
+## Estimated time of a coordinates transformation (CoordsLib::getHCoords, getECoords) on the Arduino: about
+#  seven calls to the software float trigonometric functions (~1800 cycles each, at 16 MHz) plus the product
+#  by the matrix
+COORDS_TRANSFORM_TIME = 0.001
+
+## Estimated time of the calculation of the transformation matrix and its inverse (CoordsLib::_setT, with the
+#  cross products of autoRef_3)
+COORDS_MATRIX_TIME = 0.0015
+
+## Byte that aborts the running movement (ABORT_BYTE)
+ABORT_BYTE = b'!'
+
+## Binary protocol (LinkLib)
+FRAME_START = 0x7E
+FRAME_MAX_PAYLOAD = 20
+BINARY_COMMANDS = {'I': 'init', 'T': 'time', '1': 'set1', '2': 'set2', '3': 'set3', 'G': 'goto', 'M': 'move',
+				   'X': 'movx', 'Y': 'movy', 'S': 'stop', 'L': 'laon', 'l': 'loff', 'P': 'ping', 'B': 'baud', 's': 'step'}
+
+## Speed changes (LinkLib)
+DEFAULT_BAUD = 9600
+BAUDS = (115200, 230400, 500000)
+BAUD_PATTERN = b'\x55\xaa\x00\xff\x0f\xf0\x33\xcc'
+BAUD_TIMEOUT = 0.5
+
+_float = struct.Struct('<f')
+_long = struct.Struct('<i')
+
+## Rounds to single precision (float of the Arduino)
+def f32(value):
+	return _float.unpack(_float.pack(value))[0]
+
+## M_PI in the Arduino (double is a float)
+PI = f32(math.pi)
+
+## C lrint(): rounds to the nearest integer, halfway cases to even (0 if not finite)
+def lrint(value):
+	if math.isnan(value) or math.isinf(value):
+		return 0
+	return int(round(value))
+
+## C conversion from float to int: truncates (0 if not finite)
+def trunc(value):
+	if math.isnan(value) or math.isinf(value):
+		return 0
+	return int(value)
+
+## Serial.print(value, digits) of Arduino (Print::printFloat, in single precision)
+def print_float(value, digits=6):
+	if math.isnan(value):
+		return "nan"
+	if math.isinf(value):
+		return "inf"
+	if abs(value) > 4294967040.0:
+		return "ovf"
+	sign = '-' if value < 0 else ''
+	number = f32(abs(value))
+	rounding = f32(0.5)
+	for i in range(digits):
+		rounding = f32(rounding/10.0)
+	number = f32(number + rounding)
+	int_part = int(number)
+	remainder = f32(number - int_part)
+	text = sign + str(int_part) + ('.' if digits > 0 else '')
+	for i in range(digits):
+		remainder = f32(remainder*10.0)
+		digit = int(remainder)
+		text += str(digit)
+		remainder = f32(remainder - digit)
+	return text
+
+## IEEE division (infinite or NaN instead of exceptions, as in the Arduino)
+def fdiv(a, b):
+	if b != 0:
+		return a/b
+	if a == 0 or math.isnan(a):
+		return float('nan')
+	return math.copysign(float('inf'), a)*math.copysign(1.0, b)
+
+## C asin() (NaN out of [-1, 1])
+def fasin(value):
+	if -1.0 <= value <= 1.0:
+		return math.asin(value)
+	return float('nan')
+
+def crc8(data):
+	crc = 0
+	for b in data:
+		crc ^= b
+		for i in range(8):
+			crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+	return crc
+
+
+## The port has been closed by the computer
+class Disconnected(Exception):
+	pass
+
+
+## \brief Model of CoordsLib (Toshimi Taki's matrix method), in single precision
+#
+class Coords_Model():
+	def __init__(self, device=None):
+		self._device = device
+		self._t0 = 0.0
+		self._k = f32(1.002737908)
+		self._isSetR1 = self._isSetR2 = self._isSetR3 = False
+		self._lmn = [[0.0]*3 for i in range(3)]
+		self._LMN = [[0.0]*3 for i in range(3)]
+		self._T = [[0.0]*3 for i in range(3)]
+		self._iT = [[0.0]*3 for i in range(3)]
+
+	def _inv(self, m):
+		idet = f32(fdiv(1, f32(m[0][0]*m[1][1]*m[2][2] + m[0][1]*m[1][2]*m[2][0] + m[0][2]*m[1][0]*m[2][1]
+						 - m[0][2]*m[1][1]*m[2][0] - m[0][1]*m[1][0]*m[2][2] - m[0][0]*m[1][2]*m[2][1])))
+		return [[f32((m[1][1]*m[2][2] - m[2][1]*m[1][2])*idet), f32((m[2][1]*m[0][2] - m[0][1]*m[2][2])*idet),
+				 f32((m[0][1]*m[1][2] - m[1][1]*m[0][2])*idet)],
+				[f32((m[1][2]*m[2][0] - m[2][2]*m[1][0])*idet), f32((m[2][2]*m[0][0] - m[0][2]*m[2][0])*idet),
+				 f32((m[0][2]*m[1][0] - m[1][2]*m[0][0])*idet)],
+				[f32((m[1][0]*m[2][1] - m[2][0]*m[1][1])*idet), f32((m[2][0]*m[0][1] - m[0][0]*m[2][1])*idet),
+				 f32((m[0][0]*m[1][1] - m[1][0]*m[0][1])*idet)]]
+
+	def _m_prod(self, m1, m2):
+		return [[f32(sum(m1[i][k]*m2[k][j] for k in range(3))) for j in range(3)] for i in range(3)]
+
+	def _EVC(self, ar, dec, t):
+		a = f32(ar - f32(self._k*f32(t - self._t0)))
+		return [f32(math.cos(dec)*math.cos(a)), f32(math.cos(dec)*math.sin(a)), f32(math.sin(dec))]
+
+	## Time of the calculations on the Arduino (see Virtual_Device.compute)
+	def _compute(self, seconds):
+		if self._device is not None:
+			self._device.compute(seconds)
+
+	def _HVC(self, ac, alt):
+		return [f32(math.cos(alt)*math.cos(ac)), f32(math.cos(alt)*math.sin(ac)), f32(math.sin(alt))]
+
+	def setTime(self, t0):
+		self._t0 = t0
+
+	def setRef(self, n, ar, dec, t, ac, alt):
+		self._LMN[n] = self._EVC(ar, dec, t)
+		self._lmn[n] = self._HVC(ac, alt)
+		if n == 0:
+			self._isSetR1 = True
+		elif n == 1:
+			self._isSetR2 = True
+		if n < 2:
+			self._isSetR3 = False
+		else:
+			self._isSetR3 = True
+		if self.isConfigured():
+			self._setT()
+
+	def isConfigured(self):
+		return self._isSetR1 and self._isSetR2 and self._isSetR3
+
+	def _cross(self, a, b):
+		c = [a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0]]
+		n = f32(fdiv(1, math.sqrt(c[0]**2 + c[1]**2 + c[2]**2)))
+		return [f32(n*v) for v in c]
+
+	def autoRef_3(self):
+		if self._isSetR1 and self._isSetR2:
+			self._lmn[2] = self._cross(self._lmn[0], self._lmn[1])
+			self._LMN[2] = self._cross(self._LMN[0], self._LMN[1])
+			self._isSetR3 = True
+			self._setT()
+
+	def _setT(self):
+		self._compute(COORDS_MATRIX_TIME)
+		subT1 = [[self._lmn[j][i] for j in range(3)] for i in range(3)]
+		subT2 = [[self._LMN[j][i] for j in range(3)] for i in range(3)]
+		self._T = self._m_prod(subT1, self._inv(subT2))
+		self._iT = self._inv(self._T)
+
+	def getHCoords(self, ar, dec, t):
+		self._compute(COORDS_TRANSFORM_TIME)
+		EVC = self._EVC(ar, dec, t)
+		if not self._isSetR3:
+			self.autoRef_3()
+		HVC = [f32(sum(self._T[i][j]*EVC[j] for j in range(3))) for i in range(3)]
+		return (f32(math.atan2(HVC[1], HVC[0])), f32(fasin(HVC[2])))
+
+	def getECoords(self, ac, alt, t):
+		self._compute(COORDS_TRANSFORM_TIME)
+		HVC = self._HVC(ac, alt)
+		if not self._isSetR3:
+			self.autoRef_3()
+		EVC = [f32(sum(self._iT[i][j]*HVC[j] for j in range(3))) for i in range(3)]
+		return (f32(math.atan2(EVC[1], EVC[0]) + self._k*f32(t - self._t0)), f32(fasin(EVC[2])))
+
+
+## \brief Model of AxesLib: positions in steps, limit sensors and timing of the movements
+#
+#  The mechanism has steps_x steps in 360º (X axis, sensors at 0º and 360º) and steps_y steps in 90º (Y axis,
+#  sensors at 0º and 90º). The device starts at (0, 0).
+class Axes_Model():
+	def __init__(self, device, steps_x=2000, steps_y=500):
+		self.device = device
+		self.steps_x = steps_x
+		self.steps_y = steps_y
+		## Physical position of the axes (steps)
+		self.px = 0
+		self.py = 0
+		## Position as known by the firmware
+		self._x = self._y = self._X = self._Y = 0
+		self._x_rev = False
+		self._pv_x = self._pv_y = 0
+		self._pgrad_x = self._pgrad_y = 0.0
+		self._revx = self._topy = 0
+
+	## Sensors (True when the limit is reached)
+	def s0_x(self):
+		return self.px <= 0
+	def s360_x(self):
+		return self.px >= self.steps_x
+	def sbottom_y(self):
+		return self.py <= 0
+	def stop_y(self):
+		return self.py >= self.steps_y
+
+	def _sensor(self, axis, up):
+		if axis == 'x':
+			return self.s360_x() if up else self.s0_x()
+		return self.stop_y() if up else self.sbottom_y()
+
+	## AxesLib::_step: moves up to 'steps' steps, until the sensor of the direction of movement is reached
+	def _step(self, axis, up, steps, nodelay=False):
+		if not nodelay:
+			self.device.delay(STEP_START_DELAY)
+		for i in range(steps):
+			if axis == 'x':
+				self.px += 1 if up else -1
+			else:
+				self.py += 1 if up else -1
+			self.device.delay(2*STEP_HALF_PERIOD)
+			self.device.heartbeat()
+			if self._sensor(axis, up):
+				return i+1
+		return steps
+
+	def init(self):
+		self._x = self._X = 0
+		self._x_rev = False
+		self._y = 0
+		self._step('x', True, MAX_STEPS)
+		self._pv_x = self._step('x', False, MAX_STEPS)
+		self._pgrad_x = f32(self._pv_x/360.0)
+		self._step('y', True, MAX_STEPS)
+		self._pv_y = self._step('y', False, MAX_STEPS)
+		self._pgrad_y = f32(self._pv_y/90.0)
+		self._X = int(360*self._pgrad_x)
+		self._Y = int(180*self._pgrad_y)
+		self._revx = int(180*self._pgrad_x)
+		self._topy = int(90*self._pgrad_y)
+
+	## Accelerated movement (AxesLib::movx / movy), until the 'stop' command, the abort byte or a limit
+	#
+	# \return True if a limit has been reached
+	def mov(self, axis, up):
+		steps = 0
+		facel = ACCEL_HALF_PERIOD
+		comm = b''
+		while comm != b'stop':
+			if self._sensor(axis, up):
+				break
+			if axis == 'x':
+				self.px += 1 if up else -1
+			else:
+				self.py += 1 if up else -1
+			self.device.delay(2*facel)
+			steps += 1
+			if steps % 50 == 0 and facel > 0.0011:
+				facel -= 0.001
+			self.device.heartbeat()
+			if self.device.abort_requested():
+				break
+			comm += self.device.read_stop(4 - len(comm))
+			if len(comm) == 4:
+				break
+		if axis == 'x':
+			self._x = min(max(self._x + (steps if up else -steps), 0), self._X)
+		else:
+			self._y = min(max(self._y + (steps if up else -steps), 0), self._Y)
+		return self._sensor(axis, up)
+
+	def getX(self):
+		if not self._x_rev:
+			degx = f32(fdiv(self._x, self._pgrad_x))
+		elif self._x >= self._revx:
+			degx = f32(fdiv(self._x - self._revx, self._pgrad_x))
+		else:
+			degx = f32(fdiv(self._x + self._revx, self._pgrad_x))
+		return self._deg2rad(360.0 - degx)
+
+	def getY(self):
+		if not self._x_rev:
+			return self._deg2rad(f32(fdiv(self._y, self._pgrad_y)))
+		return self._deg2rad(f32(fdiv(self._topy + (self._topy - self._y), self._pgrad_y)))
+
+	def getPX(self):
+		return self._pv_x
+
+	def getPY(self):
+		return self._pv_y*4
+
+	def _rad2deg(self, rad):
+		return lrint(f32(f32(rad*180.0)/PI))
+
+	def _deg2rad(self, deg):
+		return f32(f32(deg*PI)/180)
+
+	def goToRads(self, rx, ry):
+		degsH = 360.0 - self._rad2deg(rx)
+		if degsH >= 360.0:
+			degsH -= 360.0
+		self._moveTo(trunc(f32(degsH*self._pgrad_x)), trunc(f32(self._rad2deg(ry)*self._pgrad_y)))
+
+	def goToSteps(self, x, y):
+		self._moveTo(min(max(x, 0), self._X), min(max(y, 0), self._Y))
+
+	def _moveTo(self, x, y):
+		if x < 0:
+			x = self._X - abs(x)
+		if x > self._X:
+			x = self._X
+		if y > self._Y:
+			y = self._Y
+		if y > self._topy:
+			self._x_rev = True
+			y = self._topy - (y - self._topy)
+			x = x - self._revx if x >= self._revx else x + self._revx
+		elif self._x_rev:
+			self._x_rev = False
+		self._moveDDA(x, y)
+
+	def _moveXY(self, x, y):
+		if x > self._x:
+			self._x += self._step('x', True, x - self._x, True)
+		else:
+			self._x -= self._step('x', False, self._x - x, True)
+		if y > self._y:
+			self._y += self._step('y', True, y - self._y, True)
+		else:
+			self._y -= self._step('y', False, self._y - y, True)
+
+	def _moveDDA(self, x, y):
+		dx = x - self._x
+		dy = y - self._y
+		steps = max(abs(dx), abs(dy))
+		if steps == 0:
+			return
+		x_inc = f32(dx/float(steps))
+		y_inc = f32(dy/float(steps))
+		x_ = float(self._x)
+		y_ = float(self._y)
+		for i in range(steps):
+			x_ = f32(x_ + x_inc)
+			y_ = f32(y_ + y_inc)
+			self._moveXY(lrint(x_), lrint(y_))
+			if self.device.abort_requested():
+				break
+
+
+## \brief Virtual device: serial port on a pseudo-terminal, LinkLib protocols and the plaser.pde main loop
+#
+class Virtual_Device():
+	## Class constructor
+	#
+	# \param fast Skips the waits of the movements (and of the transmission)
+	# \param steps_x Steps of the X axis in 360º
+	# \param steps_y Steps of the Y axis in 90º
+	# \param link Path of a symbolic link to the pseudo-terminal (optional)
+	# \param cpu_time Simulates the time of the coordinates transformations of the Arduino
+	def __init__(self, fast=False, steps_x=2000, steps_y=500, link=None, cpu_time=False):
+		self.fast = fast
+		self.cpu_time = cpu_time
+		self.steps_x = steps_x
+		self.steps_y = steps_y
+		(self._master, slave) = os.openpty()
+		tty.setraw(slave)
+		## Path of the serial port of the device
+		self.port = os.ttyname(slave)
+		os.close(slave)
+		if link is not None:
+			if os.path.lexists(link):
+				os.remove(link)
+			os.symlink(self.port, link)
+			self.port = link
+		self._rx = bytearray()
+		self._thread = None
+		## Number of commands executed
+		self.commands = 0
+
+	## Starts the device in a separate thread
+	#
+	def start(self):
+		self._thread = threading.Thread(target=self.serve, name='Virtual_Device')
+		self._thread.daemon = True
+		self._thread.start()
+
+	## Runs the device: the firmware is restarted each time the port is opened
+	#
+	def serve(self):
+		while True:
+			self._wait_open()
+			self.reset()
+			try:
+				while True:
+					self.loop()
+			except Disconnected:
+				pass
+
+	## Waits until the port is opened by the computer
+	#
+	def _wait_open(self):
+		poll = select.poll()
+		poll.register(self._master, select.POLLIN)
+		while True:
+			events = poll.poll(50)
+			if not any(e & select.POLLHUP for (fd, e) in events):
+				return
+			sleep(0.05)
+
+	## Restart of the board: initial state of the firmware (setup())
+	#
+	def reset(self):
+		self._rx = bytearray()
+		self.binary = False
+		self.pipelined = False
+		self.baud = DEFAULT_BAUD
+		self.laser = False
+		self.coords = Coords_Model(self)
+		self.axes = Axes_Model(self, self.steps_x, self.steps_y)
+		self.t = 0.0
+		self._wall = time()
+		self._clock = 0.0
+		self._last_beat = 0.0
+		#Time for the computer to configure the port
+		sleep(0.05)
+		self.println("init")
+
+	## Virtual time
+
+	def delay(self, seconds):
+		self._clock += seconds
+		if not self.fast:
+			ahead = self._clock - (time() - self._wall)
+			if ahead > 0.002:
+				sleep(ahead)
+
+	## Time of a calculation of the Arduino, in real time even in fast mode (if cpu_time)
+	def compute(self, seconds):
+		if not self.cpu_time:
+			return
+		if self.fast:
+			self._clock += seconds
+			sleep(seconds)
+		else:
+			self.delay(seconds)
+
+	def millis(self):
+		return self._clock
+
+	def heartbeat(self):
+		if self._clock - self._last_beat >= HEARTBEAT:
+			self._last_beat = self._clock
+			if self.binary:
+				self.frame(b'k')
+			else:
+				self.println("k")
+
+	## Serial port
+
+	def _fill(self, timeout):
+		(r, w, x) = select.select([self._master], [], [], timeout)
+		if not r:
+			return False
+		try:
+			data = os.read(self._master, 1024)
+		except OSError:
+			raise Disconnected()
+		if not data:
+			raise Disconnected()
+		self._rx += data
+		return True
+
+	## Reads a byte, waiting for it (None on timeout)
+	def read(self, timeout=None):
+		if not self._rx:
+			while not self._fill(timeout):
+				if timeout is not None:
+					return None
+			#The virtual time goes on while waiting
+			if not self.fast:
+				self._clock = max(self._clock, time() - self._wall)
+		b = self._rx[:1]
+		del self._rx[:1]
+		return bytes(b)
+
+	## Reads the received bytes of a 'stop', without waiting: up to the given size, and not the abort byte
+	def read_stop(self, size):
+		self._fill(0)
+		data = bytes(self._rx[:size]).split(ABORT_BYTE)[0]
+		del self._rx[:len(data)]
+		return data
+
+	## AxesLib::_abortRequested: consumes the abort byte if it is the next one
+	def abort_requested(self):
+		self._fill(0)
+		if self._rx[:1] == ABORT_BYTE:
+			del self._rx[:1]
+			return True
+		return False
+
+	def write(self, data):
+		if not self.fast:
+			self.delay(len(data)*10.0/self.baud)
+		try:
+			os.write(self._master, data)
+		except OSError:
+			raise Disconnected()
+
+	def println(self, line=''):
+		self.write(line.encode('ascii') + b'\r\n')
+
+	def frame(self, code, payload=b''):
+		body = code + bytes((len(payload), )) + payload
+		self.write(bytes((FRAME_START, )) + body + bytes((crc8(body), )))
+
+	## LinkLib
+
+	def read_command(self):
+		self._payload = b''
+		self._pos = 0
+		if self.binary:
+			while self.read() != bytes((FRAME_START, )):
+				pass
+			code = self.read()
+			size = self.read()[0]
+			if size > FRAME_MAX_PAYLOAD:
+				return '????'
+			self._payload = b''.join(self.read() for i in range(size))
+			if self.read()[0] != crc8(code + bytes((size, )) + self._payload):
+				return '????'
+			return BINARY_COMMANDS.get(code.decode('ascii', 'replace'), '????')
+		if not self.pipelined:
+			self.println("cmd")
+		comm = b''
+		while len(comm) < 4:
+			b = self.read()
+			if b != ABORT_BYTE:
+				comm += b
+		return comm.decode('ascii', 'replace')
+
+	def get_float(self):
+		if self.binary:
+			if self._pos + 4 > len(self._payload):
+				return 0.0
+			value = _float.unpack_from(self._payload, self._pos)[0]
+			self._pos += 4
+			return value
+		if not self.pipelined:
+			self.println("float")
+		sign = self.read()
+		data = b''.join(self.read() for i in range(8))
+		try:
+			value = f32(float(data.decode('ascii')))
+		except ValueError:
+			value = 0.0
+		if sign == b'-':
+			value = -value
+		if not self.pipelined:
+			self.println("_OK_")
+		return value
+
+	def get_long(self):
+		if not self.binary:
+			return lrint(self.get_float())
+		if self._pos + 4 > len(self._payload):
+			return 0
+		value = _long.unpack_from(self._payload, self._pos)[0]
+		self._pos += 4
+		return value
+
+	def get_char(self):
+		if self.binary:
+			c = self._payload[self._pos:self._pos+1]
+			self._pos += 1
+			return c
+		return self.read()
+
+	def done(self, tag):
+		if self.binary:
+			self.frame(b'D', tag.encode('ascii'))
+		else:
+			self.println("done_" + tag)
+
+	def _pair(self, tag, a, b, fmt):
+		if self.binary:
+			self.frame(tag.encode('ascii'), struct.pack(fmt, a, b))
+		elif fmt == '<ff':
+			self.println("%s_%s %s" % (tag, print_float(a), print_float(b)))
+		else:
+			self.println("%s_%d %d" % (tag, a, b))
+
+	def horizontal(self):
+		self._pair('h', self.axes.getX(), self.axes.getY(), '<ff')
+
+	def equatorial(self, ar, dec):
+		self._pair('e', ar, dec, '<ff')
+
+	def error(self):
+		if self.binary:
+			self.frame(b'E')
+		else:
+			self.println("ERROR")
+
+	def change_baud(self, baud):
+		previous = self.baud
+		self.baud = baud
+		received = b''
+		deadline = time() + BAUD_TIMEOUT
+		while len(received) < len(BAUD_PATTERN) and time() < deadline:
+			b = self.read(max(0.0, deadline - time()))
+			if b is not None:
+				received += b
+		if received == BAUD_PATTERN:
+			self.write(BAUD_PATTERN)
+			return True
+		self.baud = previous
+		return False
+
+	## Main loop of plaser.pde
+	#
+	def loop(self):
+		comm = self.read_command()
+		self.commands += 1
+		c = self.coords
+		a = self.axes
+
+		if comm in ('set1', 'set2', 'set3', 'goto'):
+			(ar, dec, t) = (self.get_float(), self.get_float(), self.get_float())
+			self.t = t
+		if comm == 'move':
+			(ac, alt, t) = (self.get_float(), self.get_float(), self.get_float())
+			self.t = t
+		if comm == 'step':
+			(px, py) = (self.get_long(), self.get_long())
+
+		if comm == 'time':
+			c.setTime(self.get_float())
+			self.done("time")
+		elif comm in ('set1', 'set2', 'set3'):
+			c.setRef(int(comm[3]) - 1, ar, dec, t, a.getX(), a.getY())
+			self.done(comm)
+		elif comm == 'goto':
+			(ac, alt) = c.getHCoords(ar, dec, t)
+			a.goToRads(ac, alt)
+			self.horizontal()
+			if c.isConfigured():
+				self.equatorial(*c.getECoords(a.getX(), a.getY(), t))
+			self.done("goto")
+		elif comm == 'move':
+			a.goToRads(ac, alt)
+			self._pair('p', a._x, a._y, '<ii')
+			self.horizontal()
+			if c.isConfigured():
+				self.equatorial(*c.getECoords(a.getX(), a.getY(), t))
+			self.done("move")
+		elif comm == 'step':
+			a.goToSteps(px, py)
+			self._pair('p', a._x, a._y, '<ii')
+			self.horizontal()
+			self.done("step")
+		elif comm in ('movx', 'movy'):
+			up = (self.get_char() == b'1')
+			end = a.mov(comm[3], up)
+			self.horizontal()
+			if c.isConfigured():
+				self.equatorial(*c.getECoords(a.getX(), a.getY(), self.t))
+			self.done("end" if end else comm)
+		elif comm == 'init':
+			a.init()
+			self._pair('p', a.getPX(), a.getPY(), '<ii')
+			self.done("init")
+		elif comm == 'laon':
+			self.laser = True
+			self.done("laserOn")
+		elif comm == 'loff':
+			self.laser = False
+			self.done("laserOff")
+		elif comm == 'stop':
+			self.done("stop")
+		elif comm == 'ping':
+			self.done("ping")
+		elif comm == 'baud':
+			baud = int(self.get_float()*100000.0 + 0.5)
+			if baud in BAUDS:
+				self.done("baud")
+				self.change_baud(baud)
+			else:
+				self.error()
+		elif comm == 'pipe' and not self.binary:
+			self.done("pipe")
+			self.pipelined = True
+		elif comm == 'binm' and not self.binary:
+			self.done("binm")
+			self.binary = True
+		else:
+			self.error()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Virtual plaser device on a pseudo-terminal")
+	parser.add_argument('--fast', action='store_true', help="Skips the waits of the movements")
+	parser.add_argument('--steps-x', type=int, default=2000, help="Steps of the X axis in 360º")
+	parser.add_argument('--steps-y', type=int, default=500, help="Steps of the Y axis in 90º")
+	parser.add_argument('--link', help="Symbolic link to the pseudo-terminal (for example /tmp/ttyPLASER)")
+	parser.add_argument('--cpu-time', action='store_true', help="Simulates the time of the CoordsLib calculations")
+	args = parser.parse_args()
+
+	device = Virtual_Device(args.fast, args.steps_x, args.steps_y, args.link, args.cpu_time)
+	print("Virtual device on %s" % device.port)
+	sys.stdout.flush()
+	try:
+		device.serve()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import types
+import random
+import argparse
+import subprocess
+from timeit import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(ROOT, 'main', 'python'))
+import coords
+
+## \brief Microbenchmark of the parsers and formatters of coords.py
+#
+#  Time per call (microseconds) of the conversions of the goto and position paths, with two workloads:
+#
+#  - cold: every value is different (first conversion of each value, the caches are not used).
+#  - tracking: a few values repeated, as the positions and targets while tracking an object.
+#
+#  With --baseline, the same functions of coords.py in another revision are measured too, and the speedup is
+#  shown. Example:
+#
+#	./coords_benchmark.py --baseline HEAD~1
+#
+
+FUNCTIONS = ['degStr_2_rad', 'hourStr_2_rad', 'radStr_2_deg', 'deg_2_degStr', 'hour_2_hourStr']
+
+## Random values for each function
+def values(name, count, rnd):
+	if name == 'degStr_2_rad':
+		return ["%sº%d'%02d''" % (rnd.randint(-89, 89), rnd.randint(0, 59), rnd.randint(0, 59)) for i in range(count)]
+	if name == 'hourStr_2_rad':
+		return ["%dh%02dm%02ds" % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)) for i in range(count)]
+	if name == 'radStr_2_deg':
+		return ["%.6f" % rnd.uniform(-3.14, 6.28) for i in range(count)]
+	if name == 'deg_2_degStr':
+		return [rnd.uniform(0, 360) for i in range(count)]
+	return [rnd.uniform(0, 24) for i in range(count)]
+
+## coords.py of a git revision, as a module
+def load_revision(rev):
+	source = subprocess.check_output(['git', 'show', '%s:main/python/coords.py' % rev], cwd=ROOT)
+	module = types.ModuleType('coords_%s' % rev)
+	exec(compile(source, 'coords.py@%s' % rev, 'exec'), module.__dict__)
+	return module
+
+## Time per call (us) of function over the values
+def per_call(function, vals, repeat):
+	return timeit(lambda: [function(v) for v in vals], number=repeat) / (repeat * len(vals)) * 1e6
+
+## Time per call of the function of module, without its cache for the cold workload
+def measure(module, name, cold, tracking, repeat):
+	function = getattr(module, name)
+	uncached = getattr(function, '__wrapped__', function)
+	if hasattr(function, 'cache_clear'):
+		function.cache_clear()
+	return (per_call(uncached, cold, 1), per_call(function, tracking, repeat))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Microbenchmark of the parsers and formatters of coords.py")
+	parser.add_argument('--baseline', help="git revision to compare with")
+	parser.add_argument('--count', type=int, default=20000, help="Values of the cold workload")
+	parser.add_argument('--distinct', type=int, default=50, help="Distinct values of the tracking workload")
+	parser.add_argument('--repeat', type=int, default=20)
+	args = parser.parse_args()
+
+	baseline = load_revision(args.baseline) if args.baseline else None
+	rnd = random.Random(1)
+	print("%-16s %10s %10s %10s %10s %8s %8s" % ("us per call", "cold", "tracking", "base cold", "base track",
+												 "x cold", "x track"))
+	for name in FUNCTIONS:
+		cold = values(name, args.count, rnd)
+		distinct = values(name, args.distinct, rnd)
+		tracking = [rnd.choice(distinct) for i in range(args.count // args.repeat)]
+		(c, t) = measure(coords, name, cold, tracking, args.repeat)
+		if baseline is None:
+			print("%-16s %10.3f %10.3f" % (name, c, t))
+		else:
+			(bc, bt) = measure(baseline, name, cold, tracking, args.repeat)
+			print("%-16s %10.3f %10.3f %10.3f %10.3f %8.1f %8.1f" % (name, c, t, bc, bt, bc / c, bt / t))
+	print("cache: %d entries per function" % coords.CACHE_SIZE)
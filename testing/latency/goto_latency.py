@@ -0,0 +1,357 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+from time import time, sleep, perf_counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(ROOT, 'main', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'testing', 'device'))
+from PyQt4 import QtCore
+import coords
+import stellarium_protocol as protocol
+from telescope_server import Telescope_Server, Telescope_Channel
+from ldevice import LaserDev
+from coalescing_dispatcher import CoalescingDispatcher
+
+## \brief End-to-end latency of the gotos: Stellarium -> server -> LaserDev -> device -> Stellarium
+#
+#  Starts the Telescope_Server without user interface, connected as in LaserControlMain to a LaserDev, which
+#  drives the virtual device (../device/simulator.py) or any other port (the firmware built for the host, or
+#  the real device). A Stellarium client emulator sends goto messages at the given rate, and every message is
+#  followed along the path. The latency of each stage is reported with its percentiles:
+#
+#  - tcp_receive: from the client write to the server read.
+#  - decode: message framing and decoding.
+#  - conversion: signal to the application and conversion of the coordinates to the device format.
+#  - dispatch: wait for the previous device commands (the pending gotos are coalesced, see superseded).
+#  - serial_write: from the goto call to the write of the command on the serial port.
+#  - device_ack: from the serial write to the end of the command ('done_goto').
+#  - position_echo: from the equatorial position reported by the device to its reception in Stellarium.
+#  - total: from the client write to the position echo.
+#
+#  The device is pointed to two reference objects and configured before the measurement. With --offload, the
+#  horizontal coordinates of the gotos and the reported equatorial positions are calculated by LaserDev instead
+#  of the device (see LaserDev.goto), and with --cpu-time the virtual device simulates the time of these
+#  calculations on the Arduino. Example:
+#
+#	./goto_latency.py --rate 5 --count 100 --output before.json
+#	./goto_latency.py --port /tmp/ttyFW --rate 2 --count 50
+#	./goto_latency.py --cpu-time --output device.json && ./goto_latency.py --cpu-time --offload --output host.json
+#
+
+STAGES = [('tcp_receive', 'sent', 'received'), ('decode', 'received', 'decoded'),
+		  ('conversion', 'decoded', 'converted'), ('dispatch', 'converted', 'dispatched'),
+		  ('serial_write', 'dispatched', 'written'), ('device_ack', 'written', 'acked'),
+		  ('position_echo', 'position', 'echoed'), ('total', 'sent', 'echoed')]
+
+PERCENTILES = (50, 90, 99)
+
+## Reference objects: equatorial coordinates, time and horizontal position (see ../device/README.md)
+REFERENCES = [("2h31m49s", "89º15'51''", "22h04m20s", "0º27'09''", "36º49'17''"),
+			  ("18h36m56s", "38º47'03''", "22h05m07s", "78º10'04''", "70º05'19''")]
+
+## Targets of the gotos (right ascension in hours, declination in degrees), visited in turn
+TARGETS = [(19.846, 8.868), (18.063, -24.383), (13.299, -8.484), (5.919, 7.407), (6.752, -16.716),
+		   (14.261, 19.182), (16.490, -26.432), (20.690, 45.280)]
+
+
+## \brief Timestamps of every goto message along the path, identified by the time field of the message
+#
+class Probe():
+	def __init__(self):
+		self.marks = {}
+		self.lock = threading.Lock()
+
+	def mark(self, mid, name, t=None):
+		with self.lock:
+			self.marks.setdefault(mid, {}).setdefault(name, perf_counter() if t is None else t)
+
+	def durations(self, start, end):
+		with self.lock:
+			return [(m[end] - m[start])*1000.0 for m in self.marks.values() if start in m and end in m]
+
+
+## Server connection that timestamps the reception and decoding of the messages
+#
+class Probed_Channel(Telescope_Channel):
+	def buffer_updated(self, nbytes):
+		received = perf_counter()
+		self.framer.commit(nbytes)
+		batch = self.framer.messages()
+		decoded = perf_counter()
+		for (mtime, ra, dec) in batch:
+			self.server.probe.mark(mtime, 'received', received)
+			self.server.probe.mark(mtime, 'decoded', decoded)
+		if batch:
+			self.handle_messages(batch)
+
+class Probed_Server(Telescope_Server):
+	def __init__(self, probe, **kwargs):
+		Telescope_Server.__init__(self, **kwargs)
+		self.probe = probe
+
+	def _new_channel(self):
+		return Probed_Channel(self, self.max_queue, self.stall_timeout)
+
+
+## \brief The application without user interface, once configured (see LaserControlMain)
+#
+#  The gotos received from Stellarium are sent to the device through the coalescing dispatcher, and the
+#  equatorial positions of the device are sent back to Stellarium.
+class Headless_Control():
+	def __init__(self, server, device, probe):
+		self.server = server
+		self.device = device
+		self.probe = probe
+		self.current = None
+		## Expected position messages in Stellarium: {(ra, dec): message id}
+		self.echoes = {}
+		## Positions not sent to Stellarium because they were already shown
+		self.unchanged = 0
+		self.lock = threading.Lock()
+		self.dispatcher = CoalescingDispatcher()
+		self.dispatcher.start()
+		server.stell_pos_recv.connect(self.stellariumRecv)
+		device.pos_e_received.connect(self.pos_e_received)
+		self._hook_serial(device.serial)
+
+	## The serial writes of the current goto are timestamped
+	def _hook_serial(self, port):
+		write = port.write
+		def probed_write(data):
+			n = write(data)
+			if self.current is not None:
+				self.probe.mark(self.current, 'written')
+			return n
+		port.write = probed_write
+
+	def stellariumRecv(self, ra, dec, mtime):
+		stime = coords.Hours.from_timestamp(mtime / 1000000.0)
+		self.probe.mark(mtime, 'converted')
+		self.dispatcher.submit(self._goto, mtime, ra, dec, stime, key='goto')
+
+	def _goto(self, mid, ra, dec, t):
+		self.current = mid
+		self.probe.mark(mid, 'dispatched')
+		future = self.device.goto(ra, dec, t)
+		future.add_done_callback(lambda f: self.probe.mark(mid, 'acked'))
+		return future
+
+	def pos_e_received(self, ra, dec):
+		if self.current is not None:
+			self.probe.mark(self.current, 'position')
+			key = coords.rad_2_stellarium(ra, dec)
+			if self.server.broadcaster.position == key:
+				# Already shown in Stellarium (the server echoes the received coordinates), no message is sent
+				self.unchanged += 1
+			else:
+				with self.lock:
+					self.echoes[key] = self.current
+		self.server.proxy_signal_sent(ra, dec)
+
+	## Position message received by Stellarium
+	def echo(self, ra, dec, t):
+		with self.lock:
+			mid = self.echoes.pop((ra, dec), None)
+		if mid is not None:
+			self.probe.mark(mid, 'echoed', t)
+
+	def close(self):
+		self.dispatcher.cancel()
+
+
+## \brief Stellarium client emulator: sends gotos at a fixed rate and receives the positions
+#
+class Stellarium_Client():
+	def __init__(self, port, probe, on_position):
+		self.sock = socket.create_connection(('localhost', port))
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.probe = probe
+		self.on_position = on_position
+		self.last_id = 0
+		self.sent = 0
+		self.received = 0
+		self._reader = threading.Thread(target=self._read)
+		self._reader.daemon = True
+		self._reader.start()
+
+	def _read(self):
+		size = protocol.CURRENT_POSITION_SIZE
+		buf = bytearray()
+		while True:
+			try:
+				data = self.sock.recv(4096)
+			except OSError:
+				return
+			if not data:
+				return
+			t = perf_counter()
+			buf += data
+			while len(buf) >= size:
+				(msize, mtype, mtime, ra, dec, status) = protocol.CURRENT_POSITION.unpack_from(buf)
+				del buf[:size]
+				self.received += 1
+				self.on_position(ra, dec, t)
+
+	def goto(self, ra_h, dec_d):
+		# The time field identifies the message
+		mid = max(protocol.timestamp(), self.last_id + 1)
+		self.last_id = mid
+		data = protocol.GOTO.pack(protocol.GOTO_SIZE, protocol.MSG_GOTO, mid,
+								  int(ra_h*(2147483648/12.0)) & 0xffffffff, int(dec_d*(1073741824/90.0)))
+		self.probe.mark(mid, 'sent')
+		self.sock.sendall(data)
+		self.sent += 1
+
+	def close(self):
+		self.sock.close()
+
+
+def percentile(values, p):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(p/100.0*(len(ordered) - 1))))]
+
+def summary(values):
+	if not values:
+		return {'count': 0}
+	result = {'count': len(values), 'mean': sum(values)/len(values), 'max': max(values)}
+	for p in PERCENTILES:
+		result['p%d' % p] = percentile(values, p)
+	return result
+
+def revision():
+	try:
+		return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+									   stderr=subprocess.DEVNULL).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def benchmark(args):
+	probe = Probe()
+	simulator = None
+	port = args.port
+	if port is None:
+		from simulator import Virtual_Device
+		simulator = Virtual_Device(fast=not args.realtime, cpu_time=args.cpu_time)
+		simulator.start()
+		port = simulator.port
+
+	server = Probed_Server(probe, port=args.server_port)
+	server.daemon = True
+	server.start()
+
+	initialized = threading.Event()
+	device = LaserDev(usb_serial=port, binary=(args.protocol == 'binary'), max_baud=args.max_baud,
+					  offload=args.offload)
+	device.init_received.connect(initialized.set)
+	control = Headless_Control(server, device, probe)
+	device.start()
+	if not initialized.wait(args.init_timeout):
+		raise RuntimeError("The device has not been initialized")
+	for (i, (ra, dec, t, az, alt)) in enumerate(REFERENCES):
+		device.move(az, alt).result(args.init_timeout)
+		device.setRef(i+1, ra, dec, t).result(args.init_timeout)
+
+	while server.loop is None:
+		sleep(0.01)
+	client = Stellarium_Client(args.server_port, probe, control.echo)
+	sleep(0.2)
+
+	start = time()
+	for i in range(args.count):
+		(ra_h, dec_d) = TARGETS[i % len(TARGETS)]
+		client.goto(ra_h + 0.01*(i // len(TARGETS)), dec_d)
+		next_goto = start + (i + 1)/args.rate
+		sleep(max(0.0, next_goto - time()))
+	# Waiting for the last commands
+	deadline = time() + args.drain
+	while time() < deadline and (control.dispatcher.pending() > 0 or
+								 len(probe.durations('sent', 'acked')) + control.dispatcher.superseded < args.count):
+		sleep(0.05)
+	sleep(0.2)
+
+	results = {
+		'revision': revision(),
+		'config': {'rate': args.rate, 'count': args.count, 'device': args.port or 'simulator',
+				   'realtime': args.realtime, 'protocol': device.protocol, 'baud': device.serial.baudrate,
+				   'cpu_time': args.cpu_time, 'offload': device.offload},
+		'gotos': {'sent': client.sent, 'executed': len(probe.durations('dispatched', 'acked')),
+				  'superseded': control.dispatcher.superseded, 'echoed': len(probe.durations('position', 'echoed')),
+				  'echo_unchanged': control.unchanged, 'suppressed': device.suppressed['goto'],
+				  'positions_received': client.received},
+		'stages_ms': dict((name, summary(probe.durations(start, end))) for (name, start, end) in STAGES),
+	}
+
+	client.close()
+	control.close()
+	device.close()
+	server.close_socket()
+	return results
+
+def report(results):
+	config = results['config']
+	print("%s, %s protocol at %d baud, %d gotos at %.1f/s, transformations on the %s" %
+		  (config['device'], config['protocol'], config['baud'], config['count'], config['rate'],
+		   'host' if config.get('offload') else 'device'))
+	print("gotos: %(sent)d sent, %(executed)d executed, %(superseded)d superseded, %(suppressed)d suppressed, "
+		  "%(echoed)d echoed (%(echo_unchanged)d unchanged)" % results['gotos'])
+	print("%-14s %6s %9s %9s %9s %9s %9s" % ('stage (ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+	for (name, start, end) in STAGES:
+		s = results['stages_ms'][name]
+		if s['count'] == 0:
+			print("%-14s %6d" % (name, 0))
+		else:
+			print("%-14s %6d %9.3f %9.3f %9.3f %9.3f %9.3f" % (name, s['count'], s['mean'], s['p50'], s['p90'],
+															   s['p99'], s['max']))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="End-to-end latency of the gotos from Stellarium to the device")
+	parser.add_argument('--port', help="Serial port of the device (by default a virtual device is started)")
+	parser.add_argument('--realtime', action='store_true', help="Virtual device with real movement times")
+	parser.add_argument('--protocol', choices=('binary', 'pipe'), default='binary', help="Protocol negotiated")
+	parser.add_argument('--max-baud', type=int, default=500000)
+	parser.add_argument('--rate', type=float, default=5.0, help="Gotos per second")
+	parser.add_argument('--count', type=int, default=50, help="Number of gotos")
+	parser.add_argument('--server-port', type=int, default=10011, help="Port of the Telescope_Server")
+	parser.add_argument('--init-timeout', type=float, default=60.0)
+	parser.add_argument('--drain', type=float, default=30.0, help="Maximum wait for the last gotos")
+	parser.add_argument('--offload', action='store_true', help="Transformations calculated by LaserDev")
+	parser.add_argument('--cpu-time', action='store_true',
+						help="Virtual device with the time of the CoordsLib calculations")
+	parser.add_argument('--output', help="JSON file for the results")
+	parser.add_argument('--verbose', action='store_true')
+	args = parser.parse_args()
+
+	if not args.verbose:
+		logging.disable(logging.INFO)
+
+	app = QtCore.QCoreApplication(sys.argv)
+	outcome = {}
+	def run():
+		try:
+			outcome['results'] = benchmark(args)
+		except Exception as e:
+			outcome['error'] = e
+		QtCore.QMetaObject.invokeMethod(app, 'quit', QtCore.Qt.QueuedConnection)
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
+	app.exec_()
+
+	if 'error' in outcome:
+		print("Error: %s" % outcome['error'])
+		sys.exit(1)
+	report(outcome['results'])
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(outcome['results'], f, indent=2, sort_keys=True)
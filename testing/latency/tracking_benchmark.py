@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import math
+import json
+import argparse
+import threading
+from time import time
+import numpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(ROOT, 'main', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'testing', 'device'))
+import coords
+from ldevice import LaserDev
+from tracking_engine import TrackingEngine, MIN_INTERVAL, MAX_INTERVAL
+
+## \brief Tracking of sidereal targets: commands sent to the device and pointing error.
+#
+#  Compares the periodic gotos of the application (one every --period seconds, calculated by the device, or by
+#  the host in steps with 'periodic-steps') with the predictive tracking (TrackingEngine, a correction in steps
+#  when the predicted position changes). The gotos to the current position of the device are not sent (see
+#  LaserDev.suppressed): 'requests' are the gotos of the tracking, and 'commands' the ones sent. The
+#  device is the virtual one in fast mode, and the time of the tracking is virtual, so hours of tracking are
+#  simulated in a few seconds. The pointing error is the distance (in motor steps) between the position of
+#  the device and the exact position of the target, sampled every second. Example:
+#
+#	./tracking_benchmark.py --duration 3600 --output tracking.json
+#
+
+## Reference objects: equatorial coordinates, time and horizontal position (see ../device/README.md)
+REFERENCES = [("2h31m49s", "89º15'51''", "22h04m20s", "0º27'09''", "36º49'17''"),
+			  ("18h36m56s", "38º47'03''", "22h05m07s", "78º10'04''", "70º05'19''")]
+
+## Tracked targets (right ascension, declination)
+TARGETS = [("Altair", "19h50m47s", "8º52'07''"), ("Vega", "18h36m56s", "38º47'03''"),
+		   ("Deneb", "20h41m26s", "45º16'49''"), ("Kochab", "14h50m42s", "74º09'19''")]
+
+MODES = ('periodic', 'periodic-steps', 'predictive')
+
+## Interval between the samples of the pointing error (seconds)
+ERROR_SAMPLE = 1.0
+
+DAY = 86400.0
+
+
+## Virtual time of the tracking, from the local time of the first reference object
+class Session():
+	def __init__(self, device, ra, dec, start, min_interval, max_interval):
+		self.device = device
+		(self.ra, self.dec) = (ra, dec)
+		self.start = start
+		self.engine = TrackingEngine(device, lambda: (ra, dec), min_interval=min_interval, max_interval=max_interval)
+		self.requests = 0
+		self.commands = 0
+		self.errors = []
+
+	def local(self, t):
+		return coords.Hours(self.engine._local(t, self.start))
+
+	def goto(self, t, offload=None):
+		suppressed = self.device.suppressed['goto']
+		self.requests += 1
+		self.device.goto(self.ra, self.dec, self.local(t), offload=offload).result(60)
+		self.commands += 1 - (self.device.suppressed['goto'] - suppressed)
+
+	## Pointing error from t0 to t1, with the device at its current position
+	def sample(self, t0, t1):
+		times = numpy.arange(t0, t1, ERROR_SAMPLE)
+		if len(times) == 0:
+			return
+		(px, py) = self.device.steps
+		(ac, alt) = self.device.pointing.getHCoords(self.ra, self.dec, self.engine._local(times, self.start))
+		x = (-ac % (2 * math.pi)) * px / (2 * math.pi)
+		y = alt * py / (2 * math.pi)
+		(sx, sy) = self.device.currentSteps()
+		dx = numpy.abs((x - sx + px / 2.0) % px - px / 2.0)
+		self.errors.extend(numpy.maximum(dx, numpy.abs(y - sy)).tolist())
+
+	## Periodic gotos, as the RepeatTimer of LaserControlMain
+	def periodic(self, duration, period, offload=None):
+		for t in numpy.arange(self.start, self.start + duration, period):
+			self.goto(t, offload)
+			self.sample(t, min(t + period, self.start + duration))
+
+	## Predictive tracking (see TrackingEngine)
+	def predictive(self, duration):
+		(t, end) = (self.start, self.start + duration)
+		while t < end:
+			(when, steps) = self.engine.plan(self.ra, self.dec, t)
+			if when <= t:
+				self.goto(t, offload=True)
+				self.engine._corrected(t)
+				continue
+			when = min(when, end)
+			self.sample(t, when)
+			t = when
+
+	def summary(self, duration):
+		errors = numpy.array(self.errors)
+		stats = self.engine.stats()
+		return {'requests': self.requests, 'commands': self.commands,
+				'commands_per_hour': self.commands * 3600.0 / duration,
+				'error_mean': float(errors.mean()), 'error_p99': float(numpy.percentile(errors, 99)),
+				'error_max': float(errors.max()), 'predictions': stats['predictions'],
+				'period_min': stats['period_min'], 'period_max': stats['period_max']}
+
+
+def benchmark(args):
+	from simulator import Virtual_Device
+	simulator = Virtual_Device(fast=True)
+	simulator.start()
+	device = LaserDev(usb_serial=simulator.port)
+	initialized = threading.Event()
+	device.init_received.connect(initialized.set)
+	device.start()
+	if not initialized.wait(60):
+		raise RuntimeError("The device has not been initialized")
+	for (i, (ra, dec, t, az, alt)) in enumerate(REFERENCES):
+		device.move(az, alt).result(60)
+		device.setRef(i+1, ra, dec, t).result(10)
+
+	# The references were taken at 22h: the tracking starts then (today)
+	now = time()
+	start = now + (coords.hourStr_2_rad("22h10m0s") - coords.Hours.from_timestamp(now)) * DAY / (2 * math.pi)
+	results = {'config': {'duration': args.duration, 'period': args.period, 'steps': list(device.steps),
+						  'min_interval': args.min_interval, 'max_interval': args.max_interval},
+			   'targets': {}}
+	for (name, ra, dec) in TARGETS:
+		(ra, dec) = (coords.Hours.from_str(ra), coords.Degrees.from_str(dec))
+		results['targets'][name] = {}
+		for mode in MODES:
+			session = Session(device, ra, dec, start, args.min_interval, args.max_interval)
+			# From the same position
+			device.goto(ra, dec, session.local(start), offload=True).result(60)
+			if mode == 'periodic':
+				session.periodic(args.duration, args.period)
+			elif mode == 'periodic-steps':
+				session.periodic(args.duration, args.period, offload=True)
+			else:
+				session.predictive(args.duration)
+			results['targets'][name][mode] = session.summary(args.duration)
+	device.close()
+	return results
+
+def report(results):
+	print("%d s of tracking, periodic gotos every %.1f s, %d x %d steps per revolution" %
+		  ((results['config']['duration'], results['config']['period']) + tuple(results['config']['steps'])))
+	print("predictive tracking: corrections every %.1f s at least, predictions every %.1f s at most" %
+		  (results['config']['min_interval'], results['config']['max_interval']))
+	print("%-8s %-14s %9s %9s %9s %11s %10s %10s %11s" % ('target', 'mode', 'requests', 'commands', 'per hour',
+														   'error mean', 'error p99', 'error max', 'predictions'))
+	for (name, ra, dec) in TARGETS:
+		for mode in MODES:
+			r = results['targets'][name][mode]
+			print("%-8s %-14s %9d %9d %9.1f %11.3f %10.3f %10.3f %11s" %
+				  (name, mode, r['requests'], r['commands'], r['commands_per_hour'], r['error_mean'], r['error_p99'],
+				   r['error_max'], r['predictions'] if mode == 'predictive' else '-'))
+	print("errors in motor steps")
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Commands and pointing error of the tracking modes")
+	parser.add_argument('--duration', type=float, default=3600.0, help="Seconds of tracking of each target")
+	parser.add_argument('--period', type=float, default=5.0, help="Interval of the periodic gotos")
+	parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL,
+						help="Minimum interval between the corrections of the predictive tracking")
+	parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL,
+						help="Maximum interval between the predictions of the predictive tracking")
+	parser.add_argument('--output', help="JSON file for the results")
+	args = parser.parse_args()
+
+	results = benchmark(args)
+	report(results)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)